@@ -35,32 +35,47 @@
 
 """
 
+from array import array
+
 from nesldr.structs import *
 from nesldr.ioregs import *
 from nesldr.mappers import *
+from nesldr.entropy import *
+from nesldr.vectors import *
+from nesldr.banks import *
+from nesldr.dispatch import find_dispatch_tables, apply_dispatch_tables
+from nesldr.bankprop import propagate_banks, apply_bank_switches
+from nesldr.multicart import MULTICART_MAPPERS, find_subgames, save_directory
+from nesldr.classify import apply_code_scores
+from nesldr.ioaccess import find_ioreg_accesses, apply_ioreg_names
+from nesldr.cycles import CpuMemory, CycleAnalysis, apply_cycle_counts
+from nesldr.cdl import CdlError, find_cdl_file, read_cdl, apply_cdl
+from nesldr.archive import *
+from nesldr.bankstore import BankStoreError, is_manifest_data, read_manifest_image
+from nesldr.containers import ContainerError, UnifImage, FdsImage, probe_format, PROBE_SIZE, \
+    FORMAT_INES, FORMAT_UNIF, FORMAT_FDS, FDS_FILE_PRG
+from nesldr.database import prg_bank_map, save_prg_bank_mapping
+from nesldr.apitrace import start_api_trace, finish_api_trace, rom_class
+from nesldr.session import LoadSession
 import ida_netnode
-from ida_loader import file2base, FILEREG_PATCHABLE
+from ida_loader import file2base, mem2base, FILEREG_PATCHABLE
 from ida_idp import ph, PLFM_6502, set_processor_type, SETPROC_LOADER_NON_FATAL
-from ida_kernwin import msg, warning
+from ida_kernwin import msg, warning, ask_yn, ASKBTN_YES
 from ida_segment import add_segm, set_segm_addressing, getseg
-from ida_bytes import del_items, create_data, byte_flag, word_flag, set_cmt, get_word
+from ida_bytes import del_items, create_data, create_byte, byte_flag, word_flag, set_cmt, get_word, get_bytes, DELIT_SIMPLE
+from ida_bytes import next_that, is_code
+from ida_auto import peek_auto_queue, AU_CODE, AU_PROC
 from ida_name import set_name
 from ida_entry import add_entry
 from ida_offset import op_offset
 from ida_lines import add_extra_line
 from ida_idaapi import get_inf_structure
-from ida_nalt import get_root_filename
-
-inf = get_inf_structure()
-
+from ida_nalt import get_root_filename, get_input_file_path
 
 def YES_NO(condition):
     return ("yes" if condition else "no")
 
 
-hdr = ines_hdr()
-
-
 def readinto(li, struct):
     buf = li.read(sizeof(struct))
     if len(buf) != sizeof(struct):
@@ -80,19 +95,38 @@ def accept_file(li, path):
 #
 """
     li.seek(0)
+    magic = li.read(PROBE_SIZE)
+
+    # look for an iNES image inside of .zip/.7z archives
+    if(is_archive_magic(magic)):
+        member = open_archive_input(li)
+        if(member is None):
+            return 0
+        return "Nintendo Entertainment System ROM (%s in archive)" % member.name
+
+    # bank store manifests name the image they stand for
+    if(magic.lstrip()[:1] == b"{"):
+        li.seek(0)
+        if(not is_manifest_data(li.read(0x100))):
+            return 0
+        member = open_manifest_input(li)
+        if(member is None):
+            return 0
+        return "Nintendo Entertainment System ROM (%s from bank store)" % member.name
+
+    kind = probe_format(magic)
+
+    if(kind == FORMAT_UNIF):
+        member = open_unif_input(li)
+        if(member is None):
+            return 0
+        return "Nintendo Entertainment System ROM (UNIF, %s)" % member.board
+
+    if(kind == FORMAT_FDS):
+        return "Famicom Disk System image"
 
     # quit if file is smaller than size of iNes header
-    if li.size() < sizeof(ines_hdr):
-        return 0
-
-    # set filepos to offset 0
-    li.seek(0)
-
-    # read NES header
-    assert readinto(li, hdr)
-
-    # is it a valid ROM image in iNes format?
-    if(hdr.id != b"NES" or hdr.term != 0x1A):
+    if(kind != FORMAT_INES or li.size() < sizeof(ines_hdr)):
         return 0
 
     # this is the name of the file format which will be
@@ -104,517 +138,162 @@ def accept_file(li, path):
 
 # ----------------------------------------------------------------------
 #
-#      load file into the database.
-#
-def load_file(li, _a, _b):
-    # set processor to 6502
-    if (ph.id != PLFM_6502):
-        msg("Nintendo Entertainment System ROM detected: setting processor type to M6502.\n")
-        set_processor_type("M6502", SETPROC_LOADER_NON_FATAL)
-
-    try:
-        return load_ines_file(li)
-    except:
-        import traceback
-        traceback.print_exc()
-        return 0
-
-
-# ----------------------------------------------------------------------
-#
-#
-def write_file(fp, _):
-    warning("[debug-msg] when am I being called?\n")
-    return 0
-
-
-# ----------------------------------------------------------------------
-#
-#      loads the whole file into IDA
-#      this is a wrapper function, which:
-#
-#      - checks the header for validity and fixes broken headers
-#      - creates all necessary segments
-#      - saves the whole file to blobs
-#      - loads prg pages/banks
-#      - adds informational descriptions to the database
-#
-def load_ines_file(li):
-    # go to file offset 0 - just to be sure
-    li.seek(0)
-
-    # read the whole header
-    if not readinto(li, hdr):
-        vloader_failure("File read error!", 0)
-        return 0
-
-    # check if header is corrupt
-    # show a warning msg, but load the rom nonetheless
-    if(hdr.is_corrupt_ines_hdr()):
-        # warning("The iNES header seems to be corrupt.\nLoader might give inaccurate results!")
-        code = askyn_c(1, "The iNES header seems to be corrupt.\n"
-                       "The NES loader could produce wrong results!\n"
-                       "Do you want to internally fix the header ?\n\n"
-                       "(this will not affect the input file)")
-        if(code == 1):
-            fix_ines_hdr()
-
-    # create NES segments
-    create_segments(li)
-
-    # save NES file to blobs
-    save_image_as_blobs(li)
-
-    # load relevant ROM banks into database
-    load_rom_banks(li)
-
-    # make vectors public
-    add_entry_points(li)
-
-    # fill inf structure
-    set_ida_export_data()
-
-    # add information about the ROM image
-    describe_rom_image()
-
-    # let IDA add some information about the loaded file
-    create_filename_cmt()
-
-    return 1
-
-
-def create_filename_cmt():
-    add_extra_line(inf.min_ea, True, "File Name   : %s" % get_root_filename())
-    add_extra_line(inf.min_ea, True, "Format      : %s" % inf.filetype)
-
-
-# ----------------------------------------------------------------------
-#
-#      creates all necessary segments and initializes them, if possible
-#
-def create_segments(li):
-    # create RAM segment
-    create_ram_segment()
-
-    # create segment for I/O registers
-    # NES uses memory mapped I/O
-    create_ioreg_segment()
-
-    # create SRAM segment if supported by cartridge
-    # if( INES_MASK_SRAM( hdr.rom_control_byte_0 ) )
-    create_sram_segment()
-
-    # create segment for expansion ROM
-    create_exprom_segment()
-
-    # load trainer, if one is present
-    if(INES_MASK_TRAINER(hdr.rom_control_byte_0)):
-        warning("This ROM image seems to have a trainer.\n"
-                "By default, this loader assumes the trainer to be mapped to $7000.\n")
-        load_trainer(li)
-
-    # create segment for PRG ROMs
-    create_rom_segment()
-
-
-# ----------------------------------------------------------------------
-#
-#      creates an SRAM segment, if available on cartridge
-#
-def create_sram_segment():
-    success = add_segm(0, SRAM_START_ADDRESS,
-                       SRAM_START_ADDRESS + SRAM_SIZE, "SRAM", None) == 1
-    msg("creating SRAM segment..%s" % ("ok!\n" if success else "failure!\n"))
-    if(not success):
-        return
-    set_segm_addressing(getseg(SRAM_START_ADDRESS), 0)
-
-
-# ----------------------------------------------------------------------
-#
-#      creates a RAM segment
-#
-def create_ram_segment():
-    success = add_segm(0, RAM_START_ADDRESS,
-                       RAM_START_ADDRESS + RAM_SIZE, "RAM", None) == 1
-    msg("creating RAM segment..%s" % ("ok!\n" if success else "failure!\n"))
-    if(not success):
-        return
-    set_segm_addressing(getseg(RAM_START_ADDRESS), 0)
-
-    # how do I properly initialize a segment ?
-    # for( unsigned int ea = SRAM_START_ADDRESS; ea<= SRAM_START_ADDRESS + SRAM_SIZE; ea++ )
-    #    put_byte( ea, 0 )
-
-
-# ----------------------------------------------------------------------
-#
-#      creates an I/O registers segment and names all io registers
-#
-def create_ioreg_segment():
-    success = add_segm(0, IOREGS_START_ADDRESS,
-                       IOREGS_START_ADDRESS + IOREGS_SIZE, "IO_REGS", None) == 1
-    msg("creating IO_REGS segment..%s" %
-        ("ok!\n" if success else "failure!\n"))
-    if(not success):
-        return
-    set_segm_addressing(getseg(IOREGS_START_ADDRESS), 0)
-
-    define_item(PPU_CR_1_ADDRESS, PPU_CR_1_SIZE,
-                PPU_CR_1_SHORT_DESCRIPTION, PPU_CR_1_COMMENT)
-    define_item(PPU_CR_2_ADDRESS, PPU_CR_2_SIZE,
-                PPU_CR_2_SHORT_DESCRIPTION, PPU_CR_2_COMMENT)
-    define_item(PPU_SR_ADDRESS, PPU_SR_SIZE,
-                PPU_SR_SHORT_DESCRIPTION, PPU_SR_COMMENT)
-
-    define_item(SPR_RAM_AR_ADDRESS, SPR_RAM_AR_SIZE,
-                SPR_RAM_AR_SHORT_DESCRIPTION, SPR_RAM_AR_COMMENT)
-    define_item(SPR_RAM_IOR_ADDRESS, SPR_RAM_IOR_SIZE,
-                SPR_RAM_IOR_SHORT_DESCRIPTION, SPR_RAM_IOR_COMMENT)
-
-    define_item(VRAM_AR_1_ADDRESS, VRAM_AR_1_SIZE,
-                VRAM_AR_1_SHORT_DESCRIPTION, VRAM_AR_1_COMMENT)
-    define_item(VRAM_AR_2_ADDRESS, VRAM_AR_2_SIZE,
-                VRAM_AR_2_SHORT_DESCRIPTION, VRAM_AR_2_COMMENT)
-    define_item(VRAM_IOR_ADDRESS, VRAM_IOR_SIZE,
-                VRAM_IOR_SHORT_DESCRIPTION, VRAM_IOR_COMMENT)
-
-    define_item(PAPU_PULSE_1_CR_ADDRESS, PAPU_PULSE_1_CR_SIZE,
-                PAPU_PULSE_1_CR_SHORT_DESCRIPTION, PAPU_PULSE_1_CR_COMMENT)
-    define_item(PAPU_PULSE_1_RCR_ADDRESS, PAPU_PULSE_1_RCR_SIZE,
-                PAPU_PULSE_1_RCR_SHORT_DESCRIPTION, PAPU_PULSE_1_RCR_COMMENT)
-    define_item(PAPU_PULSE_1_FTR_ADDRESS, PAPU_PULSE_1_FTR_SIZE,
-                PAPU_PULSE_1_FTR_SHORT_DESCRIPTION, PAPU_PULSE_1_FTR_COMMENT)
-    define_item(PAPU_PULSE_1_CTR_ADDRESS, PAPU_PULSE_1_CTR_SIZE,
-                PAPU_PULSE_1_CTR_SHORT_DESCRIPTION, PAPU_PULSE_1_CTR_COMMENT)
-
-    define_item(PAPU_PULSE_2_CR_ADDRESS, PAPU_PULSE_2_CR_SIZE,
-                PAPU_PULSE_2_CR_SHORT_DESCRIPTION, PAPU_PULSE_2_CR_COMMENT)
-    define_item(PAPU_PULSE_2_RCR_ADDRESS, PAPU_PULSE_2_RCR_SIZE,
-                PAPU_PULSE_2_RCR_SHORT_DESCRIPTION, PAPU_PULSE_2_RCR_COMMENT)
-    define_item(PAPU_PULSE_2_FTR_ADDRESS, PAPU_PULSE_2_FTR_SIZE,
-                PAPU_PULSE_2_FTR_SHORT_DESCRIPTION, PAPU_PULSE_2_FTR_COMMENT)
-    define_item(PAPU_PULSE_2_CTR_ADDRESS, PAPU_PULSE_2_CTR_SIZE,
-                PAPU_PULSE_2_CTR_SHORT_DESCRIPTION, PAPU_PULSE_2_CTR_COMMENT)
-
-    define_item(PAPU_TRIANGLE_CR_1_ADDRESS, PAPU_TRIANGLE_CR_1_SIZE,
-                PAPU_TRIANGLE_CR_1_SHORT_DESCRIPTION, PAPU_TRIANGLE_CR_1_COMMENT)
-    define_item(PAPU_TRIANGLE_CR_2_ADDRESS, PAPU_TRIANGLE_CR_2_SIZE,
-                PAPU_TRIANGLE_CR_2_SHORT_DESCRIPTION, PAPU_TRIANGLE_CR_2_COMMENT)
-    define_item(PAPU_TRIANGLE_FR_1_ADDRESS, PAPU_TRIANGLE_FR_1_SIZE,
-                PAPU_TRIANGLE_FR_1_SHORT_DESCRIPTION, PAPU_TRIANGLE_FR_1_COMMENT)
-    define_item(PAPU_TRIANGLE_FR_2_ADDRESS, PAPU_TRIANGLE_FR_2_SIZE,
-                PAPU_TRIANGLE_FR_2_SHORT_DESCRIPTION, PAPU_TRIANGLE_FR_2_COMMENT)
-
-    define_item(PAPU_NOISE_CR_1_ADDRESS, PAPU_NOISE_CR_1_SIZE,
-                PAPU_NOISE_CR_1_SHORT_DESCRIPTION, PAPU_NOISE_CR_1_COMMENT)
-    define_item(PAPU_NOISE_CR_2_ADDRESS, PAPU_NOISE_CR_2_SIZE,
-                PAPU_NOISE_CR_2_SHORT_DESCRIPTION, PAPU_NOISE_CR_2_COMMENT)
-    define_item(PAPU_NOISE_FR_1_ADDRESS, PAPU_NOISE_FR_1_SIZE,
-                PAPU_NOISE_FR_1_SHORT_DESCRIPTION, PAPU_NOISE_FR_1_COMMENT)
-    define_item(PAPU_NOISE_FR_2_ADDRESS, PAPU_NOISE_FR_2_SIZE,
-                PAPU_NOISE_FR_2_SHORT_DESCRIPTION, PAPU_NOISE_FR_2_COMMENT)
-
-    define_item(PAPU_DM_CR_ADDRESS, PAPU_DM_CR_SIZE,
-                PAPU_DM_CR_SHORT_DESCRIPTION, PAPU_DM_CR_COMMENT)
-    define_item(PAPU_DM_DAR_ADDRESS, PAPU_DM_DAR_SIZE,
-                PAPU_DM_DAR_SHORT_DESCRIPTION, PAPU_DM_DAR_COMMENT)
-    define_item(PAPU_DM_AR_ADDRESS, PAPU_DM_AR_SIZE,
-                PAPU_DM_AR_SHORT_DESCRIPTION, PAPU_DM_AR_COMMENT)
-    define_item(PAPU_DM_DLR_ADDRESS, PAPU_DM_DLR_SIZE,
-                PAPU_DM_DLR_SHORT_DESCRIPTION, PAPU_DM_DLR_COMMENT)
-
-    define_item(PAPU_SV_CSR_ADDRESS, PAPU_SV_CSR_SIZE,
-                PAPU_SV_CSR_SHORT_DESCRIPTION, PAPU_SV_CSR_COMMENT)
-
-    define_item(SPRITE_DMAR_ADDRESS, SPRITE_DMAR_SIZE,
-                SPRITE_DMAR_SHORT_DESCRIPTION, SPRITE_DMAR_COMMENT)
-
-    define_item(JOYPAD_1_ADDRESS, JOYPAD_1_SIZE,
-                JOYPAD_1_SHORT_DESCRIPTION, JOYPAD_1_COMMENT)
-    define_item(JOYPAD_2_ADDRESS, JOYPAD_2_SIZE,
-                JOYPAD_2_SHORT_DESCRIPTION, JOYPAD_2_COMMENT)
-
-
-# ----------------------------------------------------------------------
-#
-#      creates a ROM segment where all the code is being loaded to
-#
-def create_rom_segment():
-    success = add_segm(0, ROM_START_ADDRESS,
-                       ROM_START_ADDRESS + ROM_SIZE, "ROM", "CODE") == 1
-    msg("creating ROM segment..%s" % ("ok!\n" if success else "failure!\n"))
-    if(not success):
-        return
-    set_segm_addressing(getseg(ROM_START_ADDRESS), 0)
-
-
-# ----------------------------------------------------------------------
-#
-#      creates an EXPANSION ROM segment, I don't know when it is used
-#
-def create_exprom_segment():
-    success = add_segm(0, EXPROM_START_ADDRESS,
-                       EXPROM_START_ADDRESS + EXPROM_SIZE, "EXP_ROM", None) == 1
-    msg("creating EXP_ROM segment..%s" %
-        ("ok!\n" if success else "failure!\n"))
-    if(not success):
-        return
-    set_segm_addressing(getseg(EXPROM_START_ADDRESS), 0)
-
-
-# ----------------------------------------------------------------------
-#
-#      loads a 512 byte trainer (located at file offset INES_HDR_SIZE)
-#      to TRAINER_START_ADDRESS
-#
-def load_trainer(li):
-    if(not INES_MASK_SRAM(hdr.rom_control_byte_0)):
-        success = add_segm(0, TRAINER_START_ADDRESS, TRAINER_START_ADDRESS +
-                           TRAINER_SIZE, "TRAINER", "CODE") == 1
-        msg("creating TRAINER segment..%s", "ok!\n" if success else "failure!\n")
-        set_segm_addressing(getseg(TRAINER_START_ADDRESS), 0)
-    li.file2base(INES_HDR_SIZE, TRAINER_START_ADDRESS,
-              TRAINER_START_ADDRESS + TRAINER_SIZE, FILEREG_PATCHABLE)
-
-
-# ----------------------------------------------------------------------
-#
-#      load 8k chr rom bank into database
-#
-def load_chr_rom_bank(li, banknr, address):
-    # todo: add support for PPU
-    # this function currently is disabled, since no
-    # segment for the PPU is created
-    msg("The loader was trying to load a CHR bank but the PPU is not supported yet.\n")
-    return
-
-    if((banknr == 0) or (hdr.chr_page_count_8k == 0)):
-        return
-
-    # this is the file offset to begin reading pages from
-    offset = INES_HDR_SIZE + \
-        (TRAINER_SIZE if INES_MASK_TRAINER(hdr.rom_control_byte_0) else 0) + \
-        PRG_PAGE_SIZE * hdr.prg_page_count_16k + \
-        (banknr - 1) * CHR_ROM_BANK_SIZE
-
-    # load page from ROM file into segment
-    msg("mapping CHR-ROM page %02d to %08x-%08x (file offset %08x) ..",
-        banknr, address, address + CHR_PAGE_SIZE, offset)
-    if(file2base(li, offset, address, address + CHR_ROM_BANK_SIZE, FILEREG_PATCHABLE) == 1):
-        msg("ok\n")
-    else:
-        msg("failure (corrupt ROM image?)\n")
-
-
-# ----------------------------------------------------------------------
-#
-#      load 16k prg rom bank into database
+#      wraps a ROM image inside of an archive, so that it can be used
+#      in place of the loader input (li) by all loading functions
 #
-def load_prg_rom_bank(li, banknr, address):
-
-    if((banknr == 0) or (hdr.prg_page_count_16k == 0)):
-        return
-
-    # this is the file offset to begin reading pages from
-    offset = INES_HDR_SIZE + \
-        (TRAINER_SIZE if INES_MASK_TRAINER(hdr.rom_control_byte_0) else 0) + \
-        (banknr - 1) * PRG_ROM_BANK_SIZE
+class ArchiveInput(object):
 
-    # load page from ROM file into segment
-    msg("mapping PRG-ROM page %02d to %08x-%08x (file offset %08x) .." %
-        (1, address, address + PRG_ROM_BANK_SIZE, offset))
-    if(li.file2base(offset, address, address + PRG_ROM_BANK_SIZE, FILEREG_PATCHABLE) == 1):
-        msg("ok\n")
-    else:
-        msg("failure (corrupt ROM image?)\n")
+    def __init__(self, member):
+        self.member = member
+        self.name = member.name
 
+    def seek(self, pos, whence=0):
+        return self.member.seek(pos, whence)
 
-# ----------------------------------------------------------------------
-#
-#      load 8k prg rom bank into database
-#
-def load_8k_prg_rom_bank(li, banknr, address):
+    def tell(self):
+        return self.member.tell()
 
-    if((banknr == 0) or (hdr.prg_page_count_16k == 0)):
-        return
+    def read(self, size):
+        return self.member.read(size)
 
-    # this is the file offset to begin reading pages from
-    offset = INES_HDR_SIZE + \
-        (TRAINER_SIZE if INES_MASK_TRAINER(hdr.rom_control_byte_0) else 0) + \
-        (banknr - 1) * PRG_ROM_8K_BANK_SIZE
+    def size(self):
+        return self.member.size()
 
-    # load page from ROM file into segment
-    msg("mapping 8k PRG-ROM page %02d to %08x-%08x (file offset %08x) ..",
-        1, address, address + PRG_ROM_8K_BANK_SIZE, offset)
-    if(file2base(li, offset, address, address + PRG_ROM_8K_BANK_SIZE, FILEREG_PATCHABLE) == 1):
-        msg("ok\n")
-    else:
-        msg("failure (corrupt ROM image?)\n")
+    # the data does not come from the input file, so there is
+    # no file offset to associate with it
+    def file2base(self, pos, ea1, ea2, patchable):
+        self.member.seek(pos)
+        data = self.member.read(ea2 - ea1)
+        if(len(data) != ea2 - ea1):
+            return 0
+        return mem2base(data, ea1, -1)
 
 
 # ----------------------------------------------------------------------
 #
-#      this function loads the image into the ida database
-#      depending on the mapper in use
+#      opens the first valid iNES image of an archive given as loader
+#      input. returns an ArchiveInput or None
 #
-def load_rom_banks(li):
-    mapper = INES_MASK_MAPPER_VERSION(
-        hdr.rom_control_byte_0, hdr.rom_control_byte_1)
-    if mapper in (MAPPER_NONE,
-                  MAPPER_MMC1,
-                  MAPPER_UNROM,
-                  MAPPER_CNROM,
-                  MAPPER_MMC3,
-                  MAPPER_MMC5,
-                  MAPPER_FFE_F4XXX,
-                  MAPPER_MMC4,
-                  MAPPER_BANDAI,
-                  MAPPER_FFE_F8XXX,
-                  MAPPER_JALECO_SS8806,
-                  MAPPER_KONAMI_VRC4,
-                  MAPPER_KONAMI_VRC2_TYPE_A,
-                  MAPPER_KONAMI_VRC2_TYPE_B,
-                  MAPPER_KONAMI_VRC6,
-                  MAPPER_NAMCOT_106,
-                  MAPPER_IREM_G_101,
-                  MAPPER_TAITO_TC0190,
-                  MAPPER_IREM_H_3001,
-                  MAPPER_SUNSOFT_MAPPER_4,
-                  MAPPER_SUNSOFT_FME7,  # not sure about this mapper
-                  MAPPER_CAMERICA,
-                  MAPPER_IREM_74HC161_32,
-                  MAPPER_GNROM,
-                  ):
-        load_prg_rom_bank(li, 1, PRG_ROM_BANK_LOW_ADDRESS)
-        load_prg_rom_bank(li, hdr.prg_page_count_16k,
-                          PRG_ROM_BANK_HIGH_ADDRESS)
-        load_chr_rom_bank(li, 1, CHR_ROM_BANK_ADDRESS)
-
-    elif mapper == MAPPER_HK_SF3:  # last prg, last prg, 1st chr
-        load_prg_rom_bank(li, hdr.prg_page_count_16k,
-                          PRG_ROM_BANK_LOW_ADDRESS)
-        load_prg_rom_bank(li, hdr.prg_page_count_16k,
-                          PRG_ROM_BANK_HIGH_ADDRESS)
-        load_chr_rom_bank(li, 1, CHR_ROM_BANK_ADDRESS)
-
-    elif mapper in (MAPPER_AOROM,  # 1st prg, 2nd prg, 1st chr
-                  MAPPER_FFE_F3XXX,
-                  MAPPER_COLOR_DREAMS,
-                  MAPPER_100_IN_1,
-                  MAPPER_NINA_1):
-        load_prg_rom_bank(li, 1, PRG_ROM_BANK_LOW_ADDRESS)
-        load_prg_rom_bank(li, 2, PRG_ROM_BANK_HIGH_ADDRESS)
-        load_chr_rom_bank(li, 1, CHR_ROM_BANK_ADDRESS)
-    elif mapper == MAPPER_MMC2:  # 1st 8k prg, last three 8k prgs, 1st chr
-        load_8k_prg_rom_bank(li, 1, PRG_ROM_BANK_LOW_ADDRESS)
-        load_8k_prg_rom_bank(li, hdr.prg_page_count_16k *
-                             2 - 2, PRG_ROM_BANK_A000)
-        load_prg_rom_bank(li, hdr.prg_page_count_16k,
-                          PRG_ROM_BANK_HIGH_ADDRESS)
-        load_chr_rom_bank(li, 1, CHR_ROM_BANK_ADDRESS)
-
-    elif mapper == MAPPER_TENGEN_RAMBO_1:  # last 8k prg, last 8k prg, last 8k prg, last 8k prg, 1st chr
-        load_8k_prg_rom_bank(li, hdr.prg_page_count_16k*2, PRG_ROM_BANK_8000)
-        load_8k_prg_rom_bank(li, hdr.prg_page_count_16k*2, PRG_ROM_BANK_A000)
-        load_8k_prg_rom_bank(li, hdr.prg_page_count_16k*2, PRG_ROM_BANK_C000)
-        load_8k_prg_rom_bank(li, hdr.prg_page_count_16k*2, PRG_ROM_BANK_E000)
-        load_chr_rom_bank(li, 1, CHR_ROM_BANK_ADDRESS)
-    else:  # 1st prg, last prg, 1st chr
-        warning("Mapper %d is not supported by this loader!\n"
-                "This could be a corrupt ROM image!\n"
-                "Loading first and last PRG-ROM banks by default." % mapper)
+def open_archive_input(li):
+    try:
+        archive = RomArchive(FileObjectAdapter(li))
+        names = archive.rom_names() or archive.names()
+        for name in names:
+            member = archive.open(name)
+            member_hdr = ines_hdr()
+            if(readinto(member, member_hdr) and
+               member_hdr.id == b"NES" and member_hdr.term == 0x1A):
+                member.seek(0)
+                return ArchiveInput(member)
+    except Exception as e:
+        msg("could not read archive: %s\n" % e)
+    return None
 
 
 # ----------------------------------------------------------------------
 #
-#      saves prg and chr ROM pages/banks to a binary large object (blob)
+#      rebuilds the image of a bank store manifest given as loader
+#      input. returns an ArchiveInput or None
 #
-def save_image_as_blobs(li):
-    # store ines header in a blob
-    save_ines_hdr_as_blob()
-
-    save_trainer_as_blob(li)
-
-    # store rom image in blobs
-    save_prg_rom_pages_as_blobs(li, hdr.prg_page_count_16k)
-    save_chr_rom_pages_as_blobs(li, hdr.chr_page_count_8k)
+def open_manifest_input(li):
+    li.seek(0)
+    try:
+        manifest, data = read_manifest_image(get_input_file_path(),
+                                             li.read(li.size()).decode("utf-8"))
+    except (OSError, ValueError, BankStoreError) as e:
+        msg("could not read manifest: %s\n" % e)
+        return None
+    return ArchiveInput(MemoryMember(manifest.name or manifest.sha1, data))
 
 
 # ----------------------------------------------------------------------
 #
-#      store header to netnode
+#      converts a UNIF image given as loader input to an iNES image.
+#      returns an ArchiveInput or None for unknown boards
 #
-def save_ines_hdr_as_blob():
-    hdr_node = ida_netnode.netnode()
-
-    if(not hdr_node.create(INES_HDR_NODE)):
-        return False
-    buf = create_string_buffer(INES_HDR_SIZE)
-    memmove(buf, addressof(hdr), sizeof(hdr))
-    return hdr_node.setblob(buf.raw, 0, 'I')
+def open_unif_input(li):
+    li.seek(0)
+    try:
+        image = UnifImage(li.read(li.size()), getattr(li, "name", None))
+        member = ArchiveInput(MemoryMember(image.title or image.board, image.to_ines()))
+    except ContainerError as e:
+        msg("could not read UNIF image: %s\n" % e)
+        return None
+    member.board = image.board
+    return member
+
+
+# loading steps (methods of IdaLoadSession), traced as separate phases
+LOADER_PHASES = ("create_segments", "save_image_as_blobs", "load_rom_banks",
+                 "find_multicart_games", "add_entry_points", "name_ioreg_accesses",
+                 "add_dispatch_targets", "add_bank_switches", "load_cdl_file", "add_likely_code",
+                 "mark_packed_data", "count_handler_cycles", "set_ida_export_data",
+                 "describe_rom_image", "create_filename_cmt",
+                 # IdaFdsLoadSession
+                 "save_disk_sides_as_blobs", "load_boot_files", "add_fds_entry_points",
+                 "describe_disk_image")
 
 
 # ----------------------------------------------------------------------
 #
-#      store trainer to netnode
+#      load file into the database.
 #
-def save_trainer_as_blob(li):
-    node = ida_netnode.netnode()
-
-    if(not INES_MASK_TRAINER(hdr.rom_control_byte_0)):
-        return False
-
-    li.seek(INES_HDR_SIZE)
-    buffer = li.read(TRAINER_SIZE)
-    if(not node.create("$ Trainer")):
-        return False
-    if(not node.setblob(buffer, TRAINER_SIZE, 0, 'I')):
-        msg("Could not store trainer to netnode!\n")
-
-    return True
-
+def load_file(li, _a, _b):
+    # set processor to 6502
+    if (ph.id != PLFM_6502):
+        msg("Nintendo Entertainment System ROM detected: setting processor type to M6502.\n")
+        set_processor_type("M6502", SETPROC_LOADER_NON_FATAL)
 
-# ----------------------------------------------------------------------
-#
-#      store PRG ROM pages to netnode
-#
-def save_prg_rom_pages_as_blobs(li, count):
-    node = ida_netnode.netnode()
+    # read archived images straight from the archive member
+    li.seek(0)
+    magic = li.read(0x100)
+    kind = probe_format(magic)
+    if(is_archive_magic(magic)):
+        li = open_archive_input(li)
+        if(li is None):
+            return 0
+    elif(is_manifest_data(magic)):
+        li = open_manifest_input(li)
+        if(li is None):
+            return 0
+    elif(kind == FORMAT_UNIF):
+        li = open_unif_input(li)
+        if(li is None):
+            return 0
 
-    li.seek(TRAINER_SIZE if INES_HDR_SIZE +
-            (INES_MASK_TRAINER(hdr.rom_control_byte_0)) else 0)
+    try:
+        if(kind == FORMAT_FDS):
+            session = IdaFdsLoadSession(li, get_root_filename())
+        else:
+            session = IdaLoadSession(li, getattr(li, "name", None))
+    except ValueError as e:
+        warning("%s" % e)
+        return 0
 
-    for i in range(count):
-        buffer = li.read(PRG_PAGE_SIZE)
-        prg_node_name = "$ PRG-ROM page %d" % i
-        if(not node.create(prg_node_name)):
-            return False
-        if(not node.setblob(buffer, 0, 'I')):
-            msg("Could not store PRG-ROM pages to netnode!\n")
+    # optional IDA API call tracing (NESLDR_API_TRACE)
+    tracer = start_api_trace(globals(), LOADER_PHASES, session)
 
-    return True
+    try:
+        result = session.run()
+        if(tracer is not None):
+            finish_api_trace(tracer, rom_class(session.mapper, session.prg_page_count,
+                                               session.chr_page_count), msg)
+        return result
+    except:
+        import traceback
+        traceback.print_exc()
+        return 0
+    finally:
+        if(tracer is not None):
+            tracer.uninstall()
 
 
 # ----------------------------------------------------------------------
 #
-#      store CHR ROM pages to netnode
 #
-def save_chr_rom_pages_as_blobs(li, count):
-    node = ida_netnode.netnode()
-
-    li.seek(INES_HDR_SIZE + (TRAINER_SIZE if INES_MASK_TRAINER(hdr.rom_control_byte_0)
-                             else 0) + PRG_PAGE_SIZE * hdr.prg_page_count_16k)
-
-    for i in range(count):
-        buffer = li.read(CHR_PAGE_SIZE)
-        chr_node_name = "$ CHR-ROM page %d" % i
-        if(not node.create(chr_node_name)):
-            return False
-        if(not node.setblob(buffer, 0, 'I')):
-            msg("Could not store CHR-ROM pages to netnode!\n")
-
-    return True
+def write_file(fp, _):
+    warning("[debug-msg] when am I being called?\n")
+    return 0
 
 
 # ----------------------------------------------------------------------
@@ -627,31 +306,6 @@ def get_mapper_name(mapper):
     return mapper_names[mapper]
 
 
-# ----------------------------------------------------------------------
-#
-#      add information about the ROM image to disassembly
-#
-def describe_rom_image():
-    mapper = INES_MASK_MAPPER_VERSION(
-        hdr.rom_control_byte_0, hdr.rom_control_byte_1)
-
-    add_extra_line(inf.min_ea, True, "\n;   ROM information\n"
-                                     ";   ---------------\n;")
-    add_extra_line(inf.min_ea, True, ";   Valid image header      : %s" % YES_NO(not hdr.is_corrupt_ines_hdr()))
-    add_extra_line(inf.min_ea, True, ";   16K PRG-ROM page count  : %d" % hdr.prg_page_count_16k)
-    add_extra_line(inf.min_ea, True, ";   8K CHR-ROM page count   : %d" % hdr.chr_page_count_8k)
-    add_extra_line(inf.min_ea, True, ";   Mirroring               : %s" % (
-        "horizontal" if INES_MASK_H_MIRRORING(hdr.rom_control_byte_0) else "vertical"))
-    add_extra_line(inf.min_ea, True,
-                   ";   SRAM enabled            : %s" % YES_NO(INES_MASK_SRAM(hdr.rom_control_byte_0)))
-    add_extra_line(inf.min_ea, True,
-                   ";   512-byte trainer        : %s" % YES_NO(INES_MASK_TRAINER(hdr.rom_control_byte_0)))
-    add_extra_line(inf.min_ea, True,
-                   ";   Four screen VRAM layout : %s" % YES_NO(INES_MASK_VRAM_LAYOUT(hdr.rom_control_byte_0)))
-    add_extra_line(inf.min_ea, True,
-                   ";   Mapper                  : %s (Mapper #%d)" % (get_mapper_name(mapper), mapper))
-
-
 # ----------------------------------------------------------------------
 #
 #      defines, names and comments an item
@@ -691,34 +345,674 @@ def name_vector(address, name):
 
 # ----------------------------------------------------------------------
 #
-#      add entrypoints to the database and name vectors
-#
-def add_entry_points(li):
-    ea = get_vector(NMI_VECTOR_START_ADDRESS)
-    add_entry(ea, ea, "NMI_routine", True)
-    name_vector(NMI_VECTOR_START_ADDRESS, "NMI_vector")
+#      a LoadSession loading into the IDA database. li is the loader
+#      input the image is read from; banks are loaded with
+#      li.file2base() so the database stays associated with the file
+#
+class IdaLoadSession(LoadSession):
 
-    ea = get_vector(RESET_VECTOR_START_ADDRESS)
-    add_entry(ea, ea, "RESET_routine", True)
-    name_vector(RESET_VECTOR_START_ADDRESS, "RESET_vector")
+    def __init__(self, li, name=None):
+        li.seek(0)
+        LoadSession.__init__(self, li.read(li.size()), name)
+        self.li = li
+
+    # ----------------------------------------------------------------------
+    #
+    #      loads the whole file into IDA
+    #      this is a wrapper function, which:
+    #
+    #      - checks the header for validity and fixes broken headers
+    #      - creates all necessary segments
+    #      - saves the whole file to blobs
+    #      - loads prg pages/banks
+    #      - adds informational descriptions to the database
+    #
+    def run(self):
+        # check if header is corrupt
+        # show a warning msg, but load the rom nonetheless
+        if(self.is_corrupt()):
+            # warning("The iNES header seems to be corrupt.\nLoader might give inaccurate results!")
+            code = ask_yn(ASKBTN_YES, "The iNES header seems to be corrupt.\n"
+                          "The NES loader could produce wrong results!\n"
+                          "Do you want to internally fix the header ?\n\n"
+                          "(this will not affect the input file)")
+            if(code == ASKBTN_YES):
+                self.fix_header()
+
+        # create NES segments
+        self.create_segments()
+
+        # save NES file to blobs
+        self.save_image_as_blobs()
+
+        # load relevant ROM banks into database
+        self.load_rom_banks()
+
+        # list the games of multicarts
+        self.find_multicart_games()
+
+        # make vectors public
+        self.add_entry_points()
+
+        # name registers accessed through mirrors
+        self.name_ioreg_accesses()
+
+        # follow RTS jump tables
+        self.add_dispatch_targets()
+
+        # resolve bank switches and cross-bank calls
+        self.add_bank_switches()
+
+        # mark code and data logged by an emulator
+        self.load_cdl_file()
+
+        # start analysis at likely code the vectors do not lead to
+        self.add_likely_code()
+
+        # keep packed data from being analyzed as code. runs after the
+        # passes above, so the code they found is left alone
+        self.mark_packed_data()
+
+        # cycles of the interrupt handlers, NMI against the vblank time
+        self.count_handler_cycles()
+
+        # fill inf structure
+        self.set_ida_export_data()
+
+        # add information about the ROM image
+        self.describe_rom_image()
+
+        # let IDA add some information about the loaded file
+        self.create_filename_cmt()
+
+        return 1
+
+    def create_filename_cmt(self):
+        inf = get_inf_structure()
+        add_extra_line(inf.min_ea, True, "File Name   : %s" % get_root_filename())
+        add_extra_line(inf.min_ea, True, "Format      : %s" % inf.filetype)
+
+    # ----------------------------------------------------------------------
+    #
+    #      creates all necessary segments and initializes them, if possible
+    #
+    def create_segments(self):
+        # create RAM segment
+        self.create_ram_segment()
+
+        # create segment for I/O registers
+        # NES uses memory mapped I/O
+        self.create_ioreg_segment()
+
+        # create SRAM segment if supported by cartridge
+        # if( INES_MASK_SRAM( self.hdr.rom_control_byte_0 ) )
+        self.create_sram_segment()
+
+        # create segment for expansion ROM
+        self.create_exprom_segment()
+
+        # load trainer, if one is present
+        if(INES_MASK_TRAINER(self.hdr.rom_control_byte_0)):
+            warning("This ROM image seems to have a trainer.\n"
+                    "By default, this loader assumes the trainer to be mapped to $7000.\n")
+            self.load_trainer()
+
+        # create segment for PRG ROMs
+        self.create_rom_segment()
+
+    # ----------------------------------------------------------------------
+    #
+    #      creates an SRAM segment, if available on cartridge
+    #
+    def create_sram_segment(self):
+        success = add_segm(0, SRAM_START_ADDRESS,
+                           SRAM_START_ADDRESS + SRAM_SIZE, "SRAM", None) == 1
+        msg("creating SRAM segment..%s" % ("ok!\n" if success else "failure!\n"))
+        if(not success):
+            return
+        set_segm_addressing(getseg(SRAM_START_ADDRESS), 0)
+
+    # ----------------------------------------------------------------------
+    #
+    #      creates a RAM segment
+    #
+    def create_ram_segment(self):
+        success = add_segm(0, RAM_START_ADDRESS,
+                           RAM_START_ADDRESS + RAM_SIZE, "RAM", None) == 1
+        msg("creating RAM segment..%s" % ("ok!\n" if success else "failure!\n"))
+        if(not success):
+            return
+        set_segm_addressing(getseg(RAM_START_ADDRESS), 0)
+
+        # how do I properly initialize a segment ?
+        # for( unsigned int ea = SRAM_START_ADDRESS; ea<= SRAM_START_ADDRESS + SRAM_SIZE; ea++ )
+        #    put_byte( ea, 0 )
+
+    # ----------------------------------------------------------------------
+    #
+    #      creates an I/O registers segment and names all io registers
+    #
+    def create_ioreg_segment(self):
+        success = add_segm(0, IOREGS_START_ADDRESS,
+                           IOREGS_START_ADDRESS + IOREGS_SIZE, "IO_REGS", None) == 1
+        msg("creating IO_REGS segment..%s" %
+            ("ok!\n" if success else "failure!\n"))
+        if(not success):
+            return
+        set_segm_addressing(getseg(IOREGS_START_ADDRESS), 0)
+
+        for address, size, shortdesc, comment in IOREGS:
+            define_item(address, size, shortdesc, comment)
+
+    # ----------------------------------------------------------------------
+    #
+    #      creates a ROM segment where all the code is being loaded to
+    #
+    def create_rom_segment(self):
+        success = add_segm(0, ROM_START_ADDRESS,
+                           ROM_START_ADDRESS + ROM_SIZE, "ROM", "CODE") == 1
+        msg("creating ROM segment..%s" % ("ok!\n" if success else "failure!\n"))
+        if(not success):
+            return
+        set_segm_addressing(getseg(ROM_START_ADDRESS), 0)
+
+    # ----------------------------------------------------------------------
+    #
+    #      creates an EXPANSION ROM segment, I don't know when it is used
+    #
+    def create_exprom_segment(self):
+        success = add_segm(0, EXPROM_START_ADDRESS,
+                           EXPROM_START_ADDRESS + EXPROM_SIZE, "EXP_ROM", None) == 1
+        msg("creating EXP_ROM segment..%s" %
+            ("ok!\n" if success else "failure!\n"))
+        if(not success):
+            return
+        set_segm_addressing(getseg(EXPROM_START_ADDRESS), 0)
+
+    # ----------------------------------------------------------------------
+    #
+    #      loads a 512 byte trainer (located at file offset INES_HDR_SIZE)
+    #      to TRAINER_START_ADDRESS
+    #
+    def load_trainer(self):
+        if(not INES_MASK_SRAM(self.hdr.rom_control_byte_0)):
+            success = add_segm(0, TRAINER_START_ADDRESS, TRAINER_START_ADDRESS +
+                               TRAINER_SIZE, "TRAINER", "CODE") == 1
+            msg("creating TRAINER segment..%s", "ok!\n" if success else "failure!\n")
+            set_segm_addressing(getseg(TRAINER_START_ADDRESS), 0)
+        self.li.file2base(INES_HDR_SIZE, TRAINER_START_ADDRESS,
+                          TRAINER_START_ADDRESS + TRAINER_SIZE, FILEREG_PATCHABLE)
+
+    # ----------------------------------------------------------------------
+    #
+    #      load 8k chr rom bank into database
+    #
+    def load_chr_rom_bank(self, load):
+        # todo: add support for PPU
+        # this function currently is disabled, since no
+        # segment for the PPU is created
+        msg("The loader was trying to load a CHR bank but the PPU is not supported yet.\n")
+        return
 
-    ea = get_vector(IRQ_VECTOR_START_ADDRESS)
-    add_entry(ea, ea, "IRQ_routine", True)
-    name_vector(IRQ_VECTOR_START_ADDRESS, "IRQ_vector")
+        if(self.hdr.chr_page_count_8k == 0):
+            return
+
+        # this is the file offset to begin reading pages from
+        offset = self.file_offset(load)
+
+        # load page from ROM file into segment
+        msg("mapping CHR-ROM page %02d to %08x-%08x (file offset %08x) .." %
+            (load.offset // CHR_ROM_BANK_SIZE + 1, load.address, load.address + load.size, offset))
+        if(file2base(self.li, offset, load.address, load.address + load.size, FILEREG_PATCHABLE) == 1):
+            msg("ok\n")
+        else:
+            msg("failure (corrupt ROM image?)\n")
+
+    # ----------------------------------------------------------------------
+    #
+    #      load 16k or 8k prg rom bank into database
+    #
+    def load_prg_rom_bank(self, load):
+        # this is the file offset to begin reading pages from
+        offset = self.file_offset(load)
+
+        # load page from ROM file into segment
+        msg("mapping %sPRG-ROM page %02d to %08x-%08x (file offset %08x) .." %
+            ("8k " if load.size == PRG_ROM_8K_BANK_SIZE else "",
+             load.offset // load.size + 1, load.address, load.address + load.size, offset))
+        if(self.li.file2base(offset, load.address, load.address + load.size, FILEREG_PATCHABLE) == 1):
+            msg("ok\n")
+            save_prg_bank_mapping(load.address, load.offset, load.size)
+        else:
+            msg("failure (corrupt ROM image?)\n")
+
+    # ----------------------------------------------------------------------
+    #
+    #      this function loads the image into the ida database
+    #      depending on the mapper in use (see LoadSession.bank_plan)
+    #
+    def load_rom_banks(self):
+        plan = self.bank_plan()
+        if(plan is None):  # 1st prg, last prg, 1st chr
+            warning("Mapper %d is not supported by this loader!\n"
+                    "This could be a corrupt ROM image!\n"
+                    "Loading first and last PRG-ROM banks by default." % self.mapper)
+            return
+
+        for load in plan:
+            if(load.chr):
+                self.load_chr_rom_bank(load)
+            else:
+                self.load_prg_rom_bank(load)
+
+    # ----------------------------------------------------------------------
+    #
+    #      saves the sub-game directory of a multicart. a single game
+    #      can be mapped later with nesldr.multicart.load_subgame()
+    #
+    def find_multicart_games(self):
+        if(self.mapper not in MULTICART_MAPPERS):
+            return
+
+        games = find_subgames(self.prg(), workers=1)
+        save_directory(games)
+        msg("multicart: %d sub-game(s) found\n" % len(games))
+        for game in games:
+            msg("  %3d: PRG-ROM offset %06X, %4dk, RESET %04X\n" %
+                (game.index, game.prg_offset, game.size // 1024, game.vectors.reset))
+
+    # ----------------------------------------------------------------------
+    #
+    #      computes the entropy map of the PRG-ROM, saves it to a netnode
+    #      and marks high entropy (packed) regions of the mapped banks as
+    #      data before the analysis starts. regions holding code that
+    #      earlier passes created or queued are skipped
+    #
+    def mark_packed_data(self):
+        prg = self.prg()
+        emap = entropy_map(prg)
+
+        node = ida_netnode.netnode(PRG_ENTROPY_NODE, 0, True)
+        node.altset(0, ENTROPY_WINDOW)
+        node.altset(1, ENTROPY_STEP)
+        node.setblob(bytes(emap), 0, 'E')
+        node.setblob(page_histograms(prg).tobytes(), 0, 'H')
+
+        # never cover the vectors, the code they point to or the code
+        # of entry points, jump tables, bank switches, the CDL file and
+        # likely code starts
+        entries = [get_vector(v) for v in (NMI_VECTOR_START_ADDRESS,
+                                          RESET_VECTOR_START_ADDRESS,
+                                          IRQ_VECTOR_START_ADDRESS)]
+
+        def has_code(ea, size):
+            end = ea + size
+            return any(ea <= e < end for e in entries) or \
+                any(peek_auto_queue(ea, queue) < end for queue in (AU_CODE, AU_PROC)) or \
+                next_that(ea - 1, end, is_code) < end
+
+        count = 0
+        bank_map = prg_bank_map()
+        for start, end in high_entropy_ranges(emap):
+            for address, prg_offset in bank_map.items():
+                lo = max(start, prg_offset)
+                hi = min(end, prg_offset + PRG_BANK_MAP_SLOT_SIZE)
+                if(lo >= hi):
+                    continue
+                ea = address + lo - prg_offset
+                size = min(address + hi - prg_offset, NMI_VECTOR_START_ADDRESS) - ea
+                if(size <= 0 or has_code(ea, size)):
+                    continue
+                del_items(ea, DELIT_SIMPLE, size)
+                create_byte(ea, size)
+                set_cmt(ea, "packed data? (entropy %.2f bits/byte)" %
+                        entropy_at(emap, lo), False)
+                count += 1
+
+        msg("marked %d high entropy region(s) as data\n" % count)
+
+    # ----------------------------------------------------------------------
+    #
+    #      saves prg and chr ROM pages/banks to a binary large object (blob)
+    #
+    def save_image_as_blobs(self):
+        # store ines header in a blob
+        self.save_ines_hdr_as_blob()
+
+        self.save_trainer_as_blob()
+
+        # store rom image in blobs
+        self.save_prg_rom_pages_as_blobs(self.hdr.prg_page_count_16k)
+        self.save_chr_rom_pages_as_blobs(self.hdr.chr_page_count_8k)
+
+    # ----------------------------------------------------------------------
+    #
+    #      store header to netnode
+    #
+    def save_ines_hdr_as_blob(self):
+        hdr_node = ida_netnode.netnode()
+
+        if(not hdr_node.create(INES_HDR_NODE)):
+            return False
+        return hdr_node.setblob(self.header_bytes(), 0, 'I')
 
-    return True
+    # ----------------------------------------------------------------------
+    #
+    #      store trainer to netnode
+    #
+    def save_trainer_as_blob(self):
+        node = ida_netnode.netnode()
 
+        if(not self.has_trainer):
+            return False
 
-# ----------------------------------------------------------------------
-#
-#      set entrypoint, min_ea, maxEA, start_cs and filetype
-#
-def set_ida_export_data():
+        buffer = self.trainer()
+        if(not node.create(TRAINER_NODE)):
+            return False
+        if(not node.setblob(buffer, 0, 'I')):
+            msg("Could not store trainer to netnode!\n")
 
-    # set entrypoint
-    inf.start_ip = inf.begin_ea = get_vector(RESET_VECTOR_START_ADDRESS)
+        return True
+
+    # ----------------------------------------------------------------------
+    #
+    #      store PRG ROM pages to netnode
+    #
+    def save_prg_rom_pages_as_blobs(self, count):
+        node = ida_netnode.netnode()
+
+        for i in range(count):
+            buffer = self.prg_page(i)
+            prg_node_name = PRG_PAGE_NODE % i
+            if(not node.create(prg_node_name)):
+                return False
+            if(not node.setblob(buffer, 0, 'I')):
+                msg("Could not store PRG-ROM pages to netnode!\n")
 
-    # set min_ea, maxEA, etc.
-    inf.start_cs = 0
-    inf.min_ea = RAM_START_ADDRESS
-    inf.max_ea = ROM_START_ADDRESS + ROM_SIZE
+        return True
+
+    # ----------------------------------------------------------------------
+    #
+    #      store CHR ROM pages to netnode
+    #
+    def save_chr_rom_pages_as_blobs(self, count):
+        node = ida_netnode.netnode()
+
+        for i in range(count):
+            buffer = self.chr_page(i)
+            chr_node_name = CHR_PAGE_NODE % i
+            if(not node.create(chr_node_name)):
+                return False
+            if(not node.setblob(buffer, 0, 'I')):
+                msg("Could not store CHR-ROM pages to netnode!\n")
+
+        return True
+
+    # ----------------------------------------------------------------------
+    #
+    #      add information about the ROM image to disassembly
+    #
+    def describe_rom_image(self):
+        mapper = self.mapper
+        inf = get_inf_structure()
+
+        add_extra_line(inf.min_ea, True, "\n;   ROM information\n"
+                                         ";   ---------------\n;")
+        add_extra_line(inf.min_ea, True, ";   Valid image header      : %s" % YES_NO(not self.hdr.is_corrupt_ines_hdr()))
+        add_extra_line(inf.min_ea, True, ";   16K PRG-ROM page count  : %d" % self.hdr.prg_page_count_16k)
+        add_extra_line(inf.min_ea, True, ";   8K CHR-ROM page count   : %d" % self.hdr.chr_page_count_8k)
+        add_extra_line(inf.min_ea, True, ";   Mirroring               : %s" % (
+            "horizontal" if INES_MASK_H_MIRRORING(self.hdr.rom_control_byte_0) else "vertical"))
+        add_extra_line(inf.min_ea, True,
+                       ";   SRAM enabled            : %s" % YES_NO(INES_MASK_SRAM(self.hdr.rom_control_byte_0)))
+        add_extra_line(inf.min_ea, True,
+                       ";   512-byte trainer        : %s" % YES_NO(INES_MASK_TRAINER(self.hdr.rom_control_byte_0)))
+        add_extra_line(inf.min_ea, True,
+                       ";   Four screen VRAM layout : %s" % YES_NO(INES_MASK_VRAM_LAYOUT(self.hdr.rom_control_byte_0)))
+        add_extra_line(inf.min_ea, True,
+                       ";   Mapper                  : %s (Mapper #%d)" % (get_mapper_name(mapper), mapper))
+
+    # ----------------------------------------------------------------------
+    #
+    #      add entrypoints to the database and name vectors
+    #
+    def add_entry_points(self):
+        ea = get_vector(NMI_VECTOR_START_ADDRESS)
+        add_entry(ea, ea, "NMI_routine", True)
+        name_vector(NMI_VECTOR_START_ADDRESS, "NMI_vector")
+
+        ea = get_vector(RESET_VECTOR_START_ADDRESS)
+        add_entry(ea, ea, "RESET_routine", True)
+        name_vector(RESET_VECTOR_START_ADDRESS, "RESET_vector")
+
+        ea = get_vector(IRQ_VECTOR_START_ADDRESS)
+        add_entry(ea, ea, "IRQ_routine", True)
+        name_vector(IRQ_VECTOR_START_ADDRESS, "IRQ_vector")
+
+        # vectors of the banks which are not mapped at $FFFA
+        self.add_bank_entry_points()
+
+        return True
+
+    # ----------------------------------------------------------------------
+    #
+    #      checks the vectors at the end of every PRG-ROM window and adds
+    #      all distinct handlers whose code is present in the mapped banks
+    #      as entry points. the vectors of all banks are saved to a netnode
+    #
+    def add_bank_entry_points(self):
+        prg = self.prg()
+        window_size = prg_window_size(self.mapper)
+        vectors = [v for v in read_bank_vectors(prg, window_size)
+                   if is_valid_vectors(prg, v)]
+
+        table = array("H")
+        for v in vectors:
+            table.extend((v.window, v.nmi, v.reset, v.irq))
+        node = ida_netnode.netnode(PRG_VECTORS_NODE, 0, True)
+        node.altset(0, window_size)
+        node.setblob(table.tobytes(), 0, 'V')
+
+        known = set(get_vector(v) for v in (NMI_VECTOR_START_ADDRESS,
+                                            RESET_VECTOR_START_ADDRESS,
+                                            IRQ_VECTOR_START_ADDRESS))
+        count = 0
+        for v in vectors:
+            for name, address in v.handlers():
+                offset = v.offset_of(address)
+                if(address in known or offset is None):
+                    continue
+                # only if this bank's handler is what the database shows there
+                code = prg[offset:min(offset + 0x10, v.prg_offset + v.size)]
+                if(get_bytes(address, len(code)) != code):
+                    continue
+                add_entry(address, address, "%s_routine_%02d" % (name, v.window), True)
+                known.add(address)
+                count += 1
+
+        msg("%d PRG-ROM bank(s) with valid vectors, %d additional entry point(s)\n" %
+            (len(vectors), count))
+
+    # ----------------------------------------------------------------------
+    #
+    #      names and comments all I/O register operands of the mapped
+    #      banks, folding the PPU register mirrors
+    #
+    def name_ioreg_accesses(self):
+        count, mirrors = apply_ioreg_names(find_ioreg_accesses(self.prg(), self.code_scores()))
+        msg("%d I/O register access(es) annotated, %d through mirrors\n" % (count, mirrors))
+
+    # ----------------------------------------------------------------------
+    #
+    #      turns the targets of "PHA/PHA/RTS" jump tables into code
+    #
+    def add_dispatch_targets(self):
+        tables = find_dispatch_tables(self.prg(), self.mapper)
+        count = apply_dispatch_tables(tables)
+        msg("%d RTS jump table(s) found, %d target(s) in mapped banks\n" %
+            (len(tables), count))
+
+    # ----------------------------------------------------------------------
+    #
+    #      comments mapper register writes and trampoline calls with the
+    #      PRG-ROM bank they select and adds cross-bank references
+    #
+    def add_bank_switches(self):
+        switches, refs = propagate_banks(self.prg(), self.mapper)
+        count = apply_bank_switches(switches, refs)
+        msg("%d bank switch(es) resolved, %d cross-bank reference(s)\n" %
+            (len(switches), count))
+
+    # ----------------------------------------------------------------------
+    #
+    #      offers to apply a Code/Data Logger file found next to the input
+    #      file (game.cdl or game.nes.cdl)
+    #
+    def load_cdl_file(self):
+        path = find_cdl_file(get_input_file_path())
+        if(path is None):
+            return
+        if(ask_yn(ASKBTN_YES, "Code/Data Logger file found:\n%s\n\n"
+                  "Mark the logged code and data?" % path) != ASKBTN_YES):
+            return
+
+        try:
+            cdl = read_cdl(path, self.hdr.prg_page_count_16k * PRG_PAGE_SIZE,
+                           self.hdr.chr_page_count_8k * CHR_PAGE_SIZE)
+        except (OSError, CdlError) as e:
+            msg("could not read %s: %s\n" % (path, e))
+            return
+        code, data = apply_cdl(cdl)
+        msg("%s CDL: %d code run(s), %d data run(s) in mapped banks\n" %
+            (cdl.format_name, code, data))
+
+    # ----------------------------------------------------------------------
+    #
+    #      scores every PRG-ROM offset as code or data and queues likely
+    #      code following returns for analysis
+    #
+    def add_likely_code(self):
+        count = apply_code_scores(self.prg(), self.code_scores())
+        msg("%d likely code start(s) queued for analysis\n" % count)
+
+    # ----------------------------------------------------------------------
+    #
+    #      comments the best/worst case cycles of the handlers and their
+    #      basic blocks (see nesldr/cycles.py)
+    #
+    def count_handler_cycles(self):
+        lines, _ = apply_cycle_counts(CycleAnalysis(CpuMemory.from_database()), self.is_pal)
+        for line in lines:
+            msg("%s\n" % line)
+
+    # ----------------------------------------------------------------------
+    #
+    #      set entrypoint, min_ea, maxEA, start_cs and filetype
+    #
+    def set_ida_export_data(self, start=None):
+        inf = get_inf_structure()
+
+        # set entrypoint
+        inf.start_ip = inf.begin_ea = get_vector(RESET_VECTOR_START_ADDRESS) if start is None else start
+
+        # set min_ea, maxEA, etc.
+        inf.start_cs = 0
+        inf.min_ea = RAM_START_ADDRESS
+        inf.max_ea = ROM_START_ADDRESS + ROM_SIZE
+
+
+# ----------------------------------------------------------------------
+#
+#      loads a Famicom Disk System image. the segments are the same as
+#      for cartridges; the files the BIOS loads at boot from the first
+#      side are mapped at their load addresses, all sides are saved to
+#      blobs. only the segment stages of IdaLoadSession are used
+#
+class IdaFdsLoadSession(IdaLoadSession):
+
+    def __init__(self, li, name=None):
+        li.seek(0)
+        self.disk = FdsImage(li.read(li.size()), name)
+        # the inherited state is that of an empty mapper 20 image
+        LoadSession.__init__(self, self.disk.ines_header(), name)
+        self.li = li
+
+    def run(self):
+        # RAM, IO_REGS, EXP_ROM (FDS registers), SRAM and ROM
+        self.create_ram_segment()
+        self.create_ioreg_segment()
+        self.create_exprom_segment()
+        self.create_sram_segment()
+        self.create_rom_segment()
+
+        # save every disk side as a blob
+        self.save_disk_sides_as_blobs()
+
+        # map the boot files of side A
+        self.load_boot_files()
+
+        # add the handlers of the BIOS vectors as entry points
+        start = self.add_fds_entry_points()
+
+        # fill inf structure
+        self.set_ida_export_data(start)
+
+        # add information about the disk image
+        self.describe_disk_image()
+
+        # let IDA add some information about the loaded file
+        self.create_filename_cmt()
+
+        return 1
+
+    # ----------------------------------------------------------------------
+    #
+    #      saves the sides one by one, straight from the input data
+    #
+    def save_disk_sides_as_blobs(self):
+        node = ida_netnode.netnode(FDS_SIDES_NODE, 0, True)
+        node.altset(0, len(self.disk.sides))
+        for i in range(len(self.disk.sides)):
+            side_node = ida_netnode.netnode(FDS_SIDE_NODE % i, 0, True)
+            if(not side_node.setblob(bytes(self.disk.side_data(i)), 0, 'I')):
+                msg("Could not store FDS disk side %d to netnode!\n" % i)
+
+    # ----------------------------------------------------------------------
+    #
+    #      maps the PRG files loaded at boot and comments them
+    #
+    def load_boot_files(self):
+        side = self.disk.sides[0]
+        for f in side.boot_files():
+            msg("%s file $%02X %-8s %s $%04X, %d bytes\n" %
+                (side.label, f.file_id, f.name, f.kind_name, f.address, f.size))
+        for address, offset, size in self.disk.boot_loads(0):
+            self.li.file2base(offset, address, address + size, FILEREG_PATCHABLE)
+        for f in side.boot_files():
+            if(f.address >= SRAM_START_ADDRESS and f.kind == FDS_FILE_PRG):
+                add_extra_line(f.address, True, "; file $%02X %s (%s), %d bytes" %
+                               (f.file_id, f.name, side.label, f.size))
+
+    # ----------------------------------------------------------------------
+    #
+    #      adds the handlers of the vectors at $DFF6-$DFFF. returns the
+    #      reset handler, None if no boot file sets it
+    #
+    def add_fds_entry_points(self):
+        start = None
+        for name, vector, address in self.disk.boot_vectors(0):
+            name_vector(vector, "%s_vector" % name)
+            if(address >= SRAM_START_ADDRESS):
+                add_entry(address, address, "%s_routine" % name, True)
+            if(name == "RESET"):
+                start = address
+        return start
+
+    def describe_disk_image(self):
+        inf = get_inf_structure()
+
+        add_extra_line(inf.min_ea, True, "\n;   Disk information\n"
+                                         ";   ----------------\n;")
+        for side in self.disk.sides:
+            add_extra_line(inf.min_ea, True, ";   %-22s: %s, %d file(s), boot files up to $%02X" %
+                           (side.label, side.game_name, len(side.files), side.boot_file_id))
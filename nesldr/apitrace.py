@@ -0,0 +1,285 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Opt-in tracing of the IDA API calls made while loading a
+    ROM. Every IDA function imported by the loader (and the
+    methods of ida_netnode.netnode) is wrapped; calls and time
+    are counted per function, call site and loader phase.
+
+    The totals are compared with a budget file (api_budget.json)
+    holding the expected number of calls per ROM class. A load
+    making more calls than allowed by the budget's tolerance
+    fails with BudgetExceeded.
+
+    environment:
+        NESLDR_API_TRACE=1        trace, report and check the budget
+        NESLDR_API_TRACE=record   trace and record the counts as budget
+        NESLDR_API_BUDGET=<path>  budget file (default: nesldr/api_budget.json)
+
+"""
+
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+from time import perf_counter
+
+
+API_TRACE_ENV = "NESLDR_API_TRACE"
+API_BUDGET_ENV = "NESLDR_API_BUDGET"
+API_TRACE_RECORD = "record"
+
+DEFAULT_BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "api_budget.json")
+DEFAULT_BUDGET_TOLERANCE = 1.5
+
+# methods of ida_netnode.netnode that are traced
+NETNODE_METHODS = ("create", "setblob", "getblob", "delblob", "altset", "altval",
+                   "supset", "supval", "supstr", "hashset", "hashval", "kill")
+
+# number of call sites listed in a report
+REPORT_SITES = 20
+
+
+# marks attributes an instance did not have before patching
+_UNSET = object()
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def is_ida_function(value):
+    module = getattr(value, "__module__", None) or ""
+    return callable(value) and not isinstance(value, type) and module.startswith("ida_")
+
+
+# ----------------------------------------------------------------------
+#
+#      the class a ROM is budgeted under
+#
+def rom_class(mapper, prg_pages, chr_pages):
+    return "mapper %d, %dk PRG, %dk CHR" % (mapper, prg_pages * 16, chr_pages * 8)
+
+
+class ApiTracer(object):
+
+    def __init__(self):
+        # (phase, function, call site) -> calls / seconds
+        self.calls = Counter()
+        self.times = defaultdict(float)
+        self.phase = None
+        self._wrappers = {}
+        self._saved = []
+
+    def _wrap(self, name, fn):
+        wrapper = self._wrappers.get(id(fn))
+        if(wrapper is not None):
+            return wrapper
+        tracer = self
+
+        def traced(*args, **kwargs):
+            frame = sys._getframe(1)
+            key = (tracer.phase, name, "%s:%d" % (frame.f_code.co_name, frame.f_lineno))
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                tracer.calls[key] += 1
+                tracer.times[key] += perf_counter() - start
+
+        traced.__wrapped__ = fn
+        self._wrappers[id(fn)] = traced
+        return traced
+
+    def _wrap_phase(self, name, fn):
+        tracer = self
+
+        def phase(*args, **kwargs):
+            outer = tracer.phase
+            if(outer is None):
+                tracer.phase = name
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                tracer.phase = outer
+
+        phase.__wrapped__ = fn
+        return phase
+
+    def _patch(self, owner, name, value):
+        if(isinstance(owner, dict)):
+            self._saved.append((owner, name, owner[name]))
+            owner[name] = value
+        elif(isinstance(owner, type) or name in vars(owner)):
+            self._saved.append((owner, name, getattr(owner, name)))
+            setattr(owner, name, value)
+        else:
+            # a method shadowed on an instance, removed again by uninstall()
+            self._saved.append((owner, name, _UNSET))
+            setattr(owner, name, value)
+
+    # ----------------------------------------------------------------------
+    #
+    #      wraps all IDA functions of a module namespace (globals()),
+    #      also in the ida_* modules they come from, so calls of
+    #      helpers using "ida_bytes.set_cmt(...)" are counted too.
+    #      the functions named in phases become loader phases; they are
+    #      looked up in the namespace, or as methods of phase_owner
+    #
+    def install(self, namespace, phases=(), phase_owner=None):
+        for name, value in list(namespace.items()):
+            if(not is_ida_function(value)):
+                continue
+            wrapper = self._wrap(name, value)
+            self._patch(namespace, name, wrapper)
+            module = sys.modules.get(value.__module__)
+            if(module is not None and getattr(module, name, None) is value):
+                self._patch(module, name, wrapper)
+
+        netnode = sys.modules.get("ida_netnode")
+        if(netnode is not None):
+            for name in NETNODE_METHODS:
+                method = getattr(netnode.netnode, name, None)
+                if(method is not None):
+                    self._patch(netnode.netnode, name,
+                                self._wrap("netnode.%s" % name, method))
+
+        for name in phases:
+            if(phase_owner is not None):
+                method = getattr(phase_owner, name, None)
+                if(method is not None):
+                    self._patch(phase_owner, name, self._wrap_phase(name, method))
+            elif(name in namespace):
+                self._patch(namespace, name, self._wrap_phase(name, namespace[name]))
+
+    # restores everything patched by install()
+    def uninstall(self):
+        while(self._saved):
+            owner, name, value = self._saved.pop()
+            if(isinstance(owner, dict)):
+                owner[name] = value
+            elif(value is _UNSET):
+                delattr(owner, name)
+            else:
+                setattr(owner, name, value)
+
+    # ----------------------------------------------------------------------
+    #
+    #      totals as {"total": n, "phases": {...}, "functions": {...}}
+    #
+    def totals(self):
+        phases = Counter()
+        functions = Counter()
+        for (phase, name, _), count in self.calls.items():
+            phases[phase or "-"] += count
+            functions[name] += count
+        return {"total": sum(functions.values()),
+                "phases": dict(phases), "functions": dict(functions)}
+
+    def report(self, write):
+        totals = self.totals()
+        phase_times = defaultdict(float)
+        for (phase, _, _), seconds in self.times.items():
+            phase_times[phase or "-"] += seconds
+
+        write("IDA API calls: %d in %.3fs\n" % (totals["total"], sum(self.times.values())))
+        for phase, count in sorted(totals["phases"].items(), key=lambda x: -x[1]):
+            write("  %-24s %8d calls %8.3fs\n" % (phase, count, phase_times[phase]))
+
+        sites = sorted(self.calls, key=lambda k: -self.times[k])[:REPORT_SITES]
+        for key in sites:
+            phase, name, site = key
+            write("  %-24s %-20s %-28s %8d %8.3fs\n" %
+                  (phase or "-", name, site, self.calls[key], self.times[key]))
+
+
+# ----------------------------------------------------------------------
+#
+#      budget file: {"tolerance": 1.5, "classes": {rom class: totals}}
+#
+def load_budget(path=None):
+    path = path or os.environ.get(API_BUDGET_ENV) or DEFAULT_BUDGET_PATH
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"tolerance": DEFAULT_BUDGET_TOLERANCE, "classes": {}}
+
+
+def save_budget(budget, path=None):
+    path = path or os.environ.get(API_BUDGET_ENV) or DEFAULT_BUDGET_PATH
+    with open(path, "w") as f:
+        json.dump(budget, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+# ----------------------------------------------------------------------
+#
+#      compares totals with the budget of a ROM class. returns a list
+#      of violations (empty if within budget or no budget exists)
+#
+def check_budget(totals, budget, klass):
+    expected = budget.get("classes", {}).get(klass)
+    if(expected is None):
+        return []
+    tolerance = budget.get("tolerance", DEFAULT_BUDGET_TOLERANCE)
+
+    violations = []
+
+    def check(what, observed, allowed):
+        if(observed > allowed * tolerance):
+            violations.append("%s: %d calls, budget %d (x%.2f)" %
+                              (what, observed, allowed, tolerance))
+
+    check("total", totals["total"], expected.get("total", 0))
+    for kind in ("phases", "functions"):
+        observed = totals.get(kind, {})
+        for name, allowed in expected.get(kind, {}).items():
+            check("%s %s" % (kind[:-1], name), observed.get(name, 0), allowed)
+        # calls to functions the budget does not know of at all
+        for name, count in observed.items():
+            if(name not in expected.get(kind, {})):
+                check("%s %s" % (kind[:-1], name), count, 0)
+    return violations
+
+
+# ----------------------------------------------------------------------
+#
+#      starts tracing if enabled in the environment, else returns None
+#
+def start_api_trace(namespace, phases=(), phase_owner=None):
+    if(not os.environ.get(API_TRACE_ENV)):
+        return None
+    tracer = ApiTracer()
+    tracer.install(namespace, phases, phase_owner)
+    return tracer
+
+
+# ----------------------------------------------------------------------
+#
+#      stops tracing, reports and records or checks the budget.
+#      raises BudgetExceeded if the budget is exceeded
+#
+def finish_api_trace(tracer, klass, write):
+    tracer.uninstall()
+    tracer.report(write)
+
+    totals = tracer.totals()
+    budget = load_budget()
+    if(os.environ.get(API_TRACE_ENV) == API_TRACE_RECORD):
+        budget.setdefault("tolerance", DEFAULT_BUDGET_TOLERANCE)
+        budget.setdefault("classes", {})[klass] = totals
+        save_budget(budget)
+        write("IDA API budget recorded for %s\n" % klass)
+        return
+
+    if(klass not in budget.get("classes", {})):
+        write("no IDA API budget for %s\n" % klass)
+        return
+    violations = check_budget(totals, budget, klass)
+    if(violations):
+        raise BudgetExceeded("IDA API budget exceeded for %s:\n  %s" %
+                             (klass, "\n  ".join(violations)))
@@ -0,0 +1,281 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Reading ROM images straight from .zip and .7z archives,
+    without extracting them to disk first.
+
+    Zip members are read through ArchiveMember, a seekable
+    file object that decompresses the member as a stream and
+    keeps a small cache of decompressed blocks, so the
+    loader's seek()/read() pattern does not restart the
+    decompression. 7z archives are solid and can not be read
+    randomly; their members are decompressed into memory.
+    7z support needs the py7zr package.
+
+    A member of an archive is addressed as "archive.zip!member.nes".
+
+"""
+
+import io
+import os
+import zipfile
+import zlib
+from collections import OrderedDict
+
+
+ZIP_MAGIC = b"PK\x03\x04"
+SEVENZIP_MAGIC = b"7z\xBC\xAF\x27\x1C"
+
+ARCHIVE_MEMBER_SEPARATOR = "!"
+
+ROM_EXTENSIONS = (".nes",)
+
+# decompressed blocks kept per member
+ARCHIVE_BLOCK_SIZE = 0x10000
+ARCHIVE_CACHED_BLOCKS = 8
+
+# errors raised for damaged archives and missing members
+ARCHIVE_ERRORS = (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile, zlib.error)
+
+
+# ----------------------------------------------------------------------
+#
+#      ARCHIVE_ERRORS plus the errors of py7zr, if it is installed
+#
+def archive_errors():
+    try:
+        from py7zr.exceptions import ArchiveError
+    except ImportError:
+        return ARCHIVE_ERRORS
+    return ARCHIVE_ERRORS + (ArchiveError,)
+
+
+def is_archive_magic(magic):
+    return magic.startswith(ZIP_MAGIC) or magic.startswith(SEVENZIP_MAGIC)
+
+
+def is_rom_name(name):
+    return name.lower().endswith(ROM_EXTENSIONS)
+
+
+# ----------------------------------------------------------------------
+#
+#      splits "archive.zip!member.nes" into (archive, member). member
+#      is None for plain paths
+#
+def split_archive_path(path):
+    archive, sep, member = path.partition(ARCHIVE_MEMBER_SEPARATOR)
+    if(sep and os.path.isfile(archive)):
+        return archive, member
+    return path, None
+
+
+def is_archive_file(path):
+    try:
+        with open(path, "rb") as f:
+            return is_archive_magic(f.read(len(SEVENZIP_MAGIC)))
+    except OSError:
+        return False
+
+
+# ----------------------------------------------------------------------
+#
+#      file object on top of anything offering read(), seek() and
+#      size(), e.g. IDA's loader input (li), so zipfile can use it
+#
+class FileObjectAdapter(io.RawIOBase):
+
+    def __init__(self, source):
+        self.source = source
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self.source.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if(whence == io.SEEK_CUR):
+            offset += self.source.tell()
+        elif(whence == io.SEEK_END):
+            offset += self.source.size()
+        self.source.seek(offset)
+        return self.source.tell()
+
+    def tell(self):
+        return self.source.tell()
+
+
+# ----------------------------------------------------------------------
+#
+#      seekable, read-only view of a zip member with a decompressed
+#      block cache. offers both the file object interface and the
+#      size() method of IDA's loader input
+#
+class ArchiveMember(object):
+
+    def __init__(self, archive, info):
+        self.archive = archive
+        self.info = info
+        self.name = info.filename
+        self._size = info.file_size
+        self._stream = None
+        self._blocks = OrderedDict()
+        self._pos = 0
+
+    def size(self):
+        return self._size
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if(whence == io.SEEK_CUR):
+            offset += self._pos
+        elif(whence == io.SEEK_END):
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def _block(self, index):
+        block = self._blocks.get(index)
+        if(block is not None):
+            self._blocks.move_to_end(index)
+            return block
+
+        start = index * ARCHIVE_BLOCK_SIZE
+        # the member stream only rewinds by restarting decompression,
+        # so only reopen it when going backwards
+        if(self._stream is None or self._stream.tell() > start):
+            if(self._stream is not None):
+                self._stream.close()
+            self._stream = self.archive.open(self.info)
+        self._stream.seek(start)
+        block = self._stream.read(ARCHIVE_BLOCK_SIZE)
+
+        self._blocks[index] = block
+        if(len(self._blocks) > ARCHIVE_CACHED_BLOCKS):
+            self._blocks.popitem(last=False)
+        return block
+
+    def read(self, size=-1):
+        if(size is None or size < 0):
+            size = self._size - self._pos
+        size = max(0, min(size, self._size - self._pos))
+        parts = []
+        while(size > 0):
+            index, offset = divmod(self._pos, ARCHIVE_BLOCK_SIZE)
+            chunk = self._block(index)[offset:offset + size]
+            if(not chunk):
+                break
+            parts.append(chunk)
+            self._pos += len(chunk)
+            size -= len(chunk)
+        return b"".join(parts)
+
+    def close(self):
+        if(self._stream is not None):
+            self._stream.close()
+            self._stream = None
+        self._blocks.clear()
+
+
+# ----------------------------------------------------------------------
+#
+#      a 7z member, decompressed into memory
+#
+class MemoryMember(io.BytesIO):
+
+    def __init__(self, name, data):
+        io.BytesIO.__init__(self, data)
+        self.name = name
+
+    def size(self):
+        return len(self.getbuffer())
+
+
+# ----------------------------------------------------------------------
+#
+#      an opened archive. fileobj may be a path or a file object
+#
+class RomArchive(object):
+
+    def __init__(self, fileobj):
+        opened = isinstance(fileobj, str)
+        if(opened):
+            fileobj = open(fileobj, "rb")
+        self.fileobj = fileobj
+        try:
+            self._open(fileobj)
+        except:
+            if(opened):
+                fileobj.close()
+            raise
+
+    def _open(self, fileobj):
+        fileobj.seek(0)
+        magic = fileobj.read(len(SEVENZIP_MAGIC))
+        fileobj.seek(0)
+
+        if(magic.startswith(ZIP_MAGIC)):
+            self.kind = "zip"
+            self.zip = zipfile.ZipFile(fileobj)
+        elif(magic.startswith(SEVENZIP_MAGIC)):
+            try:
+                import py7zr
+            except ImportError:
+                raise ValueError("7z archives need the py7zr package")
+            self.kind = "7z"
+            self.sevenzip = py7zr.SevenZipFile(fileobj)
+        else:
+            raise ValueError("not a zip or 7z archive")
+
+    def names(self):
+        if(self.kind == "zip"):
+            return [i.filename for i in self.zip.infolist() if not i.is_dir()]
+        return [n for n in self.sevenzip.getnames()]
+
+    def rom_names(self):
+        return [n for n in self.names() if is_rom_name(n)]
+
+    # ----------------------------------------------------------------------
+    #
+    #      opens a member, by default the first ROM image
+    #
+    def open(self, name=None):
+        if(name is None):
+            names = self.rom_names()
+            if(not names):
+                raise ValueError("archive does not contain a ROM image")
+            name = names[0]
+
+        if(self.kind == "zip"):
+            return ArchiveMember(self.zip, self.zip.getinfo(name))
+
+        self.sevenzip.reset()
+        data = self.sevenzip.read([name])[name].read()
+        return MemoryMember(name, data)
+
+    # all ROM members, decompressed in one pass for 7z archives
+    def iter_roms(self):
+        if(self.kind == "zip"):
+            for name in self.rom_names():
+                yield name, self.open(name)
+        else:
+            self.sevenzip.reset()
+            for name, data in sorted(self.sevenzip.read(self.rom_names()).items()):
+                yield name, MemoryMember(name, data.read())
+
+    def close(self):
+        if(self.kind == "zip"):
+            self.zip.close()
+        else:
+            self.sevenzip.close()
+        self.fileobj.close()
@@ -0,0 +1,579 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Bank number constant propagation. The PRG-ROM is swept
+    linearly, page by page, tracking known values of A, X, Y,
+    the carry flag and zero page variables inside each basic
+    block. Where a mapper register is written with a known
+    value, the selected PRG-ROM bank is computed:
+
+        latch mappers   any write to $8000-$FFFF (UNROM, AOROM, ...)
+        MMC1            five serial writes of bit 0
+        MMC3            bank select ($8000) / bank data ($8001)
+
+    Routines which write a register value they were passed in
+    A, X or Y ("trampolines") are recognized, so calls to them
+    with a known value are resolved as well. A JSR/JMP into the
+    switched window following a resolved switch in the same
+    block becomes a cross-bank reference.
+
+    usage:
+        python -m nesldr.bankprop <rom.nes>
+
+"""
+
+import argparse
+import bisect
+import re
+import sys
+
+from nesldr.structs import *
+from nesldr.mappers import *
+from nesldr.opcodes import *
+from nesldr.banks import prg_window_size, prg_offset_to_address, address_to_prg_offset
+
+
+# mapper -> (window size, window address, bank shift, bank mask, lowest
+# register address) for mappers latching the bank number on any write
+LATCH_MAPPERS = {
+    MAPPER_UNROM: (PRG_PAGE_SIZE, PRG_ROM_BANK_LOW_ADDRESS, 0, 0x0F, ROM_START_ADDRESS),
+    MAPPER_CAMERICA: (PRG_PAGE_SIZE, PRG_ROM_BANK_LOW_ADDRESS, 0, 0x0F, PRG_ROM_BANK_C000),
+    MAPPER_IREM_74HC161_32: (PRG_PAGE_SIZE, PRG_ROM_BANK_LOW_ADDRESS, 0, 0x07, ROM_START_ADDRESS),
+    MAPPER_AOROM: (ROM_SIZE, ROM_START_ADDRESS, 0, 0x07, ROM_START_ADDRESS),
+    MAPPER_COLOR_DREAMS: (ROM_SIZE, ROM_START_ADDRESS, 0, 0x03, ROM_START_ADDRESS),
+    MAPPER_GNROM: (ROM_SIZE, ROM_START_ADDRESS, 4, 0x03, ROM_START_ADDRESS),
+    MAPPER_NINA_1: (ROM_SIZE, ROM_START_ADDRESS, 0, 0xFF, ROM_START_ADDRESS),
+}
+
+MMC1_PRG_REGISTER = PRG_ROM_BANK_E000
+MMC3_PRG_REGISTERS = {6: PRG_ROM_BANK_8000, 7: PRG_ROM_BANK_A000}
+
+# a trampoline has to write the mapper register within this many
+# instructions of its entry
+MAX_TRAMPOLINE_INSTRUCTIONS = 32
+
+REGISTERS = ("A", "X", "Y")
+
+
+# a value passed to a routine in a register
+class Argument(object):
+
+    def __init__(self, register):
+        self.register = register
+
+    def __repr__(self):
+        return "Argument(%s)" % self.register
+
+
+class BankSwitch(object):
+
+    def __init__(self, offset, address, register, value, bank, window_address,
+                 window_size, via=None):
+        self.offset = offset                    # PRG-ROM offset of the STx / JSR
+        self.address = address
+        self.register = register                # mapper register address
+        self.value = value
+        self.bank = bank                        # selected bank (window_size units)
+        self.window_address = window_address
+        self.window_size = window_size
+        self.via = via                          # trampoline address for calls
+
+    def target_offset(self, address):
+        if(not self.window_address <= address < self.window_address + self.window_size):
+            return None
+        return self.bank * self.window_size + address - self.window_address
+
+    def __repr__(self):
+        return "BankSwitch(%04X, bank %d at %04X)" % (self.address, self.bank,
+                                                     self.window_address)
+
+
+class CrossBankRef(object):
+
+    def __init__(self, offset, address, bank, target, target_offset, call):
+        self.offset = offset
+        self.address = address
+        self.bank = bank
+        self.target = target
+        self.target_offset = target_offset
+        self.call = call
+
+    def __repr__(self):
+        return "CrossBankRef(%04X -> bank %d:%04X)" % (self.address, self.bank, self.target)
+
+
+# ----------------------------------------------------------------------
+#
+#      mapper register state of the current block
+#
+class MapperState(object):
+
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self.mmc1_shift = 0
+        self.mmc1_count = 0
+        self.mmc3_select = None
+
+    # ----------------------------------------------------------------------
+    #
+    #      how a value written to a register selects a PRG-ROM bank:
+    #      (shift, mask, window address, window size), None if the
+    #      register does not switch PRG-ROM
+    #
+    def decoder(self, register):
+        mapper = self.mapper
+        if(mapper in LATCH_MAPPERS):
+            window_size, window_address, shift, mask, lowest = LATCH_MAPPERS[mapper]
+            if(register < lowest):
+                return None
+            return shift, mask, window_address, window_size
+        if(mapper == MAPPER_MMC1 and register >= MMC1_PRG_REGISTER):
+            return 0, 0x0F, PRG_ROM_BANK_LOW_ADDRESS, PRG_PAGE_SIZE
+        if(mapper == MAPPER_MMC3 and register < PRG_ROM_BANK_A000 and register & 1 and
+           self.mmc3_select in MMC3_PRG_REGISTERS):
+            return 0, 0x3F, MMC3_PRG_REGISTERS[self.mmc3_select], PRG_ROM_8K_BANK_SIZE
+        return None
+
+    # ----------------------------------------------------------------------
+    #
+    #      a write of value (int, Argument or None) to a mapper register.
+    #      returns (bank, window address, window size) for a resolved
+    #      switch, (Argument, decoder) if the bank comes from a routine
+    #      argument, None otherwise
+    #
+    def write(self, register, value):
+        if(self.mapper == MAPPER_MMC3 and register < PRG_ROM_BANK_A000 and
+           register & 1 == 0):
+            self.mmc3_select = value & 7 if isinstance(value, int) else None
+            return None
+
+        decoder = self.decoder(register)
+
+        if(self.mapper == MAPPER_MMC1):
+            if(isinstance(value, Argument)):
+                # passed in and shifted in by the routine itself
+                self.mmc1_shift = self.mmc1_count = 0
+                return (value, decoder) if decoder is not None else None
+            if(value is None or value & 0x80):
+                self.mmc1_shift = self.mmc1_count = 0
+                return None
+            self.mmc1_shift |= (value & 1) << self.mmc1_count
+            self.mmc1_count += 1
+            if(self.mmc1_count < 5):
+                return None
+            value = self.mmc1_shift
+            self.mmc1_shift = self.mmc1_count = 0
+
+        if(decoder is None or value is None):
+            return None
+        if(isinstance(value, Argument)):
+            return value, decoder
+        return decode_bank(decoder, value)
+
+
+def decode_bank(decoder, value):
+    shift, mask, window_address, window_size = decoder
+    return (value >> shift) & mask, window_address, window_size
+
+
+def is_mapper_register(mapper, address):
+    if(address < ROM_START_ADDRESS):
+        return False
+    if(mapper in LATCH_MAPPERS):
+        return address >= LATCH_MAPPERS[mapper][4]
+    return mapper in (MAPPER_MMC1, MAPPER_MMC3)
+
+
+# ----------------------------------------------------------------------
+#
+#      register and zero page values of a basic block. values are ints,
+#      Arguments or None (unknown)
+#
+class RegisterState(object):
+
+    def __init__(self, mapper, arguments=False):
+        if(arguments):
+            self.regs = dict((r, Argument(r)) for r in REGISTERS)
+        else:
+            self.regs = dict((r, None) for r in REGISTERS)
+        self.carry = None
+        self.zp = {}
+        self.mapper = MapperState(mapper)
+
+    # ----------------------------------------------------------------------
+    #
+    #      applies an instruction. returns (register address, value)
+    #      for stores to the ROM area
+    #
+    def step(self, op, operand):
+        m = op.mnemonic
+        regs = self.regs
+        mode = op.mode
+
+        def known(v):
+            return isinstance(v, int)
+
+        if(m in LOAD_MNEMONICS):
+            reg = m[2]
+            if(mode == MODE_IMM):
+                regs[reg] = operand
+            elif(mode == MODE_ZP):
+                regs[reg] = self.zp.get(operand)
+            else:
+                regs[reg] = None
+        elif(m in STORE_MNEMONICS):
+            value = regs[m[2]]
+            if(mode == MODE_ZP):
+                self.zp[operand] = value
+            elif(mode in (MODE_ABS, MODE_ABX, MODE_ABY) and operand >= ROM_START_ADDRESS):
+                return operand, value
+            elif(mode in (MODE_ZPX, MODE_ZPY, MODE_IZX, MODE_IZY)):
+                self.zp.clear()
+        elif(m in ("TAX", "TAY", "TXA", "TYA")):
+            regs[m[2]] = regs[m[1]]
+        elif(m in ("INX", "INY", "DEX", "DEY")):
+            reg = m[2]
+            if(known(regs[reg])):
+                regs[reg] = (regs[reg] + (1 if m[0] == "I" else -1)) & 0xFF
+            else:
+                regs[reg] = None
+        elif(m in ("AND", "ORA", "EOR") and mode == MODE_IMM):
+            if(known(regs["A"])):
+                a = regs["A"]
+                regs["A"] = a & operand if m == "AND" else (a | operand if m == "ORA" else a ^ operand)
+            else:
+                regs["A"] = None
+        elif(m in ("ASL", "LSR") and mode == MODE_ACC):
+            a = regs["A"]
+            if(known(a)):
+                self.carry = (a >> 7) & 1 if m == "ASL" else a & 1
+                regs["A"] = (a << 1) & 0xFF if m == "ASL" else a >> 1
+            elif(not isinstance(a, Argument)):
+                # arguments keep their identity while being shifted out
+                # bit by bit (MMC1 serial writes)
+                regs["A"] = None
+                self.carry = None
+        elif(m in ("ADC", "SBC") and mode == MODE_IMM):
+            a = regs["A"]
+            if(known(a) and self.carry is not None):
+                if(m == "ADC"):
+                    r = a + operand + self.carry
+                    self.carry = r >> 8
+                else:
+                    r = a - operand - (1 - self.carry)
+                    self.carry = 0 if r < 0 else 1
+                regs["A"] = r & 0xFF
+            else:
+                regs["A"] = None
+                self.carry = None
+        elif(m == "CLC"):
+            self.carry = 0
+        elif(m == "SEC"):
+            self.carry = 1
+        elif(m in ("TSX", "PLA")):
+            regs["X" if m == "TSX" else "A"] = None
+        elif(m in ("CMP", "CPX", "CPY", "BIT", "ROL", "ROR")):
+            self.carry = None
+            if(m in ("ROL", "ROR")):
+                if(mode == MODE_ACC):
+                    regs["A"] = None
+                elif(mode == MODE_ZP):
+                    self.zp.pop(operand, None)
+        elif(m in RMW_MNEMONICS and mode == MODE_ZP):
+            self.zp.pop(operand, None)
+        elif(m in ("ADC", "SBC", "AND", "ORA", "EOR")):
+            regs["A"] = None
+            self.carry = None
+        return None
+
+
+# instruction kinds for the sweep
+_KIND_OTHER = 0
+_KIND_BRANCH = 1
+_KIND_JSR = 2
+_KIND_JMP = 3
+_KIND_STOP = 4
+_KIND_STORE = 5
+
+
+def _build_kind_table():
+    table = [None] * 0x100
+    for op in OPCODES:
+        if(op is None):
+            continue
+        kind = _KIND_OTHER
+        if(op.mode == MODE_REL):
+            kind = _KIND_BRANCH
+        elif(op.mnemonic == "JSR"):
+            kind = _KIND_JSR
+        elif(op.mnemonic == "JMP" and op.mode == MODE_ABS):
+            kind = _KIND_JMP
+        elif(op.mnemonic in STOP_MNEMONICS):
+            kind = _KIND_STOP
+        elif(op.mnemonic in STORE_MNEMONICS and op.mode in (MODE_ABS, MODE_ABX, MODE_ABY)):
+            kind = _KIND_STORE
+        table[op.opcode] = (op.size, kind)
+    return table
+
+
+_kind_table = _build_kind_table()
+
+# STA/STX/STY to $8000-$FFFF, used to find trampoline candidates
+_rom_store_re = re.compile(b"[\x8C\x8D\x8E\x99\x9D][\x00-\xFF][\x80-\xFF]")
+
+
+# ----------------------------------------------------------------------
+#
+#      linear sweep of every page. returns
+#        - the sorted offsets where basic blocks start: page starts,
+#          branch/jump targets and instructions following a JMP, RTS,
+#          RTI, BRK or an invalid opcode
+#        - offsets of stores to the ROM area and of JSR/JMP abs
+#        - all JSR targets as {offset: address}
+#
+def _sweep(prg, window_size):
+    prg_size = len(prg)
+    table = _kind_table
+    starts = bytearray(prg_size + 1)
+    leaders = set()
+    sites = []
+    calls = {}
+
+    for page_start in range(0, prg_size, PRG_PAGE_SIZE):
+        pos, end = page_start, page_start + PRG_PAGE_SIZE
+        leaders.add(pos)
+        while(pos < end):
+            entry = table[prg[pos]]
+            if(entry is None or pos + entry[0] > end):
+                pos += 1
+                leaders.add(pos)
+                continue
+            size, kind = entry
+            starts[pos] = 1
+            if(kind == _KIND_BRANCH):
+                operand = prg[pos + 1]
+                address = prg_offset_to_address(prg_size, window_size, pos)
+                target = address_to_prg_offset(prg_size, window_size, pos,
+                                               branch_target(address, operand))
+                if(target is not None):
+                    leaders.add(target)
+            elif(kind == _KIND_JSR or kind == _KIND_JMP):
+                operand = prg[pos + 1] | (prg[pos + 2] << 8)
+                target = address_to_prg_offset(prg_size, window_size, pos, operand)
+                if(target is not None):
+                    leaders.add(target)
+                    if(kind == _KIND_JSR):
+                        calls[target] = operand
+                sites.append(pos)
+            elif(kind == _KIND_STORE and prg[pos + 2] >= 0x80):
+                sites.append(pos)
+            pos += size
+            if(kind == _KIND_STOP or kind == _KIND_JMP):
+                leaders.add(pos)
+
+    # targets inside of other instructions never start a block of
+    # the sweep
+    leaders = sorted(p for p in leaders if p < prg_size and
+                     (starts[p] or p % PRG_PAGE_SIZE == 0))
+    return leaders, sites, calls
+
+
+# ----------------------------------------------------------------------
+#
+#      checks if the routine at offset writes a mapper register with a
+#      value passed in a register. returns (register name, decoder)
+#      or None
+#
+def _trampoline_argument(prg, mapper, offset):
+    state = RegisterState(mapper, arguments=True)
+    pos = offset
+    for _ in range(MAX_TRAMPOLINE_INSTRUCTIONS):
+        op, operand = decode(prg, pos)
+        if(op is None or op.mnemonic in STOP_MNEMONICS or op.mnemonic == "JSR"):
+            return None
+        store = state.step(op, operand)
+        if(store is not None and is_mapper_register(mapper, store[0])):
+            result = state.mapper.write(store[0], store[1])
+            if(result is not None and isinstance(result[0], Argument)):
+                return result[0].register, result[1]
+            if(result is not None):
+                # switches to a constant bank, not a trampoline
+                return None
+        pos += op.size
+    return None
+
+
+def is_supported_mapper(mapper):
+    return mapper in LATCH_MAPPERS or mapper in (MAPPER_MMC1, MAPPER_MMC3)
+
+
+# ----------------------------------------------------------------------
+#
+#      finds trampolines among all JSR targets. returns {offset:
+#      (address, argument register, decoder)}
+#
+def find_trampolines(prg, mapper, calls=None):
+    prg = bytes(prg)
+    if(not is_supported_mapper(mapper)):
+        return {}
+    if(calls is None):
+        calls = _sweep(prg, prg_window_size(mapper))[2]
+    trampolines = {}
+    span = MAX_TRAMPOLINE_INSTRUCTIONS * 3
+    for offset, address in calls.items():
+        if(not _rom_store_re.search(prg, offset, offset + span)):
+            continue
+        argument = _trampoline_argument(prg, mapper, offset)
+        if(argument is not None):
+            trampolines[offset] = (address,) + argument
+    return trampolines
+
+
+# ----------------------------------------------------------------------
+#
+#      runs the propagation over one basic block [start, stop)
+#
+def _propagate_block(prg, mapper, window_size, start, stop,
+                     trampolines, switches, refs):
+    prg_size = len(prg)
+    state = RegisterState(mapper)
+    current = None                  # last resolved switch of the block
+    pos = start
+
+    while(pos < stop):
+        op, operand = decode(prg, pos)
+        if(op is None or pos + op.size > stop):
+            return
+        address = prg_offset_to_address(prg_size, window_size, pos)
+        switch = None
+
+        if(op.mnemonic in ("JSR", "JMP") and op.mode == MODE_ABS):
+            target = address_to_prg_offset(prg_size, window_size, pos, operand)
+            if(target in trampolines):
+                _, register, decoder = trampolines[target]
+                value = state.regs[register]
+                if(isinstance(value, int)):
+                    switch = decode_bank(decoder, value) + (None, value, operand)
+            elif(current is not None):
+                target_offset = current.target_offset(operand)
+                if(target_offset is not None):
+                    refs.append(CrossBankRef(pos, address, current.bank, operand,
+                                             target_offset, op.mnemonic == "JSR"))
+            if(op.mnemonic == "JSR"):
+                # the callee may change anything but the mapper
+                mapper_state = state.mapper
+                state = RegisterState(mapper)
+                state.mapper = mapper_state
+        else:
+            store = state.step(op, operand)
+            if(store is not None and is_mapper_register(mapper, store[0])):
+                result = state.mapper.write(store[0], store[1])
+                if(result is not None and not isinstance(result[0], Argument)):
+                    switch = result + (store[0], store[1], None)
+
+        if(switch is not None):
+            bank, window_address, size, register, value, via = switch
+            # unused high bits of the bank number wrap around
+            bank %= max(1, prg_size // size)
+            current = BankSwitch(pos, address, register, value, bank,
+                                 window_address, size, via)
+            switches.append(current)
+
+        pos += op.size
+        if(op.mnemonic in STOP_MNEMONICS):
+            return
+
+
+# ----------------------------------------------------------------------
+#
+#      runs the propagation over the whole PRG-ROM. only the basic
+#      blocks containing a store to the ROM area or a JSR/JMP are
+#      simulated. returns a list of BankSwitch and a list of
+#      CrossBankRef
+#
+def propagate_banks(prg, mapper):
+    prg = bytes(prg)
+    if(not is_supported_mapper(mapper)):
+        return [], []
+
+    window_size = prg_window_size(mapper)
+    leaders, sites, calls = _sweep(prg, window_size)
+    trampolines = find_trampolines(prg, mapper, calls)
+
+    switches = []
+    refs = []
+    done = set()
+    for site in sites:
+        i = bisect.bisect_right(leaders, site) - 1
+        if(i in done):
+            continue
+        done.add(i)
+        stop = leaders[i + 1] if i + 1 < len(leaders) else len(prg)
+        _propagate_block(prg, mapper, window_size, leaders[i], stop,
+                         trampolines, switches, refs)
+    return switches, refs
+
+
+# ----------------------------------------------------------------------
+#
+#      comments all resolved bank switches in the mapped banks and adds
+#      cross-bank references. references whose target bank is not
+#      mapped are saved to a netnode (supval index = PRG-ROM offset)
+#
+def apply_bank_switches(switches, refs):
+    import ida_bytes
+    import ida_netnode
+    import ida_xref
+    from nesldr.database import prg_bank_map, is_prg_offset_at
+
+    bank_map = prg_bank_map()
+    unmapped = ida_netnode.netnode(PRG_CROSS_BANK_REFS_NODE, 0, True)
+
+    for switch in switches:
+        if(not is_prg_offset_at(switch.offset, switch.address, bank_map)):
+            continue
+        ida_bytes.set_cmt(switch.address, "PRG-ROM bank %d -> $%04X" %
+                          (switch.bank, switch.window_address), False)
+
+    count = 0
+    for ref in refs:
+        if(not is_prg_offset_at(ref.offset, ref.address, bank_map)):
+            continue
+        if(is_prg_offset_at(ref.target_offset, ref.target, bank_map)):
+            ida_xref.add_cref(ref.address, ref.target,
+                              ida_xref.fl_CN if ref.call else ida_xref.fl_JN)
+        else:
+            unmapped.supset(ref.offset, "%d:%04X" % (ref.bank, ref.target))
+            ida_bytes.set_cmt(ref.address, "-> bank %d:$%04X" % (ref.bank, ref.target), False)
+        count += 1
+    return count
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+
+    parser = argparse.ArgumentParser(prog="nesldr.bankprop")
+    parser.add_argument("rom")
+    args = parser.parse_args(argv)
+
+    image = RomImage.from_file(args.rom)
+    switches, refs = propagate_banks(image.prg(), image.mapper)
+    trampolines = find_trampolines(image.prg(), image.mapper)
+
+    for offset, (address, register, _) in sorted(trampolines.items()):
+        print("%06X  $%04X  trampoline, bank in %s" % (offset, address, register))
+    for switch in switches:
+        via = " via $%04X" % switch.via if switch.via is not None else ""
+        print("%06X  $%04X  bank %d -> $%04X%s" % (switch.offset, switch.address,
+                                                switch.bank, switch.window_address, via))
+    for ref in refs:
+        print("%06X  $%04X  %s bank %d:$%04X (offset %06X)" %
+              (ref.offset, ref.address, "JSR" if ref.call else "JMP", ref.bank,
+               ref.target, ref.target_offset))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Translation between PRG-ROM offsets and CPU addresses for
+    analysis passes working on the raw PRG-ROM, including the
+    banks which are not mapped into the database.
+
+    For 16k switching mappers the last page is assumed to be
+    fixed at $C000 and every other page to be switched in at
+    $8000. For 32k switching mappers every 32k window is
+    mapped at $8000.
+
+"""
+
+from nesldr.structs import *
+from nesldr.mappers import *
+
+
+# ----------------------------------------------------------------------
+#
+#      size of the PRG-ROM window ending at $FFFF that a mapper switches
+#
+def prg_window_size(mapper):
+    return ROM_SIZE if mapper in PRG_32K_MAPPERS else PRG_PAGE_SIZE
+
+
+# ----------------------------------------------------------------------
+#
+#      the usual CPU address of a PRG-ROM offset
+#
+def prg_offset_to_address(prg_size, window_size, offset):
+    if(window_size == ROM_SIZE):
+        return ROM_START_ADDRESS + offset % ROM_SIZE
+    if(offset >= prg_size - PRG_PAGE_SIZE):
+        return PRG_ROM_BANK_HIGH_ADDRESS + offset % PRG_PAGE_SIZE
+    return PRG_ROM_BANK_LOW_ADDRESS + offset % PRG_PAGE_SIZE
+
+
+# ----------------------------------------------------------------------
+#
+#      the PRG-ROM offset of a CPU address as seen by code at PRG-ROM
+#      offset origin. None if the address is outside of the ROM or in
+#      a bank that can not be determined (e.g. the switchable bank as
+#      seen from the fixed bank)
+#
+def address_to_prg_offset(prg_size, window_size, origin, address):
+    if(not ROM_START_ADDRESS <= address < ROM_START_ADDRESS + ROM_SIZE):
+        return None
+
+    if(window_size == ROM_SIZE):
+        offset = origin - origin % ROM_SIZE + address - ROM_START_ADDRESS
+    elif(prg_size <= PRG_PAGE_SIZE):
+        # a single page is mirrored at $8000 and $C000
+        offset = address % PRG_PAGE_SIZE
+    elif(address >= PRG_ROM_BANK_HIGH_ADDRESS):
+        offset = prg_size - PRG_PAGE_SIZE + address - PRG_ROM_BANK_HIGH_ADDRESS
+    elif(origin >= prg_size - PRG_PAGE_SIZE):
+        return None
+    else:
+        offset = origin - origin % PRG_PAGE_SIZE + address - PRG_ROM_BANK_LOW_ADDRESS
+
+    return offset if offset < prg_size else None
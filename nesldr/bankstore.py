@@ -0,0 +1,371 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Content-addressed store of PRG-ROM and CHR-ROM pages.
+    Every page is stored once, zlib compressed, under the
+    SHA-256 of its contents; a ROM is a manifest listing the
+    header and the hashes of its trainer and pages. Regional
+    releases, revisions and hacks share most of their pages,
+    so a corpus takes a fraction of its size.
+
+    Layout of a store directory:
+
+        objects/ab/abcdef...    pages (and trainers, trailing data)
+        manifests/<sha1>.json   one manifest per ROM (SHA-1 of the file)
+        index.db                sqlite index: page hash -> ROMs
+
+    A manifest file (.nesm) saved anywhere and naming its store
+    can be opened like a .nes file by the loader and by all
+    tools using RomImage.from_file().
+
+    usage:
+        python -m nesldr.bankstore add <store> <rom, archive or dir>... [--manifest-dir DIR]
+        python -m nesldr.bankstore which <store> <rom.nes> --page N [--chr]
+        python -m nesldr.bankstore extract <store> <sha1> <out.nes>
+        python -m nesldr.bankstore stats <store>
+
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import zlib
+
+from nesldr.structs import *
+from nesldr.rom import RomImage, iter_rom_images
+
+
+MANIFEST_FORMAT = "nesldr-manifest"
+MANIFEST_VERSION = 1
+MANIFEST_EXTENSION = ".nesm"
+
+# store used for manifests not naming one
+BANK_STORE_ENV = "NESLDR_BANK_STORE"
+
+PAGE_PRG = "prg"
+PAGE_CHR = "chr"
+
+
+class BankStoreError(Exception):
+    pass
+
+
+def page_hash(data):
+    return hashlib.sha256(bytes(data)).hexdigest()
+
+
+# ----------------------------------------------------------------------
+#
+#      an iNES image as header and references to stored pages
+#
+class Manifest(object):
+
+    def __init__(self, sha1, header, prg, chr, trainer=None, tail=None,
+                 name=None, store=None):
+        self.sha1 = sha1                # of the whole file
+        self.header = header            # 16 header bytes
+        self.prg = prg                  # hashes of the PRG-ROM pages
+        self.chr = chr                  # hashes of the CHR-ROM pages
+        self.trainer = trainer          # hash of the trainer or None
+        self.tail = tail                # hash of data after the pages or None
+        self.name = name
+        self.store = store              # path of the store, if known
+
+    def hashes(self):
+        return [h for h in [self.trainer, self.tail] + self.prg + self.chr if h]
+
+    def to_json(self):
+        return json.dumps({"format": MANIFEST_FORMAT, "version": MANIFEST_VERSION,
+                           "sha1": self.sha1, "name": self.name, "store": self.store,
+                           "header": self.header.hex(), "trainer": self.trainer,
+                           "prg": self.prg, "chr": self.chr, "tail": self.tail},
+                          indent=1)
+
+    @classmethod
+    def from_json(cls, text):
+        try:
+            d = json.loads(text)
+        except ValueError as e:
+            raise BankStoreError("not a manifest: %s" % e)
+        if(not isinstance(d, dict) or d.get("format") != MANIFEST_FORMAT):
+            raise BankStoreError("not a manifest")
+        if(d.get("version") != MANIFEST_VERSION):
+            raise BankStoreError("manifest version %r is not supported" % d.get("version"))
+        return cls(d["sha1"], bytes.fromhex(d["header"]), d["prg"], d["chr"],
+                   d.get("trainer"), d.get("tail"), d.get("name"), d.get("store"))
+
+
+# ----------------------------------------------------------------------
+#
+#      does data (the start of a file) look like a manifest?
+#
+def is_manifest_data(data):
+    return bytes(data).lstrip()[:1] == b"{" and MANIFEST_FORMAT.encode() in bytes(data)
+
+
+def is_manifest_file(path):
+    return path.lower().endswith(MANIFEST_EXTENSION)
+
+
+class BankStore(object):
+
+    def __init__(self, root, create=True):
+        self.root = os.path.abspath(root)
+        if(not os.path.isdir(self.root)):
+            if(not create):
+                raise BankStoreError("%s: no bank store" % root)
+            os.makedirs(os.path.join(self.root, "objects"))
+            os.makedirs(os.path.join(self.root, "manifests"))
+        self.db = sqlite3.connect(os.path.join(self.root, "index.db"))
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS roms (
+                sha1 TEXT PRIMARY KEY,
+                name TEXT,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                hash TEXT NOT NULL,
+                rom TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                PRIMARY KEY (hash, rom, kind, page)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS objects (
+                hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                stored INTEGER NOT NULL
+            ) WITHOUT ROWID;
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def _manifest_path(self, sha1):
+        return os.path.join(self.root, "manifests", sha1 + ".json")
+
+    # ----------------------------------------------------------------------
+    #
+    #      stores data unless already present. returns its hash
+    #
+    def put(self, data):
+        data = bytes(data)
+        digest = page_hash(data)
+        path = self._object_path(digest)
+        if(os.path.exists(path)):
+            return digest
+
+        packed = zlib.compress(data, 9)
+        directory = os.path.dirname(path)
+        if(not os.path.isdir(directory)):
+            os.makedirs(directory, exist_ok=True)
+        # written under a temporary name, so readers never see half an object
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(packed)
+        os.replace(temp, path)
+        self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)",
+                        (digest, len(data), len(packed)))
+        return digest
+
+    def get(self, digest):
+        try:
+            with open(self._object_path(digest), "rb") as f:
+                data = zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            raise BankStoreError("object %s: %s" % (digest, e))
+        if(page_hash(data) != digest):
+            raise BankStoreError("object %s is corrupt" % digest)
+        return data
+
+    def __contains__(self, digest):
+        return os.path.exists(self._object_path(digest))
+
+    # ----------------------------------------------------------------------
+    #
+    #      stores the pages of an image and its manifest. returns the
+    #      Manifest; an image stored before is not stored again
+    #
+    def add_image(self, image, name=None):
+        sha1 = hashlib.sha1(image.data).hexdigest()
+        if(os.path.exists(self._manifest_path(sha1))):
+            return self.manifest(sha1)
+
+        prg = [self.put(image.prg_page(i)) for i in range(image.prg_page_count)]
+        chr = [self.put(image.chr_page(i)) for i in range(image.chr_page_count)]
+        trainer = self.put(image.trainer()) if image.has_trainer else None
+        # whatever follows the last complete page (or a short trainer)
+        end = image.prg_offset + image.prg_page_count * PRG_PAGE_SIZE
+        if(image.prg_page_count == image.hdr.prg_page_count_16k):
+            end = image.chr_offset + image.chr_page_count * CHR_PAGE_SIZE
+        tail = self.put(image.data[end:]) if len(image.data) > end else None
+
+        manifest = Manifest(sha1, image.header_bytes(), prg, chr, trainer, tail,
+                            name or image.name, self.root)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO roms VALUES (?, ?, ?)",
+                            (sha1, manifest.name, len(image.data)))
+            self.db.executemany("INSERT OR IGNORE INTO pages VALUES (?, ?, ?, ?)",
+                                [(h, sha1, PAGE_PRG, i) for i, h in enumerate(prg)] +
+                                [(h, sha1, PAGE_CHR, i) for i, h in enumerate(chr)])
+        with open(self._manifest_path(sha1), "w") as f:
+            f.write(manifest.to_json())
+        return manifest
+
+    def manifest(self, sha1):
+        try:
+            with open(self._manifest_path(sha1)) as f:
+                return Manifest.from_json(f.read())
+        except OSError:
+            raise BankStoreError("no ROM %s in %s" % (sha1, self.root))
+
+    # ----------------------------------------------------------------------
+    #
+    #      rebuilds the original file of a manifest
+    #
+    def image_data(self, manifest):
+        parts = [manifest.header]
+        if(manifest.trainer):
+            parts.append(self.get(manifest.trainer))
+        parts.extend(self.get(h) for h in manifest.prg)
+        parts.extend(self.get(h) for h in manifest.chr)
+        if(manifest.tail):
+            parts.append(self.get(manifest.tail))
+        data = b"".join(parts)
+        if(hashlib.sha1(data).hexdigest() != manifest.sha1):
+            raise BankStoreError("%s: rebuilt image does not match" % manifest.sha1)
+        return data
+
+    def image(self, manifest):
+        return RomImage(self.image_data(manifest), manifest.name)
+
+    # ----------------------------------------------------------------------
+    #
+    #      all ROMs containing a page as (sha1, name, kind, page)
+    #
+    def roms_with_page(self, digest):
+        return self.db.execute(
+            "SELECT pages.rom, roms.name, pages.kind, pages.page FROM pages "
+            "JOIN roms ON roms.sha1 = pages.rom WHERE pages.hash = ? "
+            "ORDER BY roms.name, pages.kind, pages.page", (digest,)).fetchall()
+
+    # (ROM count, size of all ROMs, size of the stored objects)
+    def stats(self):
+        roms, size = self.db.execute("SELECT COUNT(*), TOTAL(size) FROM roms").fetchone()
+        stored, = self.db.execute("SELECT TOTAL(stored) FROM objects").fetchone()
+        return roms, int(size), int(stored)
+
+
+# ----------------------------------------------------------------------
+#
+#      the store a manifest refers to: the one it names (relative to
+#      the manifest's directory), else $NESLDR_BANK_STORE
+#
+def open_manifest_store(manifest, manifest_path=None):
+    root = manifest.store or os.environ.get(BANK_STORE_ENV)
+    if(root is None):
+        raise BankStoreError("the manifest names no bank store and %s is not set" %
+                             BANK_STORE_ENV)
+    if(manifest_path is not None and not os.path.isabs(root)):
+        root = os.path.join(os.path.dirname(os.path.abspath(manifest_path)), root)
+    return BankStore(root, create=False)
+
+
+# ----------------------------------------------------------------------
+#
+#      the original file of a manifest file (or its contents)
+#
+def read_manifest_image(path, text=None):
+    if(text is None):
+        with open(path) as f:
+            text = f.read()
+    manifest = Manifest.from_json(text)
+    store = open_manifest_store(manifest, path)
+    try:
+        return manifest, store.image_data(manifest)
+    finally:
+        store.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nesldr.bankstore")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("add", help="store ROMs")
+    p.add_argument("store")
+    p.add_argument("paths", nargs="+")
+    p.add_argument("--manifest-dir", help="also write a .nesm manifest per ROM here")
+
+    p = sub.add_parser("which", help="list the ROMs containing a page of a ROM")
+    p.add_argument("store")
+    p.add_argument("rom")
+    p.add_argument("--page", type=int, default=0)
+    p.add_argument("--chr", action="store_true", help="a CHR-ROM page")
+
+    p = sub.add_parser("extract", help="rebuild a ROM")
+    p.add_argument("store")
+    p.add_argument("sha1")
+    p.add_argument("output")
+
+    p = sub.add_parser("stats", help="show the space saved")
+    p.add_argument("store")
+
+    args = parser.parse_args(argv)
+    try:
+        store = BankStore(args.store, create=args.command == "add")
+    except BankStoreError as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+
+    status = 0
+    try:
+        if(args.command == "add"):
+            for path, image in iter_rom_images(args.paths):
+                if(isinstance(image, Exception)):
+                    sys.stderr.write("skipping %s: %s\n" % (path, image))
+                    status = 1
+                    continue
+                manifest = store.add_image(image, path)
+                print("%s %s" % (manifest.sha1, path))
+                if(args.manifest_dir):
+                    base = os.path.splitext(os.path.basename(path.split("!")[-1]))[0]
+                    with open(os.path.join(args.manifest_dir, base + MANIFEST_EXTENSION), "w") as f:
+                        f.write(manifest.to_json())
+
+        elif(args.command == "which"):
+            image = RomImage.from_file(args.rom)
+            page = image.chr_page(args.page) if args.chr else image.prg_page(args.page)
+            digest = page_hash(page)
+            print("%s page %d: %s" % (PAGE_CHR if args.chr else PAGE_PRG, args.page, digest))
+            for sha1, name, kind, index in store.roms_with_page(digest):
+                print("  %s %s page %d  %s" % (sha1, kind, index, name))
+
+        elif(args.command == "extract"):
+            data = store.image_data(store.manifest(args.sha1))
+            with open(args.output, "wb") as f:
+                f.write(data)
+
+        else:
+            roms, size, stored = store.stats()
+            print("%d ROM(s), %d bytes, stored in %d bytes (%.1f%%)" %
+                  (roms, size, stored, 100.0 * stored / size if size else 0))
+    except BankStoreError as e:
+        sys.stderr.write("%s\n" % e)
+        status = 1
+    finally:
+        store.close()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
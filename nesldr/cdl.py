@@ -0,0 +1,204 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Import of Code/Data Logger (CDL) files written by FCEUX
+    and Mesen. A CDL file holds one flag byte per PRG-ROM and
+    CHR-ROM byte; bit 0 marks bytes executed as code, bit 1
+    bytes read as data, in all formats:
+
+        FCEUX       raw flags, PRG-ROM then CHR-ROM
+        Mesen       "CDL\\x01" followed by the flags
+        Mesen 2     "CDLv2", a 32-bit CRC, then the flags
+
+    The flags of every PRG-ROM page are turned into runs of
+    code and data with a translate table and a regular
+    expression, so only one IDA call per run is made. The
+    whole map is kept zlib compressed in the database.
+
+    usage:
+        python -m nesldr.cdl <rom.nes> [<rom.cdl>]
+
+"""
+
+import argparse
+import os
+import re
+import sys
+import zlib
+
+from nesldr.structs import *
+
+
+CDL_CODE = 0x01
+CDL_DATA = 0x02
+
+MESEN_CDL_MAGIC = b"CDL\x01"
+MESEN2_CDL_MAGIC = b"CDLv2"
+MESEN2_CDL_HEADER_SIZE = len(MESEN2_CDL_MAGIC) + 4
+
+RUN_CODE = b"C"
+RUN_DATA = b"D"
+
+# flags -> run class. code wins over data
+_run_classes = bytes((RUN_CODE if f & CDL_CODE else RUN_DATA if f & CDL_DATA else b".")[0]
+                     for f in range(0x100))
+_run_re = re.compile(b"C+|D+")
+
+
+class CdlError(Exception):
+    pass
+
+
+class CdlMap(object):
+
+    def __init__(self, prg, chr, format_name):
+        self.prg = prg                  # flags of the PRG-ROM
+        self.chr = chr                  # flags of the CHR-ROM (may be empty)
+        self.format_name = format_name
+
+    def to_bytes(self):
+        return zlib.compress(bytes(self.prg) + bytes(self.chr), 9)
+
+    @classmethod
+    def from_bytes(cls, blob, prg_size):
+        data = zlib.decompress(blob)
+        return cls(data[:prg_size], data[prg_size:], "database")
+
+
+# ----------------------------------------------------------------------
+#
+#      parses the contents of a CDL file for a ROM with the given
+#      PRG-ROM and CHR-ROM sizes
+#
+def parse_cdl(data, prg_size, chr_size):
+    data = bytes(data)
+    if(data.startswith(MESEN2_CDL_MAGIC)):
+        format_name, data = "Mesen 2", data[MESEN2_CDL_HEADER_SIZE:]
+    elif(data.startswith(MESEN_CDL_MAGIC)):
+        format_name, data = "Mesen", data[len(MESEN_CDL_MAGIC):]
+    else:
+        format_name = "FCEUX"
+
+    if(len(data) not in (prg_size, prg_size + chr_size)):
+        raise CdlError("%s CDL holds %d bytes, the ROM %d PRG-ROM + %d CHR-ROM bytes" %
+                       (format_name, len(data), prg_size, chr_size))
+    return CdlMap(data[:prg_size], data[prg_size:], format_name)
+
+
+def read_cdl(path, prg_size, chr_size):
+    with open(path, "rb") as f:
+        return parse_cdl(f.read(), prg_size, chr_size)
+
+
+# ----------------------------------------------------------------------
+#
+#      the CDL file belonging to a ROM: game.cdl or game.nes.cdl
+#
+def find_cdl_file(rom_path):
+    for path in (os.path.splitext(rom_path)[0] + ".cdl", rom_path + ".cdl"):
+        if(os.path.isfile(path)):
+            return path
+    return None
+
+
+# ----------------------------------------------------------------------
+#
+#      yields (kind, offset, size) for all runs of code (RUN_CODE) and
+#      data (RUN_DATA) bytes. runs never cross a page of page_size
+#
+def iter_runs(flags, page_size=PRG_PAGE_SIZE):
+    classes = bytes(flags).translate(_run_classes)
+    for page_start in range(0, len(classes), page_size):
+        for m in _run_re.finditer(classes, page_start, page_start + page_size):
+            yield m.group()[:1], m.start(), m.end() - m.start()
+
+
+def summarize(flags, page_size=PRG_PAGE_SIZE):
+    classes = bytes(flags).translate(_run_classes)
+    pages = []
+    for page_start in range(0, len(classes), page_size):
+        page = classes[page_start:page_start + page_size]
+        pages.append((page.count(RUN_CODE), page.count(RUN_DATA)))
+    return pages
+
+
+# ----------------------------------------------------------------------
+#
+#      saves the map and applies the runs of the mapped banks: data
+#      runs become byte arrays, code runs are queued for analysis.
+#      returns (code runs, data runs) applied
+#
+def apply_cdl(cdl):
+    import ida_auto
+    import ida_bytes
+    import ida_netnode
+    from nesldr.database import prg_bank_map, prg_offset_to_eas
+
+    node = ida_netnode.netnode(CDL_NODE, 0, True)
+    node.altset(0, len(cdl.prg))
+    node.setblob(cdl.to_bytes(), 0, 'C')
+
+    bank_map = prg_bank_map()
+    code = data = 0
+    for kind, offset, run_size in iter_runs(cdl.prg, PRG_BANK_MAP_SLOT_SIZE):
+        # every copy of a bank mapped more than once
+        for ea in prg_offset_to_eas(offset, bank_map):
+            size = min(run_size, NMI_VECTOR_START_ADDRESS - ea) \
+                if ea < NMI_VECTOR_START_ADDRESS else 0
+            if(size <= 0):
+                continue
+            # the log is authoritative, items defined earlier go away
+            ida_bytes.del_items(ea, ida_bytes.DELIT_SIMPLE, size)
+            if(kind == RUN_CODE):
+                ida_auto.auto_make_code(ea)
+                code += 1
+            else:
+                ida_bytes.create_byte(ea, size)
+                data += 1
+    return code, data
+
+
+# ----------------------------------------------------------------------
+#
+#      the map saved by apply_cdl(), None if there is none
+#
+def load_cdl():
+    import ida_netnode
+    from nesldr.database import get_node_blob
+
+    blob = get_node_blob(CDL_NODE, 'C')
+    if(blob is None):
+        return None
+    return CdlMap.from_bytes(blob, ida_netnode.netnode(CDL_NODE, 0, False).altval(0))
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+
+    parser = argparse.ArgumentParser(prog="nesldr.cdl")
+    parser.add_argument("rom")
+    parser.add_argument("cdl", nargs="?")
+    args = parser.parse_args(argv)
+
+    image = RomImage.from_file(args.rom)
+    path = args.cdl or find_cdl_file(args.rom)
+    if(path is None):
+        sys.stderr.write("no CDL file found for %s\n" % args.rom)
+        return 1
+    try:
+        cdl = read_cdl(path, len(image.prg()), len(image.chr()))
+    except CdlError as e:
+        sys.stderr.write("%s: %s\n" % (path, e))
+        return 1
+
+    print("%s (%s)" % (path, cdl.format_name))
+    for page, (code, data) in enumerate(summarize(cdl.prg)):
+        print("page %3d: %5d code, %5d data, %5d unknown" %
+              (page, code, data, PRG_PAGE_SIZE - code - data))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
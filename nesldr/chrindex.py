@@ -0,0 +1,258 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Corpus-wide CHR tile index. Every CHR-ROM page is split
+    into 16-byte tiles which are hashed twice: once as they
+    are stored, once in a flip and palette invariant form.
+    The hashes go into an inverted index (sqlite) mapping
+    tile hash -> (ROM, page, tile).
+
+    usage:
+        python -m nesldr.chrindex index <index.db> <rom, archive or dir>...
+        python -m nesldr.chrindex query <index.db> <rom.nes> [options]
+
+"""
+
+import argparse
+import hashlib
+import sqlite3
+import sys
+from collections import Counter
+
+from nesldr.structs import *
+from nesldr.rom import RomImage, iter_rom_images
+
+
+TILE_SIZE = 0x10
+TILES_PER_CHR_PAGE = CHR_PAGE_SIZE // TILE_SIZE
+
+# kinds of keys stored for each tile
+TILE_KEY_EXACT = 0
+TILE_KEY_INVARIANT = 1
+
+# used for mirroring a tile horizontally
+_bit_reverse = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(0x100))
+
+# ---------------------------------------------------------------------
+#
+#      tile transformations
+#
+
+
+def tile_hflip(tile):
+    return bytes(tile).translate(_bit_reverse)
+
+
+def tile_vflip(tile):
+    tile = bytes(tile)
+    return tile[7::-1] + tile[15:7:-1]
+
+
+# ----------------------------------------------------------------------
+#
+#      renumbers the 4 colors of a tile in order of first appearance,
+#      so that the same shape drawn with another palette yields the
+#      same bytes. a solid tile always becomes 16 zero bytes
+#
+def tile_normalize_palette(tile):
+    lo, hi = tile[:8], tile[8:]
+    mapping = {}
+    out_lo = bytearray(8)
+    out_hi = bytearray(8)
+    for y in range(8):
+        p0, p1 = lo[y], hi[y]
+        for x in range(7, -1, -1):
+            color = ((p0 >> x) & 1) | (((p1 >> x) & 1) << 1)
+            color = mapping.setdefault(color, len(mapping))
+            out_lo[y] |= (color & 1) << x
+            out_hi[y] |= (color >> 1) << x
+    return bytes(out_lo + out_hi)
+
+
+# ----------------------------------------------------------------------
+#
+#      returns the flip and palette invariant form of a tile: the
+#      smallest palette-normalized variant of all four flips
+#
+_invariant_cache = {}
+
+
+def tile_invariant(tile):
+    tile = bytes(tile)
+    key = _invariant_cache.get(tile)
+    if(key is None):
+        h = tile_hflip(tile)
+        key = min(tile_normalize_palette(t)
+                  for t in (tile, h, tile_vflip(tile), tile_vflip(h)))
+        if(len(_invariant_cache) > 0x40000):
+            _invariant_cache.clear()
+        _invariant_cache[tile] = key
+    return key
+
+
+def tile_is_solid(tile):
+    return tile_invariant(tile) == bytes(TILE_SIZE)
+
+
+# ----------------------------------------------------------------------
+#
+#      64 bit hash of a tile, stored as a signed sqlite INTEGER
+#
+def tile_hash(tile):
+    return int.from_bytes(hashlib.blake2b(bytes(tile), digest_size=8).digest(),
+                          "little", signed=True)
+
+
+def tile_keys(tile):
+    return tile_hash(tile), tile_hash(tile_invariant(tile))
+
+
+def iter_tiles(page):
+    for i in range(len(page) // TILE_SIZE):
+        yield i, page[i * TILE_SIZE:(i + 1) * TILE_SIZE]
+
+
+# ----------------------------------------------------------------------
+#
+#      persistent inverted tile index
+#
+class TileIndex(object):
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS roms (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                sha1 TEXT NOT NULL,
+                chr_pages INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tiles (
+                kind INTEGER NOT NULL,
+                key INTEGER NOT NULL,
+                rom INTEGER NOT NULL,
+                page INTEGER NOT NULL,
+                tile INTEGER NOT NULL,
+                PRIMARY KEY (kind, key, rom, page, tile)
+            ) WITHOUT ROWID;
+        """)
+
+    def close(self):
+        self.db.close()
+
+    # ----------------------------------------------------------------------
+    #
+    #      adds (or refreshes) the CHR pages of an image. returns False
+    #      if the image is already indexed with the same contents
+    #
+    def add_image(self, image, name):
+        sha1 = hashlib.sha1(image.data).hexdigest()
+        row = self.db.execute("SELECT id, sha1 FROM roms WHERE path = ?",
+                              (name,)).fetchone()
+        if(row is not None and row[1] == sha1):
+            return False
+
+        with self.db:
+            if(row is not None):
+                self.db.execute("DELETE FROM tiles WHERE rom = ?", (row[0],))
+                self.db.execute("DELETE FROM roms WHERE id = ?", (row[0],))
+            rom_id = self.db.execute(
+                "INSERT INTO roms (path, sha1, chr_pages) VALUES (?, ?, ?)",
+                (name, sha1, image.chr_page_count)).lastrowid
+
+            rows = []
+            for page in range(image.chr_page_count):
+                for i, tile in iter_tiles(image.chr_page(page)):
+                    if(tile_is_solid(tile)):
+                        continue
+                    exact, invariant = tile_keys(tile)
+                    rows.append((TILE_KEY_EXACT, exact, rom_id, page, i))
+                    rows.append((TILE_KEY_INVARIANT, invariant, rom_id, page, i))
+            self.db.executemany(
+                "INSERT OR IGNORE INTO tiles VALUES (?, ?, ?, ?, ?)", rows)
+        return True
+
+    def add_file(self, path):
+        return self.add_image(RomImage.from_file(path), path)
+
+    # ----------------------------------------------------------------------
+    #
+    #      all occurences of a single tile as (path, page, tile) tuples
+    #
+    def lookup(self, tile, exact=False):
+        kind = TILE_KEY_EXACT if exact else TILE_KEY_INVARIANT
+        key = tile_keys(tile)[kind]
+        return self.db.execute(
+            "SELECT roms.path, tiles.page, tiles.tile FROM tiles "
+            "JOIN roms ON roms.id = tiles.rom "
+            "WHERE tiles.kind = ? AND tiles.key = ?", (kind, key)).fetchall()
+
+    # ----------------------------------------------------------------------
+    #
+    #      ranks ROMs by how many of the given (non-solid) tiles
+    #      they contain. returns a list of (path, matches, total)
+    #
+    def query(self, tiles, exact=False, limit=50):
+        kind = TILE_KEY_EXACT if exact else TILE_KEY_INVARIANT
+        keys = set(tile_keys(t)[kind] for t in tiles if not tile_is_solid(t))
+
+        hits = Counter()
+        for key in keys:
+            for (rom,) in self.db.execute(
+                    "SELECT DISTINCT rom FROM tiles WHERE kind = ? AND key = ?",
+                    (kind, key)):
+                hits[rom] += 1
+
+        result = []
+        for rom, count in hits.most_common(limit):
+            path = self.db.execute("SELECT path FROM roms WHERE id = ?",
+                                   (rom,)).fetchone()[0]
+            result.append((path, count, len(keys)))
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nesldr.chrindex")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("index", help="add ROMs to the index")
+    p.add_argument("index")
+    p.add_argument("paths", nargs="+")
+
+    p = sub.add_parser("query", help="find ROMs sharing tiles with a ROM")
+    p.add_argument("index")
+    p.add_argument("rom")
+    p.add_argument("--page", type=int, default=0)
+    p.add_argument("--first", type=int, default=0, help="first tile")
+    p.add_argument("--count", type=int, default=TILES_PER_CHR_PAGE)
+    p.add_argument("--exact", action="store_true",
+                   help="do not match flipped or recolored tiles")
+    p.add_argument("--limit", type=int, default=50)
+
+    args = parser.parse_args(argv)
+    index = TileIndex(args.index)
+
+    if(args.command == "index"):
+        for path, image in iter_rom_images(args.paths):
+            if(isinstance(image, Exception)):
+                sys.stderr.write("skipping %s: %s\n" % (path, image))
+                continue
+            added = index.add_image(image, path)
+            print("%s %s" % ("indexed" if added else "unchanged", path))
+    else:
+        page = RomImage.from_file(args.rom).chr_page(args.page)
+        tiles = [t for i, t in iter_tiles(page)
+                 if args.first <= i < args.first + args.count]
+        for path, count, total in index.query(tiles, args.exact, args.limit):
+            print("%4d/%-4d %s" % (count, total, path))
+
+    index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Statistical code/data classifier. Every offset of the
+    PRG-ROM is scored (0-255) as the start of an instruction:
+
+        opcode      valid, common opcodes score higher
+        operand     absolute operands have to address RAM, the
+                    PPU/APU registers, SRAM or ROM
+        chain       the following 1-4 instructions are valid too
+        flow        branch/JMP/JSR targets are valid instructions
+
+    The features are computed for all offsets at once: bytes
+    are mapped with translate tables and combined bytewise as
+    big integers (AND/OR and addition without carries between
+    bytes), so no per-byte Python loop is needed except for the
+    control flow targets.
+
+    The scores are saved zlib compressed to the database and
+    used to start analysis at likely code following returns.
+
+    usage:
+        python -m nesldr.classify <rom.nes> [--threshold N]
+
+"""
+
+import argparse
+import re
+import sys
+import zlib
+
+from nesldr.structs import *
+from nesldr.ioregs import PAPU_PULSE_1_CR_ADDRESS
+from nesldr.opcodes import *
+from nesldr.banks import prg_window_size, prg_offset_to_address, address_to_prg_offset
+
+
+# feature weights, the maximum score is 240
+WEIGHT_COMMON_OPCODE = 40
+WEIGHT_OPCODE = 20
+WEIGHT_OPERAND = 40
+WEIGHT_CHAIN = 30
+CHAIN_DEPTH = 4
+WEIGHT_FLOW = 40
+WEIGHT_NO_FLOW = 20
+
+# offsets scoring at least this are considered code
+CODE_THRESHOLD = 180
+# code following a return has to start a run of this many instructions
+MIN_CODE_RUN = 6
+
+# opcodes most frequent in NES code
+COMMON_MNEMONICS = frozenset(("LDA", "STA", "LDX", "STX", "LDY", "STY", "JSR", "RTS",
+                              "JMP", "BNE", "BEQ", "BCC", "BCS", "BPL", "BMI", "CMP",
+                              "INC", "DEC", "INX", "INY", "DEX", "DEY", "AND", "ORA",
+                              "CLC", "SEC", "ADC", "SBC", "TAX", "TAY", "TXA", "TYA",
+                              "PHA", "PLA", "ASL", "LSR"))
+
+# high bytes of absolute addresses code usually accesses: RAM, PPU and
+# APU/IO registers, SRAM and ROM. mirrors of RAM and of the PPU
+# registers are unusual
+_plausible_high = bytes(0xFF if (hi < 0x08 or hi == IOREGS_START_ADDRESS >> 8 or
+                                 hi == PAPU_PULSE_1_CR_ADDRESS >> 8 or
+                                 hi >= SRAM_START_ADDRESS >> 8) else 0
+                        for hi in range(0x100))
+
+
+def _table(predicate, value=0xFF):
+    return bytes(value if op is not None and predicate(op) else 0 for op in OPCODES)
+
+
+_valid_mask = _table(lambda op: op.mnemonic != "BRK")
+_opcode_weight = bytes(0 if op is None or op.mnemonic == "BRK" else
+                       WEIGHT_COMMON_OPCODE if op.mnemonic in COMMON_MNEMONICS else
+                       WEIGHT_OPCODE for op in OPCODES)
+_abs_mask = _table(lambda op: op.mode in (MODE_ABS, MODE_ABX, MODE_ABY, MODE_IND))
+_not_abs_mask = _table(lambda op: op.mode not in (MODE_ABS, MODE_ABX, MODE_ABY, MODE_IND))
+_size_masks = [_table(lambda op, s=s: op.size == s) for s in (1, 2, 3)]
+
+_branch_re = re.compile(b"[\\x10\\x30\\x50\\x70\\x90\\xB0\\xD0\\xF0]")
+_jump_re = re.compile(b"[\\x20\\x4C]")
+
+
+def _int(data):
+    return int.from_bytes(data, "little")
+
+
+def _fill(value, size):
+    return _int(bytes((value,)) * size)
+
+
+# ----------------------------------------------------------------------
+#
+#      scores every offset of the PRG-ROM. returns a bytearray of the
+#      same size
+#
+def classify_prg(prg, mapper=0):
+    prg = bytes(prg)
+    size = len(prg)
+    if(not size):
+        return bytearray()
+    window_size = prg_window_size(mapper)
+
+    valid = _int(prg.translate(_valid_mask))
+    score = _int(prg.translate(_opcode_weight))
+
+    # absolute operands: the high byte is two bytes after the opcode
+    high = _int((prg[2:] + b"\x00\x00").translate(_plausible_high))
+    operand = _int(prg.translate(_not_abs_mask)) | (_int(prg.translate(_abs_mask)) & high)
+    score += operand & _fill(WEIGHT_OPERAND, size)
+
+    # chain[i]: the instruction at i and the next k ones are valid
+    sizes = [_int(prg.translate(m)) for m in _size_masks]
+    chain = valid & operand
+    chain_weight = _fill(WEIGHT_CHAIN, size)
+    for _ in range(CHAIN_DEPTH):
+        chain = valid & ((sizes[0] & (chain >> 8)) |
+                         (sizes[1] & (chain >> 16)) |
+                         (sizes[2] & (chain >> 24)))
+        score += chain & chain_weight
+
+    # control flow targets have to start an instruction chain
+    first = (valid & ((sizes[0] & (valid >> 8)) | (sizes[1] & (valid >> 16)) |
+                      (sizes[2] & (valid >> 24)))).to_bytes(size, "little")
+    flow = bytearray(bytes((WEIGHT_NO_FLOW,)) * size)
+    for m in _branch_re.finditer(prg, 0, size - 1):
+        pos = m.start()
+        target = pos + 2 + (prg[pos + 1] ^ 0x80) - 0x80
+        good = 0 <= target < size and target // PRG_PAGE_SIZE == pos // PRG_PAGE_SIZE and first[target]
+        flow[pos] = WEIGHT_FLOW if good else 0
+    for m in _jump_re.finditer(prg, 0, size - 2):
+        pos = m.start()
+        address = prg[pos + 1] | (prg[pos + 2] << 8)
+        if(address < ROM_START_ADDRESS):
+            # JSR into RAM is rare, JMP into RAM very rare
+            flow[pos] = 0 if prg[pos] == OP_JMP else WEIGHT_NO_FLOW
+            continue
+        target = address_to_prg_offset(size, window_size, pos, address)
+        if(target is not None):
+            flow[pos] = WEIGHT_FLOW if first[target] else 0
+    score += _int(flow)
+
+    # invalid opcodes score zero
+    return bytearray((score & _int(prg.translate(_valid_mask))).to_bytes(size, "little"))
+
+
+def scores_to_bytes(scores):
+    return zlib.compress(bytes(scores), 9)
+
+
+def scores_from_bytes(blob):
+    return bytearray(zlib.decompress(blob))
+
+
+# ----------------------------------------------------------------------
+#
+#      walks the instructions from offset while they score as code.
+#      returns the number of instructions up to (and including) the
+#      first JMP/RTS/RTI
+#
+def code_run_length(prg, scores, offset, threshold=CODE_THRESHOLD, limit=64):
+    count = 0
+    end = min(len(prg), offset - offset % PRG_PAGE_SIZE + PRG_PAGE_SIZE)
+    while(offset < end and count < limit):
+        op = OPCODES[prg[offset]]
+        if(op is None or scores[offset] < threshold):
+            break
+        count += 1
+        if(op.mnemonic in STOP_MNEMONICS):
+            break
+        offset += op.size
+    return count
+
+
+# ----------------------------------------------------------------------
+#
+#      likely code not reached by recursive descent: offsets directly
+#      following a JMP/RTS/RTI which start a run of well scoring
+#      instructions
+#
+def find_code_starts(prg, scores, threshold=CODE_THRESHOLD, min_run=MIN_CODE_RUN):
+    prg = bytes(prg)
+    starts = []
+    for m in re.finditer(b"[\\x4C\\x60\\x40]", prg):
+        pos = m.start()
+        if(scores[pos] < threshold):
+            continue
+        start = pos + OPCODES[prg[pos]].size
+        if(start < len(prg) and start % PRG_PAGE_SIZE and
+           code_run_length(prg, scores, start, threshold) >= min_run):
+            starts.append(start)
+    return starts
+
+
+# ----------------------------------------------------------------------
+#
+#      saves the scores and queues the likely code starts in the
+#      mapped banks for analysis. unexplored bytes only, so data
+#      defined before (e.g. by a CDL file) is kept
+#
+def apply_code_scores(prg, scores):
+    import ida_auto
+    import ida_bytes
+    import ida_netnode
+    from nesldr.database import prg_bank_map, prg_offset_to_eas
+
+    node = ida_netnode.netnode(CODE_SCORES_NODE, 0, True)
+    node.setblob(scores_to_bytes(scores), 0, 'S')
+
+    bank_map = prg_bank_map()
+    count = 0
+    for offset in find_code_starts(prg, scores):
+        # every copy of a bank mapped more than once
+        for ea in prg_offset_to_eas(offset, bank_map):
+            if(not ida_bytes.is_unknown(ida_bytes.get_flags(ea))):
+                continue
+            ida_auto.auto_make_code(ea)
+            count += 1
+    return count
+
+
+# ----------------------------------------------------------------------
+#
+#      the scores saved by apply_code_scores(), None if there are none
+#
+def load_code_scores():
+    from nesldr.database import get_node_blob
+
+    blob = get_node_blob(CODE_SCORES_NODE, 'S')
+    if(blob is None):
+        return None
+    return scores_from_bytes(blob)
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+
+    parser = argparse.ArgumentParser(prog="nesldr.classify")
+    parser.add_argument("rom")
+    parser.add_argument("--threshold", type=int, default=CODE_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    image = RomImage.from_file(args.rom)
+    prg = image.prg()
+    scores = classify_prg(prg, image.mapper)
+    window_size = prg_window_size(image.mapper)
+
+    for page in range(image.prg_page_count):
+        part = scores[page * PRG_PAGE_SIZE:(page + 1) * PRG_PAGE_SIZE]
+        code = sum(1 for s in part if s >= args.threshold)
+        print("page %3d: %5d offsets score as code" % (page, code))
+    for offset in find_code_starts(prg, scores, args.threshold):
+        print("%06X  $%04X  likely code" %
+              (offset, prg_offset_to_address(len(prg), window_size, offset)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,453 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    ROM container formats besides iNES:
+
+        UNIF    "UNIF" header followed by chunks (MAPR board
+                name, PRG0..PRGF, CHR0..CHRF, NAME, MIRR, ...)
+        FDS     Famicom Disk System images, 65500 bytes per
+                disk side, with or without the 16 byte fwNES
+                header ("FDS\\x1A")
+
+    probe_format() tells the formats apart by their first 16
+    bytes. The parsers build an index of the chunks or of the
+    disk sides and their files in one pass over the block
+    headers; payloads are only sliced (memoryview) when asked
+    for. A UNIF image is converted to an iNES image for the
+    loader; the boot files of an FDS disk are mapped at their
+    load addresses ($6000-$DFFF lies in the SRAM and ROM
+    segments).
+
+    usage:
+        python -m nesldr.containers <image>...
+
+"""
+
+import argparse
+import struct
+import sys
+from collections import OrderedDict
+
+from nesldr.structs import *
+from nesldr.mappers import *
+
+
+FORMAT_INES = "iNES"
+FORMAT_UNIF = "UNIF"
+FORMAT_FDS = "FDS"
+
+INES_MAGIC = b"NES\x1A"
+UNIF_MAGIC = b"UNIF"
+FDS_MAGIC = b"FDS\x1A"
+FDS_DISK_MAGIC = b"\x01*NINTENDO-HVC*"
+
+# bytes needed by probe_format()
+PROBE_SIZE = 16
+
+UNIF_HDR_SIZE = 32
+UNIF_CHUNK_HDR_SIZE = 8
+
+FDS_HDR_SIZE = 16
+FDS_SIDE_SIZE = 65500
+
+# FDS block codes and sizes (without CRCs, as in .fds images)
+FDS_BLOCK_DISK_INFO = 1
+FDS_BLOCK_FILE_AMOUNT = 2
+FDS_BLOCK_FILE_HEADER = 3
+FDS_BLOCK_FILE_DATA = 4
+FDS_DISK_INFO_SIZE = 56
+FDS_FILE_AMOUNT_SIZE = 2
+FDS_FILE_HEADER_SIZE = 16
+
+FDS_FILE_PRG = 0
+FDS_FILE_CHR = 1
+FDS_FILE_NAMETABLE = 2
+FDS_FILE_KINDS = ("PRG", "CHR", "VRAM")
+
+# iNES mapper number reserved for the Famicom Disk System
+FDS_INES_MAPPER = 20
+
+# FDS RAM, the BIOS above it is not part of the image
+FDS_RAM_START_ADDRESS = 0x6000
+FDS_RAM_SIZE = 0x8000
+
+# vectors read by the BIOS: three NMI vectors (selected by $0100),
+# reset and IRQ
+FDS_VECTORS = (("NMI_1", 0xDFF6), ("NMI_2", 0xDFF8), ("NMI_3", 0xDFFA),
+               ("RESET", 0xDFFC), ("IRQ", 0xDFFE))
+
+# UNIF board names (without "NES-", "HVC-", "UNL-", ... prefix) -> mapper
+UNIF_BOARDS = {
+    "NROM": MAPPER_NONE, "NROM-128": MAPPER_NONE, "NROM-256": MAPPER_NONE, "RROM": MAPPER_NONE,
+    "SAROM": MAPPER_MMC1, "SBROM": MAPPER_MMC1, "SCROM": MAPPER_MMC1, "SEROM": MAPPER_MMC1,
+    "SFROM": MAPPER_MMC1, "SGROM": MAPPER_MMC1, "SHROM": MAPPER_MMC1, "SJROM": MAPPER_MMC1,
+    "SKROM": MAPPER_MMC1, "SLROM": MAPPER_MMC1, "SL1ROM": MAPPER_MMC1, "SNROM": MAPPER_MMC1,
+    "SOROM": MAPPER_MMC1, "SUROM": MAPPER_MMC1, "SXROM": MAPPER_MMC1,
+    "UNROM": MAPPER_UNROM, "UOROM": MAPPER_UNROM,
+    "CNROM": MAPPER_CNROM,
+    "TBROM": MAPPER_MMC3, "TEROM": MAPPER_MMC3, "TFROM": MAPPER_MMC3, "TGROM": MAPPER_MMC3,
+    "TKROM": MAPPER_MMC3, "TLROM": MAPPER_MMC3, "TL1ROM": MAPPER_MMC3, "TR1ROM": MAPPER_MMC3,
+    "TSROM": MAPPER_MMC3, "TVROM": MAPPER_MMC3, "B4": MAPPER_MMC3,
+    "EKROM": MAPPER_MMC5, "ELROM": MAPPER_MMC5, "ETROM": MAPPER_MMC5, "EWROM": MAPPER_MMC5,
+    "AMROM": MAPPER_AOROM, "ANROM": MAPPER_AOROM, "AN1ROM": MAPPER_AOROM, "AOROM": MAPPER_AOROM,
+    "PEEOROM": MAPPER_MMC2, "PNROM": MAPPER_MMC2,
+    "FJROM": MAPPER_MMC4, "FKROM": MAPPER_MMC4,
+    "GNROM": MAPPER_GNROM, "MHROM": MAPPER_GNROM,
+    "TC0190FMC": MAPPER_TAITO_TC0190,
+}
+
+UNIF_BOARD_PREFIXES = ("NES-", "HVC-", "UNL-", "BTL-", "BMC-", "IREM-", "KONAMI-", "TAITO-")
+
+
+class ContainerError(ValueError):
+    pass
+
+
+# ----------------------------------------------------------------------
+#
+#      the format of an image from its first PROBE_SIZE bytes, None if
+#      it is none of them
+#
+def probe_format(magic):
+    magic = bytes(magic[:PROBE_SIZE])
+    if(magic.startswith(INES_MAGIC)):
+        return FORMAT_INES
+    if(magic.startswith(UNIF_MAGIC)):
+        return FORMAT_UNIF
+    if(magic.startswith(FDS_MAGIC) or magic.startswith(FDS_DISK_MAGIC)):
+        return FORMAT_FDS
+    return None
+
+
+def unif_board_mapper(board):
+    for prefix in UNIF_BOARD_PREFIXES:
+        if(board.startswith(prefix)):
+            board = board[len(prefix):]
+            break
+    return UNIF_BOARDS.get(board)
+
+
+class UnifChunk(object):
+
+    def __init__(self, chunk_id, offset, size):
+        self.id = chunk_id
+        self.offset = offset        # of the payload
+        self.size = size
+
+    def __repr__(self):
+        return "UnifChunk(%s, %06X, %d)" % (self.id, self.offset, self.size)
+
+
+# ----------------------------------------------------------------------
+#
+#      a UNIF image with the index of its chunks
+#
+class UnifImage(object):
+
+    def __init__(self, data, name=None):
+        self.name = name
+        self.data = bytes(data)
+        self.view = memoryview(self.data)
+        if(len(self.data) < UNIF_HDR_SIZE or not self.data.startswith(UNIF_MAGIC)):
+            raise ContainerError("%s: not a UNIF image" % name)
+        self.revision = struct.unpack_from("<I", self.data, 4)[0]
+
+        self.chunks = OrderedDict()
+        pos = UNIF_HDR_SIZE
+        while(pos + UNIF_CHUNK_HDR_SIZE <= len(self.data)):
+            chunk_id, size = struct.unpack_from("<4sI", self.data, pos)
+            pos += UNIF_CHUNK_HDR_SIZE
+            if(pos + size > len(self.data)):
+                raise ContainerError("%s: chunk %r runs past the end of the file" %
+                                     (name, chunk_id))
+            self.chunks[chunk_id.decode("latin-1")] = UnifChunk(
+                chunk_id.decode("latin-1"), pos, size)
+            pos += size
+        self._prg = self._chr = None
+
+    def chunk(self, chunk_id):
+        chunk = self.chunks.get(chunk_id)
+        if(chunk is None):
+            return None
+        return self.view[chunk.offset:chunk.offset + chunk.size]
+
+    def _string(self, chunk_id):
+        data = self.chunk(chunk_id)
+        if(data is None):
+            return None
+        return bytes(data).split(b"\0", 1)[0].decode("latin-1")
+
+    def _byte(self, chunk_id, default=0):
+        data = self.chunk(chunk_id)
+        return data[0] if data is not None and len(data) else default
+
+    @property
+    def board(self):
+        return self._string("MAPR") or ""
+
+    @property
+    def title(self):
+        return self._string("NAME")
+
+    @property
+    def mapper(self):
+        return unif_board_mapper(self.board)
+
+    @property
+    def mirroring(self):
+        return self._byte("MIRR")
+
+    @property
+    def has_battery(self):
+        return bool(self._byte("BATR"))
+
+    # PRG0..PRGF / CHR0..CHRF in bank order
+    def prg_chunks(self):
+        return [self.chunk("PRG%X" % i) for i in range(16) if "PRG%X" % i in self.chunks]
+
+    def chr_chunks(self):
+        return [self.chunk("CHR%X" % i) for i in range(16) if "CHR%X" % i in self.chunks]
+
+    # the PRG/CHR data, joined on first use
+    def prg(self):
+        if(self._prg is None):
+            self._prg = b"".join(self.prg_chunks())
+        return self._prg
+
+    def chr(self):
+        if(self._chr is None):
+            self._chr = b"".join(self.chr_chunks())
+        return self._chr
+
+    # ----------------------------------------------------------------------
+    #
+    #      the equivalent iNES image. PRG-ROM and CHR-ROM are padded to
+    #      whole pages
+    #
+    def to_ines(self):
+        mapper = self.mapper
+        if(mapper is None):
+            raise ContainerError("%s: UNIF board %r has no known iNES mapper" %
+                                 (self.name, self.board))
+        prg = self.prg()
+        chr = self.chr()
+        prg_pages = -(-len(prg) // PRG_PAGE_SIZE)
+        chr_pages = -(-len(chr) // CHR_PAGE_SIZE)
+        if(prg_pages > 0xFF or chr_pages > 0xFF):
+            raise ContainerError("%s: too large for an iNES header" % self.name)
+
+        hdr = ines_hdr()
+        hdr.id = INES_MAGIC[:3]
+        hdr.term = INES_MAGIC[3]
+        hdr.prg_page_count_16k = prg_pages
+        hdr.chr_page_count_8k = chr_pages
+        # MIRR 0 is horizontal, 1 vertical, 4 four screen
+        hdr.rom_control_byte_0 = ((mapper & 0x0F) << 4) | \
+            (0x1 if self.mirroring == 1 else 0) | \
+            (0x2 if self.has_battery else 0) | \
+            (0x8 if self.mirroring == 4 else 0)
+        hdr.rom_control_byte_1 = mapper & 0xF0
+        return b"".join((bytes(hdr),
+                         prg, bytes(prg_pages * PRG_PAGE_SIZE - len(prg)),
+                         chr, bytes(chr_pages * CHR_PAGE_SIZE - len(chr))))
+
+    def __repr__(self):
+        return "UnifImage(%s, %d chunk(s))" % (self.board, len(self.chunks))
+
+
+class FdsFile(object):
+
+    def __init__(self, side, number, file_id, name, address, size, kind, offset):
+        self.side = side
+        self.number = number
+        self.file_id = file_id
+        self.name = name
+        self.address = address
+        self.size = size
+        self.kind = kind
+        self.offset = offset        # of the data in the image
+
+    @property
+    def kind_name(self):
+        return FDS_FILE_KINDS[self.kind] if self.kind < len(FDS_FILE_KINDS) else "%d" % self.kind
+
+    def __repr__(self):
+        return "FdsFile(%d:%02X %s %s $%04X, %d)" % \
+            (self.side, self.file_id, self.name, self.kind_name, self.address, self.size)
+
+
+class FdsSide(object):
+
+    def __init__(self, index, offset, game_name, side_number, disk_number, boot_file_id):
+        self.index = index
+        self.offset = offset
+        self.game_name = game_name
+        self.side_number = side_number
+        self.disk_number = disk_number
+        self.boot_file_id = boot_file_id    # files up to this ID are loaded at boot
+        self.file_count = 0                 # as listed in the file amount block
+        self.files = []                     # including hidden files
+
+    @property
+    def label(self):
+        return "disk %d side %s" % (self.disk_number + 1, "AB"[self.side_number & 1])
+
+    def boot_files(self):
+        return [f for f in self.files[:self.file_count] if f.file_id <= self.boot_file_id]
+
+
+# ----------------------------------------------------------------------
+#
+#      a Famicom Disk System image with the index of its sides and files
+#
+class FdsImage(object):
+
+    def __init__(self, data, name=None):
+        self.name = name
+        self.data = bytes(data)
+        self.view = memoryview(self.data)
+        start = FDS_HDR_SIZE if self.data.startswith(FDS_MAGIC) else 0
+        if(not self.data.startswith(FDS_DISK_MAGIC, start)):
+            raise ContainerError("%s: not an FDS image" % name)
+
+        self.sides = []
+        for offset in range(start, len(self.data), FDS_SIDE_SIZE):
+            if(not self.data.startswith(FDS_DISK_MAGIC, offset)):
+                break
+            self.sides.append(self._read_side(len(self.sides), offset))
+
+    def _read_side(self, index, offset):
+        data = self.data
+        end = min(offset + FDS_SIDE_SIZE, len(data))
+        side = FdsSide(index, offset, data[offset + 16:offset + 19].decode("latin-1"),
+                       data[offset + 21], data[offset + 22], data[offset + 25])
+        pos = offset + FDS_DISK_INFO_SIZE
+        if(pos + FDS_FILE_AMOUNT_SIZE > end or data[pos] != FDS_BLOCK_FILE_AMOUNT):
+            return side
+        side.file_count = data[pos + 1]
+        pos += FDS_FILE_AMOUNT_SIZE
+
+        # files after file_count are read too, some games load them
+        while(pos + FDS_FILE_HEADER_SIZE < end and data[pos] == FDS_BLOCK_FILE_HEADER):
+            number, file_id, file_name, address, size, kind = \
+                struct.unpack_from("<BB8sHHB", data, pos + 1)
+            pos += FDS_FILE_HEADER_SIZE
+            if(pos + 1 + size > end or data[pos] != FDS_BLOCK_FILE_DATA):
+                break
+            side.files.append(FdsFile(index, number, file_id,
+                                      file_name.decode("latin-1").rstrip("\0 "),
+                                      address, size, kind, pos + 1))
+            pos += 1 + size
+        return side
+
+    def side_data(self, index):
+        side = self.sides[index]
+        return self.view[side.offset:side.offset + FDS_SIDE_SIZE]
+
+    def file_data(self, f):
+        return self.view[f.offset:f.offset + f.size]
+
+    # ----------------------------------------------------------------------
+    #
+    #      the PRG files loaded by the BIOS at boot from a side, as
+    #      [(address, file offset, size)] in load order, clipped to the
+    #      FDS RAM
+    #
+    def boot_loads(self, index=0):
+        loads = []
+        for f in self.sides[index].boot_files():
+            if(f.kind != FDS_FILE_PRG):
+                continue
+            start = max(f.address, FDS_RAM_START_ADDRESS)
+            end = min(f.address + f.size, FDS_RAM_START_ADDRESS + FDS_RAM_SIZE)
+            if(start < end):
+                loads.append((start, f.offset + start - f.address, end - start))
+        return loads
+
+    # ----------------------------------------------------------------------
+    #
+    #      the vectors set by the boot files of a side as [(name, vector
+    #      address, handler address)]. later files overwrite earlier ones
+    #
+    def boot_vectors(self, index=0):
+        memory = {}
+        for address, offset, size in self.boot_loads(index):
+            for name, vector in FDS_VECTORS:
+                for a in (vector, vector + 1):
+                    if(address <= a < address + size):
+                        memory[a] = self.data[offset + a - address]
+        return [(name, vector, memory[vector] | (memory[vector + 1] << 8))
+                for name, vector in FDS_VECTORS
+                if vector in memory and vector + 1 in memory]
+
+    # an iNES header of mapper 20 without PRG-ROM and CHR-ROM, for
+    # code expecting an iNES image
+    def ines_header(self):
+        hdr = ines_hdr()
+        hdr.id = INES_MAGIC[:3]
+        hdr.term = INES_MAGIC[3]
+        hdr.rom_control_byte_0 = (FDS_INES_MAPPER & 0x0F) << 4
+        hdr.rom_control_byte_1 = FDS_INES_MAPPER & 0xF0
+        return bytes(hdr)
+
+    def __repr__(self):
+        return "FdsImage(%d side(s))" % len(self.sides)
+
+
+# ----------------------------------------------------------------------
+#
+#      opens an image of any of the formats. iNES images are returned
+#      as RomImage
+#
+def open_image(data, name=None):
+    from nesldr.rom import RomImage
+
+    kind = probe_format(data)
+    if(kind == FORMAT_INES):
+        return RomImage(data, name)
+    if(kind == FORMAT_UNIF):
+        return UnifImage(data, name)
+    if(kind == FORMAT_FDS):
+        return FdsImage(data, name)
+    raise ContainerError("%s: unknown image format" % name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nesldr.containers")
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args(argv)
+
+    status = 0
+    for path in args.paths:
+        try:
+            with open(path, "rb") as f:
+                image = open_image(f.read(), path)
+        except (OSError, ValueError) as e:
+            sys.stderr.write("%s\n" % e)
+            status = 1
+            continue
+        if(isinstance(image, UnifImage)):
+            print("%s: UNIF rev %d, board %s (mapper %s)%s" %
+                  (path, image.revision, image.board,
+                   "?" if image.mapper is None else image.mapper,
+                   ", %s" % image.title if image.title else ""))
+            for chunk in image.chunks.values():
+                print("  %-4s %06X %7d" % (chunk.id, chunk.offset, chunk.size))
+        elif(isinstance(image, FdsImage)):
+            print("%s: FDS, %d side(s)" % (path, len(image.sides)))
+            for side in image.sides:
+                print("  %s, %s, %d file(s) (%d listed), boot files up to $%02X" %
+                      (side.label, side.game_name, len(side.files), side.file_count,
+                       side.boot_file_id))
+                for f in side.files:
+                    print("    %02X %-8s %-4s $%04X %5d" %
+                          (f.file_id, f.name, f.kind_name, f.address, f.size))
+        else:
+            print("%s: iNES, mapper %d" % (path, image.mapper))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,556 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    6502 cycle counts of the interrupt handlers. The code
+    reachable from a handler is split into basic blocks; every
+    instruction costs its base cycles plus one if an indexed
+    operand can cross a page (never for $nn00,X/Y) and STA
+    $4014 stalls the CPU for the sprite DMA. Taken branches
+    cost one more cycle, two if the target is on another page
+    than the next instruction. JSR adds the cost of the called
+    routine.
+
+    The best and worst case from a handler to its return are
+    summed over the block graph with every loop body counted
+    once, so the worst case of a handler with loops is a lower
+    bound. For the NMI handler the worst case plus the
+    interrupt sequence is compared to the vblank time.
+
+    Results are cached per routine. When bytes change, only
+    the routines containing them are decoded again; the totals
+    of their callers are summed again from the cached blocks.
+
+    usage:
+        python -m nesldr.cycles <rom.nes> [--pal] [--blocks]
+
+"""
+
+import argparse
+import re
+import sys
+
+from nesldr.structs import *
+from nesldr.opcodes import *
+
+
+# CPU cycles between the start of vblank and the start of rendering:
+# 20 (PAL: 70) scanlines of 341 PPU dots, 3 (PAL: 3.2) dots per cycle
+NTSC_VBLANK_CYCLES = 2273
+PAL_VBLANK_CYCLES = 7459
+
+# pushing PC and P and reading the vector
+INTERRUPT_CYCLES = 7
+
+# writing $4014 halts the CPU for the sprite DMA
+OAM_DMA_ADDRESS = 0x4014
+OAM_DMA_CYCLES = (513, 514)
+
+INTERRUPT_VECTORS = (("NMI", NMI_VECTOR_START_ADDRESS),
+                     ("RESET", RESET_VECTOR_START_ADDRESS),
+                     ("IRQ", IRQ_VECTOR_START_ADDRESS))
+
+# interval of the comment refresh of watch_cycle_counts(), in ms
+CYCLE_REFRESH_INTERVAL = 500
+
+# the comment lines written by apply_cycle_counts()
+CYCLE_COMMENT_RE = re.compile(r"^(cycles \d+-\d+, to return \d+-\d+"
+                              r"|(NMI|RESET|IRQ): \d+-\d+ cycles\b.*)$")
+
+
+def page_of(address):
+    return address & 0xFF00
+
+
+# ----------------------------------------------------------------------
+#
+#      best and worst case cycles of one instruction, without the
+#      branch penalty
+#
+def instruction_cycles(op, operand):
+    best = worst = op.cycles
+    if(op.page_penalty and (op.mode == MODE_IZY or operand & 0xFF)):
+        worst += 1
+    if(operand == OAM_DMA_ADDRESS and op.mode == MODE_ABS and op.mnemonic in STORE_MNEMONICS):
+        best += OAM_DMA_CYCLES[0]
+        worst += OAM_DMA_CYCLES[1]
+    return best, worst
+
+
+# ----------------------------------------------------------------------
+#
+#      extra cycles of a taken branch at address
+#
+def branch_penalty(address, target):
+    return 1 if page_of(address + 2) == page_of(target) else 2
+
+
+# ----------------------------------------------------------------------
+#
+#      the 64k CPU address space with the PRG-ROM banks mapped in.
+#      code is only decoded in mapped 8k slots
+#
+class CpuMemory(object):
+
+    def __init__(self, data, mapped):
+        self.data = bytearray(data)
+        self.mapped = frozenset(mapped)
+
+    # the banks the loader maps (see LoadSession.bank_plan())
+    @classmethod
+    def from_session(cls, session):
+        data = bytearray(0x10000)
+        mapped = []
+        prg = session.prg()
+        for load in session.bank_plan() or ():
+            if(load.chr):
+                continue
+            chunk = prg[load.offset:load.offset + load.size]
+            data[load.address:load.address + len(chunk)] = chunk
+            mapped.extend(range(load.address, load.address + len(chunk), PRG_BANK_MAP_SLOT_SIZE))
+        return cls(data, mapped)
+
+    # the ROM segment of the database, including patches
+    @classmethod
+    def from_database(cls):
+        import ida_bytes
+        from nesldr.database import prg_bank_map
+
+        data = bytearray(0x10000)
+        mapped = list(prg_bank_map())
+        for slot in mapped:
+            data[slot:slot + PRG_BANK_MAP_SLOT_SIZE] = \
+                ida_bytes.get_bytes(slot, PRG_BANK_MAP_SLOT_SIZE) or bytes(PRG_BANK_MAP_SLOT_SIZE)
+        return cls(data, mapped)
+
+    def is_mapped(self, address):
+        return address - address % PRG_BANK_MAP_SLOT_SIZE in self.mapped
+
+    def word(self, address):
+        return self.data[address] | (self.data[(address + 1) & 0xFFFF] << 8)
+
+    # ----------------------------------------------------------------------
+    #
+    #      decodes the instruction at address. (None, None) if it is not
+    #      a documented opcode or not completely in mapped memory
+    #
+    def decode(self, address):
+        if(not self.is_mapped(address)):
+            return None, None
+        op, operand = decode(self.data, address)
+        if(op is None or not self.is_mapped(address + op.size - 1)):
+            return None, None
+        return op, operand
+
+
+class BasicBlock(object):
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start            # address after the last instruction
+        self.best = 0               # cycles of the own instructions
+        self.worst = 0
+        self.instructions = []      # (address, Opcode, best, worst)
+        self.edges = []             # (target, best extra, worst extra)
+        self.calls = []             # JSR targets
+        self.unresolved = False     # JMP (ind), BRK, undecodable code
+
+    def __repr__(self):
+        return "BasicBlock(%04X-%04X, %d-%d)" % (self.start, self.end, self.best, self.worst)
+
+
+# ----------------------------------------------------------------------
+#
+#      the blocks of the routine at entry and the best/worst cycles from
+#      its entry (and from every block) to its end. the totals are None
+#      until summed by CycleAnalysis
+#
+class RoutineCycles(object):
+
+    def __init__(self, entry, blocks):
+        self.entry = entry
+        self.blocks = blocks        # {start: BasicBlock}
+        self.best = None
+        self.worst = None
+        self.block_totals = {}      # {start: (best, worst)}
+        self.loops = False          # loop bodies counted once
+        self.incomplete = False     # unresolved jumps, recursion
+
+    @property
+    def callees(self):
+        return set(target for block in self.blocks.values() for target in block.calls)
+
+    # addresses of all instruction bytes
+    def extent(self):
+        for block in self.blocks.values():
+            for address, op, _, _ in block.instructions:
+                for i in range(op.size):
+                    yield (address + i) & 0xFFFF
+
+    def __repr__(self):
+        return "RoutineCycles(%04X, %d block(s), %s-%s)" % \
+            (self.entry, len(self.blocks), self.best, self.worst)
+
+
+# ----------------------------------------------------------------------
+#
+#      decodes the routine at entry into basic blocks. JSR continues
+#      with the next instruction, JMP abs is followed, JMP (ind), RTS,
+#      RTI and BRK end a path
+#
+def decode_routine(memory, entry):
+    leaders = set([entry])
+    decoded = {}
+    todo = [entry]
+    while(todo):
+        address = todo.pop()
+        while(address not in decoded):
+            op, operand = memory.decode(address)
+            decoded[address] = (op, operand)
+            if(op is None):
+                break
+            next_address = address + op.size
+            if(op.mnemonic in BRANCH_MNEMONICS):
+                target = branch_target(address, operand)
+                leaders.update((target, next_address))
+                todo.append(target)
+            elif(op.mnemonic == "JMP"):
+                if(op.mode == MODE_ABS):
+                    leaders.add(operand)
+                    todo.append(operand)
+                break
+            elif(op.mnemonic in STOP_MNEMONICS):
+                break
+            address = next_address
+
+    blocks = {}
+    for start in leaders:
+        if(start not in decoded):
+            continue
+        block = BasicBlock(start)
+        address = start
+        while(True):
+            op, operand = decoded.get(address, (None, None))
+            if(op is None):
+                block.unresolved = True
+                break
+            best, worst = instruction_cycles(op, operand)
+            block.instructions.append((address, op, best, worst))
+            block.best += best
+            block.worst += worst
+            if(op.mnemonic in BRANCH_MNEMONICS):
+                target = branch_target(address, operand)
+                penalty = branch_penalty(address, target)
+                address += op.size
+                block.edges.append((address, 0, 0))
+                block.edges.append((target, penalty, penalty))
+                break
+            address += op.size
+            if(op.mnemonic == "JSR"):
+                block.calls.append(operand)
+            elif(op.mnemonic == "JMP"):
+                if(op.mode == MODE_ABS):
+                    block.edges.append((operand, 0, 0))
+                else:
+                    block.unresolved = True
+                break
+            elif(op.mnemonic in STOP_MNEMONICS):
+                block.unresolved = op.mnemonic == "BRK"
+                break
+            if(address in leaders):
+                block.edges.append((address, 0, 0))
+                break
+        block.end = address
+        blocks[start] = block
+    return RoutineCycles(entry, blocks)
+
+
+# ----------------------------------------------------------------------
+#
+#      cycle counts of all routines reached from the handlers, cached
+#      per routine
+#
+class CycleAnalysis(object):
+
+    def __init__(self, memory):
+        self.memory = memory
+        self._routines = {}         # {entry: RoutineCycles}
+        self._owners = {}           # {address: set of routine entries}
+        self._callers = {}          # {entry: set of caller entries}
+        self._active = set()
+
+    def handlers(self):
+        return [(name, self.memory.word(vector)) for name, vector in INTERRUPT_VECTORS]
+
+    # ----------------------------------------------------------------------
+    #
+    #      the routine at entry with its totals, decoded and summed only
+    #      if not cached
+    #
+    def routine(self, entry):
+        routine = self._routines.get(entry)
+        if(routine is None):
+            routine = decode_routine(self.memory, entry)
+            self._routines[entry] = routine
+            for address in routine.extent():
+                self._owners.setdefault(address, set()).add(entry)
+            for callee in routine.callees:
+                self._callers.setdefault(callee, set()).add(entry)
+        if(routine.best is None and entry not in self._active):
+            self._active.add(entry)
+            try:
+                self._sum(routine)
+            finally:
+                self._active.discard(entry)
+        return routine
+
+    # ----------------------------------------------------------------------
+    #
+    #      sums the best and worst case from every block to the end of the
+    #      routine. edges closing a loop (back edges of a depth first
+    #      search) are ignored, the rest is summed in post order
+    #
+    def _sum(self, routine):
+        blocks = routine.blocks
+        routine.loops = routine.incomplete = False
+        call_cost = {}
+        for block in blocks.values():
+            best = worst = 0
+            for callee in block.calls:
+                if(callee in self._active):
+                    routine.incomplete = True
+                    continue
+                called = self.routine(callee)
+                best += called.best
+                worst += called.worst
+                routine.incomplete |= called.incomplete
+                routine.loops |= called.loops
+            call_cost[block.start] = (best, worst)
+            routine.incomplete |= block.unresolved
+
+        totals = {}
+        state = {}
+        stack = [(routine.entry, iter(blocks[routine.entry].edges))] if routine.entry in blocks else []
+        state[routine.entry] = 1
+        while(stack):
+            start, edges = stack[-1]
+            for target, _, _ in edges:
+                if(target not in blocks):
+                    routine.incomplete = True
+                elif(state.get(target) == 1):
+                    routine.loops = True
+                elif(target not in state):
+                    state[target] = 1
+                    stack.append((target, iter(blocks[target].edges)))
+                    break
+            else:
+                stack.pop()
+                state[start] = 2
+                block = blocks[start]
+                paths = [(extra_best + totals[target][0], extra_worst + totals[target][1])
+                         for target, extra_best, extra_worst in block.edges
+                         if target in totals]
+                best = block.best + call_cost[start][0] + min([p[0] for p in paths] or [0])
+                worst = block.worst + call_cost[start][1] + max([p[1] for p in paths] or [0])
+                totals[start] = (best, worst)
+
+        routine.block_totals = totals
+        routine.best, routine.worst = totals.get(routine.entry, (0, 0))
+
+    # ----------------------------------------------------------------------
+    #
+    #      drops the routines with instructions in [address, address + size)
+    #      and the totals of everything calling them. returns the entries
+    #      of the dropped routines
+    #
+    def invalidate(self, address, size=1):
+        dropped = set()
+        for a in range(address, address + size):
+            dropped.update(self._owners.get(a & 0xFFFF, ()))
+        for entry in dropped:
+            routine = self._routines.pop(entry)
+            for a in routine.extent():
+                owners = self._owners.get(a)
+                if(owners is not None):
+                    owners.discard(entry)
+                    if(not owners):
+                        del self._owners[a]
+            for callee in routine.callees:
+                self._callers.get(callee, set()).discard(entry)
+
+        todo = list(dropped)
+        seen = set(dropped)
+        while(todo):
+            for caller in self._callers.get(todo.pop(), ()):
+                if(caller not in seen):
+                    seen.add(caller)
+                    todo.append(caller)
+                    if(caller in self._routines):
+                        self._routines[caller].best = None
+        return dropped
+
+    # changes bytes of the memory and invalidates what they affect
+    def update(self, address, data):
+        self.memory.data[address:address + len(data)] = data
+        return self.invalidate(address, len(data))
+
+
+def vblank_cycles(pal=False):
+    return PAL_VBLANK_CYCLES if pal else NTSC_VBLANK_CYCLES
+
+
+# ----------------------------------------------------------------------
+#
+#      one line summary of a handler. for the NMI the worst case is
+#      compared to the vblank time; with loops or unknown code it is
+#      only a lower bound and cannot prove the handler fits
+#
+def describe_handler(name, routine, pal=False):
+    text = "%s: %d-%d cycles" % (name, routine.best, routine.worst)
+    if(name != "RESET"):
+        text += " (+%d interrupt)" % INTERRUPT_CYCLES
+    if(name == "NMI"):
+        budget = vblank_cycles(pal)
+        used = routine.worst + INTERRUPT_CYCLES
+        text += ", %s vblank %d: " % ("PAL" if pal else "NTSC", budget)
+        if(used > budget):
+            text += "OVER by %d" % (used - budget)
+        elif(routine.loops or routine.incomplete):
+            text += "lower bound, may exceed vblank"
+        else:
+            text += "fits by %d" % (budget - used)
+    if(routine.loops):
+        text += ", loops counted once"
+    if(routine.incomplete):
+        text += ", incomplete"
+    return text
+
+
+# the comment with the cycle count line replaced by text (removed if
+# text is None), user written lines are kept
+def cycle_comment(comment, text=None):
+    lines = [line for line in (comment or "").split("\n")
+             if line and not CYCLE_COMMENT_RE.match(line)]
+    if(text is not None):
+        lines.append(text)
+    return "\n".join(lines)
+
+
+# ----------------------------------------------------------------------
+#
+#      comments the handlers with their totals and every block reached
+#      from them with its own and remaining cycles. only the lines this
+#      function writes are replaced; those set by an earlier call
+#      (previous) which are no longer valid are removed. returns the
+#      addresses commented
+#
+def apply_cycle_counts(analysis, pal=False, previous=()):
+    import ida_bytes
+
+    comments = {}
+    lines = []
+    done = set()
+    for name, entry in analysis.handlers():
+        if(not analysis.memory.is_mapped(entry)):
+            continue
+        routine = analysis.routine(entry)
+        lines.append(describe_handler(name, routine, pal))
+        todo = [entry]
+        while(todo):
+            routine = analysis.routine(todo.pop())
+            if(routine.entry in done):
+                continue
+            done.add(routine.entry)
+            todo.extend(routine.callees)
+            for start, block in routine.blocks.items():
+                best, worst = routine.block_totals.get(start, (0, 0))
+                comments[start] = "cycles %d-%d, to return %d-%d" % \
+                    (block.best, block.worst, best, worst)
+        comments[entry] = lines[-1]
+
+    updates = dict.fromkeys(set(previous) - set(comments))
+    updates.update(comments)
+    for address, text in updates.items():
+        comment = ida_bytes.get_cmt(address, False) or ""
+        updated = cycle_comment(comment, text)
+        if(updated != comment):
+            ida_bytes.set_cmt(address, updated, False)
+    return lines, set(comments)
+
+
+# ----------------------------------------------------------------------
+#
+#      comments the cycle counts of the database and keeps them up to
+#      date while bytes are patched. returns the watcher, stop() ends it
+#
+def watch_cycle_counts(pal=False):
+    import ida_bytes
+    import ida_idp
+    import ida_kernwin
+
+    class CycleWatcher(ida_idp.IDB_Hooks):
+
+        def __init__(self):
+            ida_idp.IDB_Hooks.__init__(self)
+            self.analysis = CycleAnalysis(CpuMemory.from_database())
+            self.lines, self.commented = apply_cycle_counts(self.analysis, pal)
+            self.dirty = False
+            self.timer = ida_kernwin.register_timer(CYCLE_REFRESH_INTERVAL, self.refresh)
+
+        def byte_patched(self, ea, old_value):
+            if(self.analysis.update(ea, bytes((ida_bytes.get_byte(ea),)))):
+                self.dirty = True
+            return 0
+
+        # summed at most every CYCLE_REFRESH_INTERVAL, not per byte
+        def refresh(self):
+            if(self.dirty):
+                self.dirty = False
+                self.lines, self.commented = apply_cycle_counts(self.analysis, pal,
+                                                                self.commented)
+            return CYCLE_REFRESH_INTERVAL
+
+        def stop(self):
+            self.unhook()
+            ida_kernwin.unregister_timer(self.timer)
+
+    watcher = CycleWatcher()
+    watcher.hook()
+    return watcher
+
+
+def main(argv=None):
+    from nesldr.session import LoadSession
+
+    parser = argparse.ArgumentParser(prog="nesldr.cycles")
+    parser.add_argument("rom")
+    parser.add_argument("--pal", action="store_true", help="PAL vblank time (default: iNES byte 9)")
+    parser.add_argument("--blocks", action="store_true", help="print every basic block")
+    args = parser.parse_args(argv)
+
+    session = LoadSession.from_file(args.rom)
+    if(session.bank_plan() is None):
+        sys.stderr.write("%s: mapper %d not supported\n" % (args.rom, session.mapper))
+        return 1
+    analysis = CycleAnalysis(CpuMemory.from_session(session))
+    pal = args.pal or session.is_pal
+    for name, entry in analysis.handlers():
+        if(not analysis.memory.is_mapped(entry)):
+            print("%s: $%04X not mapped" % (name, entry))
+            continue
+        routine = analysis.routine(entry)
+        print("%s at $%04X, %s" % (name, entry, describe_handler(name, routine, pal)))
+        if(not args.blocks):
+            continue
+        for start in sorted(routine.blocks):
+            block = routine.blocks[start]
+            best, worst = routine.block_totals.get(start, (0, 0))
+            print("  $%04X-$%04X  %4d-%-4d  to return %5d-%-5d%s" %
+                  (start, block.end - 1, block.best, block.worst, best, worst,
+                   "".join("  JSR $%04X" % c for c in block.calls)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Local query daemon keeping an index of a ROM tree in
+    memory. Every image (.nes files and archive members) is
+    parsed once: header fields, mapper, the banks the loader
+    maps and the sha-256 of every PRG and CHR page (the hashes
+    of nesldr/bankstore.py). Queries are answered from that
+    index over a Unix socket, one JSON object per line:
+
+        {"op": "info", "rom": <path or sha1>}
+        {"op": "hashes", "rom": ...}
+        {"op": "page", "rom": ..., "kind": "prg"|"chr", "index": n}
+        {"op": "by_mapper", "mapper": n}
+        {"op": "by_hash", "hash": <sha1 of an image or page hash>}
+        {"op": "stats"} / {"op": "errors"} / {"op": "refresh"}
+
+    Replies are {"ok": true, ...} or {"ok": false, "error": ...}.
+    Page bytes are base64 encoded; the images of the last
+    pages asked for are kept in a small cache.
+
+    The tree is scanned again every few seconds in a worker
+    thread. Only files whose size or modification time changed
+    are parsed again, then the index is updated in one step
+    between queries.
+
+    usage:
+        python -m nesldr.daemon serve <rom dir> [--socket <path>] [--interval N]
+        python -m nesldr.daemon query <op> [key=value...] [--socket <path>]
+
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+from collections import OrderedDict
+
+from nesldr.structs import *
+from nesldr.mappers import mapper_names, MAPPER_LAST, MAPPER_NOT_SUPPORTED
+from nesldr.archive import is_rom_name, is_archive_file
+from nesldr.rom import RomImage, iter_rom_images
+from nesldr.session import plan_banks
+from nesldr.bankstore import page_hash, PAGE_PRG, PAGE_CHR
+
+
+DAEMON_SOCKET_ENV = "NESLDR_DAEMON_SOCKET"
+
+# seconds between two scans of the tree
+DAEMON_REFRESH_INTERVAL = 5
+
+# images kept in memory for page queries
+DAEMON_CACHED_IMAGES = 16
+
+
+class QueryError(Exception):
+    pass
+
+
+def default_socket_path():
+    return os.environ.get(DAEMON_SOCKET_ENV) or \
+        os.path.join(tempfile.gettempdir(), "nesldr-%d.sock" % os.getuid())
+
+
+def _mapper_name(mapper):
+    return MAPPER_NOT_SUPPORTED if mapper > MAPPER_LAST else mapper_names[mapper]
+
+
+# ----------------------------------------------------------------------
+#
+#      everything the daemon answers about one image, computed once
+#
+class RomEntry(object):
+
+    def __init__(self, name, path, image):
+        hdr = image.hdr
+        cb0 = hdr.rom_control_byte_0
+        self.name = name
+        self.path = path            # file the image was read from
+        self.size = len(image.data)
+        self.sha1 = hashlib.sha1(image.data).hexdigest()
+        self.mapper = image.mapper
+        self.prg_hashes = [page_hash(p) for p in image.prg_pages()]
+        self.chr_hashes = [page_hash(p) for p in image.chr_pages()]
+        plan = plan_banks(image.mapper, hdr.prg_page_count_16k)
+        self.info = {
+            "name": name, "size": self.size, "sha1": self.sha1,
+            "mapper": image.mapper, "mapper_name": _mapper_name(image.mapper),
+            "prg_pages": hdr.prg_page_count_16k, "chr_pages": hdr.chr_page_count_8k,
+            "prg_pages_present": image.prg_page_count, "chr_pages_present": image.chr_page_count,
+            "mirroring": "horizontal" if INES_MASK_H_MIRRORING(cb0) else "vertical",
+            "sram": bool(INES_MASK_SRAM(cb0)), "trainer": image.has_trainer,
+            "four_screen": bool(INES_MASK_VRAM_LAYOUT(cb0)),
+            "corrupt_header": bool(hdr.is_corrupt_ines_hdr()),
+            "banks": None if plan is None else
+            [{"address": load.address, "offset": load.offset, "size": load.size,
+              "kind": PAGE_CHR if load.chr else PAGE_PRG} for load in plan],
+        }
+
+
+# ----------------------------------------------------------------------
+#
+#      the index of a ROM tree. scan() only reads the file system and
+#      parses images, apply() updates the lookup tables; the daemon
+#      runs the first in a worker thread and the second in its loop
+#
+class RomIndex(object):
+
+    def __init__(self, root):
+        self.root = root
+        self.files = {}             # {path: ((size, mtime), [RomEntry])}
+        self.entries = {}           # {name: RomEntry}
+        self.by_sha1 = {}           # {sha1: set of names}
+        self.by_mapper = {}         # {mapper: set of names}
+        self.by_page = {}           # {page hash: set of (name, kind, index)}
+        self.errors = {}            # {name: message}
+        self._images = OrderedDict()
+
+    # ----------------------------------------------------------------------
+    #
+    #      finds new, changed and removed files. returns (changed, removed)
+    #      with changed as {path: (signature, [RomEntry], {name: error})}
+    #
+    def scan(self, known=None):
+        known = dict(self.files if known is None else known)
+        changed = {}
+        seen = set()
+        for root, _, names in os.walk(self.root):
+            for n in sorted(names):
+                path = os.path.join(root, n)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                signature = (st.st_size, st.st_mtime_ns)
+                if(path in known and known[path][0] == signature):
+                    seen.add(path)
+                    continue
+                if(not is_rom_name(path) and not is_archive_file(path)):
+                    continue
+                seen.add(path)
+                changed[path] = self._parse(path, signature)
+        removed = [path for path in known if path not in seen]
+        return changed, removed
+
+    # ----------------------------------------------------------------------
+    #
+    #      the images of one file. a file which can not be read only
+    #      gets an entry in errors, it never stops the scan
+    #
+    def _parse(self, path, signature):
+        entries = []
+        errors = {}
+        try:
+            for name, image in iter_rom_images([path]):
+                if(isinstance(image, Exception)):
+                    errors[name] = str(image)
+                else:
+                    entries.append(RomEntry(name, path, image))
+        except Exception as e:
+            errors[path] = "%s: %s" % (type(e).__name__, e)
+        return signature, entries, errors
+
+    def _remove_file(self, path):
+        _, entries = self.files.pop(path, (None, ()))
+        for entry in entries:
+            self.entries.pop(entry.name, None)
+            self._images.pop(entry.name, None)
+            self.by_sha1.get(entry.sha1, set()).discard(entry.name)
+            self.by_mapper.get(entry.mapper, set()).discard(entry.name)
+            for kind, hashes in ((PAGE_PRG, entry.prg_hashes), (PAGE_CHR, entry.chr_hashes)):
+                for i, digest in enumerate(hashes):
+                    self.by_page.get(digest, set()).discard((entry.name, kind, i))
+        for name in [n for n in self.errors if n == path or n.startswith(path + "!")]:
+            del self.errors[name]
+
+    def apply(self, changed, removed):
+        for path in removed:
+            self._remove_file(path)
+        for path, (signature, entries, errors) in changed.items():
+            self._remove_file(path)
+            self.files[path] = (signature, entries)
+            self.errors.update(errors)
+            for entry in entries:
+                self.entries[entry.name] = entry
+                self.by_sha1.setdefault(entry.sha1, set()).add(entry.name)
+                self.by_mapper.setdefault(entry.mapper, set()).add(entry.name)
+                for kind, hashes in ((PAGE_PRG, entry.prg_hashes),
+                                     (PAGE_CHR, entry.chr_hashes)):
+                    for i, digest in enumerate(hashes):
+                        self.by_page.setdefault(digest, set()).add((entry.name, kind, i))
+        return len(changed), len(removed)
+
+    def refresh(self):
+        return self.apply(*self.scan())
+
+    # an image by name (as indexed, or a path below the root) or sha1
+    def find(self, key):
+        entry = self.entries.get(key)
+        if(entry is None and key is not None):
+            entry = self.entries.get(os.path.join(self.root, key))
+        if(entry is None):
+            names = self.by_sha1.get(key)
+            if(names):
+                entry = self.entries[min(names)]
+        if(entry is None):
+            raise QueryError("unknown ROM %r" % key)
+        return entry
+
+    # ----------------------------------------------------------------------
+    #
+    #      one page of an image. the image is read again from its file,
+    #      recently used images are cached
+    #
+    def page(self, entry, kind, index):
+        image = self._images.pop(entry.name, None)
+        if(image is None):
+            image = RomImage.from_file(entry.name)
+        self._images[entry.name] = image
+        while(len(self._images) > DAEMON_CACHED_IMAGES):
+            self._images.popitem(last=False)
+        try:
+            return image.prg_page(index) if kind == PAGE_PRG else image.chr_page(index)
+        except IndexError as e:
+            raise QueryError(str(e))
+
+
+# ----------------------------------------------------------------------
+#
+#      answers one request
+#
+def handle_query(index, request):
+    op = request.get("op")
+    if(op == "info"):
+        return {"rom": index.find(request.get("rom")).info}
+    if(op == "hashes"):
+        entry = index.find(request.get("rom"))
+        return {"sha1": entry.sha1, "prg": entry.prg_hashes, "chr": entry.chr_hashes}
+    if(op == "page"):
+        entry = index.find(request.get("rom"))
+        kind = request.get("kind", PAGE_PRG)
+        if(kind not in (PAGE_PRG, PAGE_CHR)):
+            raise QueryError("kind must be %r or %r" % (PAGE_PRG, PAGE_CHR))
+        data = index.page(entry, kind, int(request.get("index", 0)))
+        return {"data": base64.b64encode(data).decode("ascii")}
+    if(op == "by_mapper"):
+        return {"roms": sorted(index.by_mapper.get(int(request.get("mapper", -1)), ()))}
+    if(op == "by_hash"):
+        digest = request.get("hash")
+        if(digest in index.by_sha1):
+            return {"roms": sorted(index.by_sha1[digest])}
+        return {"pages": [{"rom": name, "kind": kind, "index": i}
+                          for name, kind, i in sorted(index.by_page.get(digest, ()))]}
+    if(op == "stats"):
+        return {"files": len(index.files), "roms": len(index.entries),
+                "pages": len(index.by_page), "errors": len(index.errors)}
+    if(op == "errors"):
+        return {"errors": dict(index.errors)}
+    raise QueryError("unknown op %r" % op)
+
+
+class QueryDaemon(object):
+
+    def __init__(self, index, path, interval=DAEMON_REFRESH_INTERVAL):
+        self.index = index
+        self.path = path
+        self.interval = interval
+        self._lock = None
+
+    # scans in a worker thread, applies in the loop
+    async def refresh(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            changed, removed = await loop.run_in_executor(None, self.index.scan,
+                                                          dict(self.index.files))
+            return self.index.apply(changed, removed)
+
+    async def _refresh_loop(self):
+        while(True):
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                sys.stderr.write("refresh failed: %s\n" % e)
+
+    async def _handle(self, reader, writer):
+        try:
+            while(True):
+                line = await reader.readline()
+                if(not line):
+                    break
+                try:
+                    request = json.loads(line)
+                    if(request.get("op") == "refresh"):
+                        changed, removed = await self.refresh()
+                        reply = {"changed": changed, "removed": removed}
+                    else:
+                        reply = handle_query(self.index, request)
+                    reply["ok"] = True
+                except QueryError as e:
+                    reply = {"ok": False, "error": str(e)}
+                except Exception as e:
+                    # a bad request must not cost the client its reply
+                    reply = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+                writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self._lock = asyncio.Lock()
+        await self.refresh()
+        if(os.path.exists(self.path)):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self._handle, self.path)
+        os.chmod(self.path, 0o600)
+        refresher = asyncio.ensure_future(self._refresh_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            refresher.cancel()
+            if(os.path.exists(self.path)):
+                os.remove(self.path)
+
+
+# ----------------------------------------------------------------------
+#
+#      sends one request to a running daemon and returns the reply
+#
+def query(request, path=None):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path or default_socket_path())
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        reply = b""
+        while(not reply.endswith(b"\n")):
+            data = client.recv(0x10000)
+            if(not data):
+                break
+            reply += data
+    finally:
+        client.close()
+    return json.loads(reply)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nesldr.daemon")
+    parser.add_argument("--socket", default=None, help="default: $%s or a per-user path in "
+                        "the temp directory" % DAEMON_SOCKET_ENV)
+    sub = parser.add_subparsers(dest="command")
+    serve = sub.add_parser("serve")
+    serve.add_argument("root")
+    serve.add_argument("--interval", type=float, default=DAEMON_REFRESH_INTERVAL)
+    ask = sub.add_parser("query")
+    ask.add_argument("op")
+    ask.add_argument("args", nargs="*", help="key=value")
+    args = parser.parse_args(argv)
+
+    path = args.socket or default_socket_path()
+    if(args.command == "serve"):
+        daemon = QueryDaemon(RomIndex(args.root), path, args.interval)
+        try:
+            asyncio.run(daemon.serve())
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if(args.command == "query"):
+        request = {"op": args.op}
+        for arg in args.args:
+            key, _, value = arg.partition("=")
+            request[key] = value
+        reply = query(request, path)
+        print(json.dumps(reply, indent=2, sort_keys=True))
+        return 0 if reply.get("ok") else 1
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Helpers for scripts and plugins running inside IDA that
+    need the ROM data the loader stored in the database.
+
+"""
+
+import ida_netnode
+
+from nesldr.structs import *
+from nesldr.rom import RomImage
+
+
+# ----------------------------------------------------------------------
+#
+#      reads a blob stored by the loader, None if the node is missing.
+#      tag is the blob tag it was stored with
+#
+def get_node_blob(name, tag='I'):
+    node = ida_netnode.netnode(name, 0, False)
+    if(node == ida_netnode.BADNODE):
+        return None
+    return node.getblob(0, tag)
+
+
+# ----------------------------------------------------------------------
+#
+#      rebuilds the original iNES image from the blobs saved by
+#      save_image_as_blobs()
+#
+def rom_image_from_database():
+    hdr_bytes = get_node_blob(INES_HDR_NODE)
+    if(hdr_bytes is None):
+        return None
+    hdr = ines_hdr.from_buffer_copy(hdr_bytes[:INES_HDR_SIZE])
+
+    trainer = None
+    if(INES_MASK_TRAINER(hdr.rom_control_byte_0)):
+        # keep the page offsets intact even if the trainer is missing
+        trainer = get_node_blob(TRAINER_NODE) or bytes(TRAINER_SIZE)
+
+    prg_pages = []
+    for i in range(hdr.prg_page_count_16k):
+        page = get_node_blob(PRG_PAGE_NODE % i)
+        if(page is None):
+            break
+        prg_pages.append(page)
+
+    chr_pages = []
+    for i in range(hdr.chr_page_count_8k):
+        page = get_node_blob(CHR_PAGE_NODE % i)
+        if(page is None):
+            break
+        chr_pages.append(page)
+
+    return RomImage.from_pages(hdr_bytes[:INES_HDR_SIZE], prg_pages, chr_pages, trainer)
+
+
+# ----------------------------------------------------------------------
+#
+#      returns {8k slot address: PRG-ROM offset} for all PRG-ROM data
+#      mapped into the ROM segment, as recorded by the loader
+#
+def prg_bank_map():
+    node = ida_netnode.netnode(PRG_BANK_MAP_NODE, 0, False)
+    if(node == ida_netnode.BADNODE):
+        return {}
+    mapping = {}
+    for slot in range(ROM_START_ADDRESS // PRG_BANK_MAP_SLOT_SIZE,
+                      (ROM_START_ADDRESS + ROM_SIZE) // PRG_BANK_MAP_SLOT_SIZE):
+        value = node.altval(slot)
+        if(value):
+            mapping[slot * PRG_BANK_MAP_SLOT_SIZE] = value - 1
+    return mapping
+
+
+# ----------------------------------------------------------------------
+#
+#      remember which part of the PRG-ROM area is mapped to address,
+#      so that tools can translate between file offsets and addresses
+#
+def save_prg_bank_mapping(address, prg_offset, size):
+    node = ida_netnode.netnode(PRG_BANK_MAP_NODE, 0, True)
+
+    for slot_offset in range(0, size, PRG_BANK_MAP_SLOT_SIZE):
+        node.altset((address + slot_offset) // PRG_BANK_MAP_SLOT_SIZE,
+                    prg_offset + slot_offset + 1)
+
+    # the 16k bank numbers, as used by bank switching plugins
+    if(size == PRG_ROM_BANK_SIZE and address in (PRG_ROM_BANK_LOW_ADDRESS, PRG_ROM_BANK_HIGH_ADDRESS)):
+        bank_node = ida_netnode.netnode(
+            BANK_NUM_8000 if address == PRG_ROM_BANK_LOW_ADDRESS else BANK_NUM_C000, 0, True)
+        bank_node.altset(0, prg_offset // PRG_ROM_BANK_SIZE)
+
+
+# ----------------------------------------------------------------------
+#
+#      maps PRG-ROM banks into the ROM segment, replacing what was
+#      there. layout is [(address, PRG-ROM offset, size)]
+#
+def map_prg_banks(layout, prg):
+    import ida_bytes
+    import ida_loader
+
+    for address, prg_offset, size in layout:
+        ida_bytes.del_items(address, ida_bytes.DELIT_SIMPLE, size)
+        ida_loader.mem2base(bytes(prg[prg_offset:prg_offset + size]), address, -1)
+        save_prg_bank_mapping(address, prg_offset, size)
+
+
+# ----------------------------------------------------------------------
+#
+#      translates an offset into the PRG-ROM area to all addresses it
+#      is mapped to in the ROM segment, lowest first. a bank may be
+#      mapped more than once (e.g. the 16k page of NROM-128 at $8000
+#      and $C000); empty if that part of the PRG-ROM is not mapped
+#
+def prg_offset_to_eas(offset, bank_map=None):
+    if(bank_map is None):
+        bank_map = prg_bank_map()
+    return sorted(address + offset - prg_offset for address, prg_offset in bank_map.items()
+                  if prg_offset <= offset < prg_offset + PRG_BANK_MAP_SLOT_SIZE)
+
+
+# the lowest address of an offset, None if it is not mapped
+def prg_offset_to_ea(offset, bank_map=None):
+    eas = prg_offset_to_eas(offset, bank_map)
+    return eas[0] if eas else None
+
+
+# ----------------------------------------------------------------------
+#
+#      of the addresses an offset is mapped at (prg_offset_to_eas()),
+#      the one code runs from: the copy in a 16k window a vector points
+#      into, else the highest, the copy next to the vectors. names go
+#      there, as they have to be unique
+#
+def primary_ea(eas):
+    import ida_bytes
+
+    if(len(eas) == 1):
+        return eas[0]
+    targets = [ida_bytes.get_word(v) for v in (NMI_VECTOR_START_ADDRESS,
+                                               RESET_VECTOR_START_ADDRESS,
+                                               IRQ_VECTOR_START_ADDRESS)]
+    for ea in eas:
+        window = ea - ea % PRG_PAGE_SIZE
+        if(any(window <= t < window + PRG_PAGE_SIZE for t in targets)):
+            return ea
+    return eas[-1]
+
+
+# whether the PRG-ROM offset is mapped at ea
+def is_prg_offset_at(offset, ea, bank_map=None):
+    return ea is not None and ea_to_prg_offset(ea, bank_map) == offset
+
+
+def ea_to_prg_offset(ea, bank_map=None):
+    if(bank_map is None):
+        bank_map = prg_bank_map()
+    slot = ea - ea % PRG_BANK_MAP_SLOT_SIZE
+    if(slot not in bank_map):
+        return None
+    return bank_map[slot] + ea - slot
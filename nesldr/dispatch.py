@@ -0,0 +1,181 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Detection of "RTS trick" jump tables:
+
+        LDA table_hi,X      ; or ,Y
+        PHA
+        LDA table_lo,X
+        PHA
+        RTS                 ; jumps to (table_hi << 8 | table_lo) + 1
+
+    If table_hi == table_lo + 1 the table consists of words
+    (interleaved), otherwise of two byte tables (split).
+    Table entries hold the target address minus one.
+
+"""
+
+import re
+
+from nesldr.structs import *
+from nesldr.opcodes import OPCODES
+from nesldr.banks import address_to_prg_offset, prg_offset_to_address, prg_window_size
+
+
+# LDA abs,X/Y ; PHA ; LDA abs,X/Y ; PHA ; RTS
+_dispatch_regex = re.compile(
+    b"[\\xB9\\xBD](..)\\x48[\\xB9\\xBD](..)\\x48\\x60", re.DOTALL)
+
+DISPATCH_SITE_SIZE = 9
+
+# upper limit for the number of entries of one table
+MAX_DISPATCH_ENTRIES = 0x80
+
+# tables with fewer valid entries are dropped
+MIN_DISPATCH_ENTRIES = 2
+
+DISPATCH_INTERLEAVED = "interleaved"
+DISPATCH_SPLIT = "split"
+
+
+class DispatchTable(object):
+
+    def __init__(self, site_offset, site_address, kind, lo_address, hi_address):
+        self.site_offset = site_offset      # PRG-ROM offset of the first LDA
+        self.site_address = site_address
+        self.kind = kind
+        self.lo_address = lo_address
+        self.hi_address = hi_address
+        # PRG-ROM offsets of the tables
+        self.lo_offset = None
+        self.hi_offset = None
+        # (entry address, target address, target PRG-ROM offset)
+        self.entries = []
+
+    @property
+    def rts_offset(self):
+        return self.site_offset + DISPATCH_SITE_SIZE - 1
+
+    @property
+    def rts_address(self):
+        return self.site_address + DISPATCH_SITE_SIZE - 1
+
+    def __repr__(self):
+        return "DispatchTable(%04X, %s, %d entries)" % \
+            (self.site_address, self.kind, len(self.entries))
+
+
+# ----------------------------------------------------------------------
+#
+#      reads the entries of a table until an entry is implausible:
+#      target outside of the ROM or not starting with a valid opcode,
+#      or the table running into the dispatch code or its other half
+#
+def _read_entries(prg, window_size, table):
+    prg_size = len(prg)
+    origin = table.site_offset
+    step = 2 if table.kind == DISPATCH_INTERLEAVED else 1
+
+    limit = MAX_DISPATCH_ENTRIES
+    if(table.kind == DISPATCH_SPLIT and table.lo_address < table.hi_address):
+        limit = min(limit, table.hi_address - table.lo_address)
+    if(table.lo_address < table.site_address):
+        limit = min(limit, (table.site_address - table.lo_address) // step)
+
+    for i in range(limit):
+        lo_address = table.lo_address + i * step
+        hi_address = table.hi_address + i * step
+        lo = address_to_prg_offset(prg_size, window_size, origin, lo_address)
+        hi = address_to_prg_offset(prg_size, window_size, origin, hi_address)
+        if(lo is None or hi is None):
+            break
+        if(i == 0):
+            table.lo_offset, table.hi_offset = lo, hi
+
+        target = ((prg[hi] << 8) | prg[lo]) + 1
+        target_offset = address_to_prg_offset(prg_size, window_size, origin, target)
+        if(target_offset is None or target >= NMI_VECTOR_START_ADDRESS):
+            break
+        op = OPCODES[prg[target_offset]]
+        if(op is None or op.mnemonic == "BRK"):
+            break
+        table.entries.append((lo_address, target, target_offset))
+
+
+# ----------------------------------------------------------------------
+#
+#      finds all dispatch tables in the PRG-ROM. the dispatch sites are
+#      located with a single regex pass, only the tables are decoded
+#
+def find_dispatch_tables(prg, mapper):
+    prg = bytes(prg)
+    window_size = prg_window_size(mapper)
+    tables = []
+
+    for m in _dispatch_regex.finditer(prg):
+        hi_address = m.group(1)[0] | (m.group(1)[1] << 8)
+        lo_address = m.group(2)[0] | (m.group(2)[1] << 8)
+        kind = DISPATCH_INTERLEAVED if hi_address == lo_address + 1 else DISPATCH_SPLIT
+
+        site_offset = m.start()
+        site_address = prg_offset_to_address(len(prg), window_size, site_offset)
+        table = DispatchTable(site_offset, site_address, kind, lo_address, hi_address)
+        _read_entries(prg, window_size, table)
+        if(len(table.entries) >= MIN_DISPATCH_ENTRIES):
+            tables.append(table)
+
+    return tables
+
+
+# ----------------------------------------------------------------------
+#
+#      turns the targets of all tables in mapped banks into code and
+#      adds code references from the RTS to them. table entries are
+#      defined as data referencing their target
+#
+def apply_dispatch_tables(tables):
+    import ida_auto
+    import ida_bytes
+    import ida_offset
+    import ida_xref
+    import ida_nalt
+    from nesldr.database import prg_bank_map, is_prg_offset_at
+
+    bank_map = prg_bank_map()
+    targets = 0
+
+    for table in tables:
+        # the code and the tables have to be mapped where the code
+        # expects them (a bank mapped twice has to be mapped there too)
+        rts_ea = table.rts_address
+        if(not is_prg_offset_at(table.rts_offset, rts_ea, bank_map) or
+           not is_prg_offset_at(table.lo_offset, table.lo_address, bank_map) or
+           not is_prg_offset_at(table.hi_offset, table.hi_address, bank_map)):
+            continue
+
+        if(table.kind == DISPATCH_INTERLEAVED):
+            size = 2 * len(table.entries)
+            ida_bytes.del_items(table.lo_address, ida_bytes.DELIT_SIMPLE, size)
+        else:
+            size = len(table.entries)
+            ida_bytes.del_items(table.lo_address, ida_bytes.DELIT_SIMPLE, size)
+            ida_bytes.del_items(table.hi_address, ida_bytes.DELIT_SIMPLE, size)
+            ida_bytes.create_byte(table.lo_address, size)
+            ida_bytes.create_byte(table.hi_address, size)
+            ida_bytes.set_cmt(table.lo_address, "jump table (low bytes - 1)", False)
+            ida_bytes.set_cmt(table.hi_address, "jump table (high bytes)", False)
+
+        for entry_ea, target, target_offset in table.entries:
+            if(not is_prg_offset_at(target_offset, target, bank_map)):
+                continue
+            if(table.kind == DISPATCH_INTERLEAVED):
+                ida_bytes.create_word(entry_ea, 2)
+                ida_offset.op_offset(entry_ea, 0, ida_nalt.REF_OFF16, target, 0, -1)
+            ida_xref.add_cref(rts_ea, target, ida_xref.fl_JN)
+            ida_xref.add_dref(entry_ea, target, ida_xref.dr_O)
+            ida_auto.auto_make_code(target)
+            targets += 1
+
+    return targets
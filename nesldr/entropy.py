@@ -0,0 +1,96 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Entropy map of the PRG-ROM. Compressed graphics, level
+    data and music have a much higher entropy than 6502 code,
+    so such regions can be marked as data before IDA starts
+    its analysis.
+
+    The map holds one byte per window step: the Shannon
+    entropy of the window in 1/32 bits per byte (0..255).
+
+"""
+
+import math
+from array import array
+from collections import Counter
+
+from nesldr.structs import *
+
+
+# the default step equals the window size, which halves the work
+# compared to overlapping windows and is precise enough for marking
+ENTROPY_WINDOW = 0x100
+ENTROPY_STEP = 0x100
+
+# 1/32 bits per byte, so 8 bits map to 256 (clamped to 255)
+ENTROPY_SCALE = 32
+
+# windows above this are considered packed data. random data
+# measured over 256 bytes gives ~7.2, 6502 code stays below ~6.5
+ENTROPY_THRESHOLD = int(6.8 * ENTROPY_SCALE)
+
+# minimum number of consecutive windows above the threshold
+ENTROPY_MIN_WINDOWS = 2
+
+
+# ----------------------------------------------------------------------
+#
+#      computes the entropy map of data. the byte counting is done
+#      by Counter (C), the sum by a table of c * log2(c) values
+#
+def entropy_map(data, window=ENTROPY_WINDOW, step=ENTROPY_STEP):
+    data = bytes(data)
+    clog = [0.0] + [c * math.log2(c) for c in range(1, window + 1)]
+    result = bytearray()
+    for start in range(0, max(len(data) - window, 0) + 1, step):
+        chunk = data[start:start + window]
+        n = len(chunk)
+        if(n == 0):
+            break
+        bits = math.log2(n) - sum(map(clog.__getitem__, Counter(chunk).values())) / n
+        result.append(min(int(bits * ENTROPY_SCALE), 0xFF))
+    return result
+
+
+# ----------------------------------------------------------------------
+#
+#      byte histogram of every PRG-ROM page, 256 16-bit counters each
+#
+def page_histograms(prg, page_size=PRG_PAGE_SIZE):
+    prg = bytes(prg)
+    result = array("H")
+    for start in range(0, len(prg), page_size):
+        counts = Counter(prg[start:start + page_size])
+        result.extend(min(counts.get(b, 0), 0xFFFF) for b in range(0x100))
+    return result
+
+
+# ----------------------------------------------------------------------
+#
+#      returns the (start, end) offsets of all regions whose windows
+#      are above threshold for at least min_windows steps in a row
+#
+def high_entropy_ranges(emap, threshold=ENTROPY_THRESHOLD,
+                        min_windows=ENTROPY_MIN_WINDOWS,
+                        window=ENTROPY_WINDOW, step=ENTROPY_STEP):
+    ranges = []
+    run_start = None
+    for i, value in enumerate(bytes(emap) + b"\x00"):
+        if(value >= threshold):
+            if(run_start is None):
+                run_start = i
+        elif(run_start is not None):
+            if(i - run_start >= min_windows):
+                ranges.append((run_start * step, (i - 1) * step + window))
+            run_start = None
+    return ranges
+
+
+def entropy_at(emap, offset, step=ENTROPY_STEP):
+    index = offset // step
+    if(index >= len(emap)):
+        return None
+    return emap[index] / float(ENTROPY_SCALE)
@@ -0,0 +1,176 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Naming of all absolute I/O register operands at once. The
+    PPU registers are mirrored every 8 bytes up to $3FFF, so
+    code using "STA $2800" or "LDA $3FFA,X" writes PPU_CR_1
+    and reads PPU_SR; such operands get no name from the
+    register items of the IO_REGS segment.
+
+    All PRG-ROM offsets holding an absolute memory access to
+    $2000-$401F are found with a single regular expression;
+    offsets which do not score as code (nesldr/classify.py)
+    are dropped. In the database, mirrored operands are
+    replaced by the name of the register they fold to and get
+    a data reference to it; every access gets the register's
+    description as repeatable comment.
+
+    usage:
+        python -m nesldr.ioaccess <rom.nes> [--list]
+
+"""
+
+import argparse
+import re
+import sys
+from collections import Counter
+
+from nesldr.structs import *
+from nesldr.ioregs import IOREG_NAMES, IOREGS
+from nesldr.opcodes import *
+from nesldr.classify import classify_prg, CODE_THRESHOLD, WEIGHT_OPERAND
+
+
+# the PPU registers repeat every 8 bytes up to here
+PPU_MIRROR_END = 0x4000
+PPU_REGISTER_COUNT = 8
+
+_index_suffix = {MODE_ABX: ",X", MODE_ABY: ",Y"}
+
+# absolute reads and writes, no JMP/JSR
+_access_opcodes = [op for op in OPCODES
+                   if op is not None and op.mode in ABS_MODES and accesses_memory(op)]
+
+# opcode, any low byte and $20-$3F as high byte, or $00-$1F/$40
+_ioreg_operand_re = re.compile(b"(?=[%s](?:[\\x00-\\xFF][\\x20-\\x3F]|[\\x00-\\x1F]\\x40))" %
+                               b"".join(re.escape(bytes((op.opcode,))) for op in _access_opcodes),
+                               re.DOTALL)
+
+# one line descriptions of the registers
+_ioreg_descriptions = dict((address, comment.split("\n", 1)[0])
+                           for address, _, _, comment in IOREGS)
+
+
+# ----------------------------------------------------------------------
+#
+#      the register an address in $2000-$401F accesses
+#
+def fold_ioreg_address(address):
+    if(IOREGS_START_ADDRESS <= address < PPU_MIRROR_END):
+        return IOREGS_START_ADDRESS + address % PPU_REGISTER_COUNT
+    return address
+
+
+class IoAccess(object):
+
+    def __init__(self, offset, op, address):
+        self.offset = offset            # PRG-ROM offset of the instruction
+        self.op = op
+        self.address = address          # operand as written
+        self.register = fold_ioreg_address(address)
+
+    @property
+    def is_mirror(self):
+        return self.address != self.register
+
+    @property
+    def name(self):
+        return IOREG_NAMES[self.register]
+
+    # the operand as shown after folding, e.g. "PPU_SR,X"
+    @property
+    def operand(self):
+        return self.name + _index_suffix.get(self.op.mode, "")
+
+    @property
+    def description(self):
+        return _ioreg_descriptions[self.register]
+
+    def __repr__(self):
+        return "IoAccess(%06X %s %s)" % (self.offset, self.op.mnemonic, self.operand)
+
+
+# ----------------------------------------------------------------------
+#
+#      all absolute accesses to named I/O registers. with scores, only
+#      offsets scoring at least threshold as code are kept; the
+#      classifier's penalty for operands in the mirrors is ignored
+#
+def find_ioreg_accesses(prg, scores=None, threshold=CODE_THRESHOLD):
+    prg = bytes(prg)
+    accesses = []
+    for m in _ioreg_operand_re.finditer(prg):
+        pos = m.start()
+        address = prg[pos + 1] | (prg[pos + 2] << 8)
+        register = fold_ioreg_address(address)
+        if(register not in IOREG_NAMES):
+            continue
+        if(scores is not None and
+           scores[pos] + (WEIGHT_OPERAND if register != address else 0) < threshold):
+            continue
+        accesses.append(IoAccess(pos, OPCODES[prg[pos]], address))
+    return accesses
+
+
+# ----------------------------------------------------------------------
+#
+#      names and comments the accesses of the mapped banks. returns the
+#      number of instructions annotated and of mirrored operands folded
+#
+def apply_ioreg_names(accesses):
+    import ida_bytes
+    import ida_xref
+    from nesldr.database import prg_bank_map, prg_offset_to_eas
+
+    bank_map = prg_bank_map()
+    count = mirrors = 0
+    for access in accesses:
+        # every copy of a bank mapped more than once
+        eas = [ea for ea in prg_offset_to_eas(access.offset, bank_map)
+               if ea + access.op.size <= NMI_VECTOR_START_ADDRESS]
+        if(not eas):
+            continue
+        for ea in eas:
+            if(access.is_mirror):
+                ida_bytes.set_forced_operand(ea, 0, access.operand)
+                ida_xref.add_dref(ea, access.register,
+                                  ida_xref.dr_W if writes_memory(access.op) else ida_xref.dr_R)
+                ida_bytes.set_cmt(ea, "%s (mirror $%04X)" % (access.description, access.address),
+                                  True)
+            else:
+                ida_bytes.set_cmt(ea, access.description, True)
+        if(access.is_mirror):
+            mirrors += 1
+        count += 1
+    return count, mirrors
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+
+    parser = argparse.ArgumentParser(prog="nesldr.ioaccess")
+    parser.add_argument("rom")
+    parser.add_argument("--list", action="store_true", help="print every access")
+    parser.add_argument("--threshold", type=int, default=CODE_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    image = RomImage.from_file(args.rom)
+    prg = image.prg()
+    accesses = find_ioreg_accesses(prg, classify_prg(prg, image.mapper), args.threshold)
+
+    if(args.list):
+        for access in accesses:
+            print("%06X  %s %s%s" % (access.offset, access.op.mnemonic, access.operand,
+                                     "  ; $%04X" % access.address if access.is_mirror else ""))
+    counts = Counter(a.register for a in accesses)
+    mirrors = Counter(a.register for a in accesses if a.is_mirror)
+    for register in sorted(counts):
+        print("$%04X  %-14s %5d access(es), %5d through mirrors" %
+              (register, IOREG_NAMES[register], counts[register], mirrors[register]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
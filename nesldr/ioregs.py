@@ -267,4 +267,76 @@ JOYPAD_2_COMMENT = "Joypad #2/SOFTCLK (RW)\n\n" \
                                              "WRITING:\n" \
                                              "Expansion Port Latch (W)\n\n" \
                                              "" \
-                                             "   D0: Expansion Port Method\n"
\ No newline at end of file
+                                             "   D0: Expansion Port Method\n"
+
+
+# all I/O registers: (address, size, short description, comment)
+IOREGS = (
+    (PPU_CR_1_ADDRESS, PPU_CR_1_SIZE,
+     PPU_CR_1_SHORT_DESCRIPTION, PPU_CR_1_COMMENT),
+    (PPU_CR_2_ADDRESS, PPU_CR_2_SIZE,
+     PPU_CR_2_SHORT_DESCRIPTION, PPU_CR_2_COMMENT),
+    (PPU_SR_ADDRESS, PPU_SR_SIZE,
+     PPU_SR_SHORT_DESCRIPTION, PPU_SR_COMMENT),
+    (SPR_RAM_AR_ADDRESS, SPR_RAM_AR_SIZE,
+     SPR_RAM_AR_SHORT_DESCRIPTION, SPR_RAM_AR_COMMENT),
+    (SPR_RAM_IOR_ADDRESS, SPR_RAM_IOR_SIZE,
+     SPR_RAM_IOR_SHORT_DESCRIPTION, SPR_RAM_IOR_COMMENT),
+    (VRAM_AR_1_ADDRESS, VRAM_AR_1_SIZE,
+     VRAM_AR_1_SHORT_DESCRIPTION, VRAM_AR_1_COMMENT),
+    (VRAM_AR_2_ADDRESS, VRAM_AR_2_SIZE,
+     VRAM_AR_2_SHORT_DESCRIPTION, VRAM_AR_2_COMMENT),
+    (VRAM_IOR_ADDRESS, VRAM_IOR_SIZE,
+     VRAM_IOR_SHORT_DESCRIPTION, VRAM_IOR_COMMENT),
+    (PAPU_PULSE_1_CR_ADDRESS, PAPU_PULSE_1_CR_SIZE,
+     PAPU_PULSE_1_CR_SHORT_DESCRIPTION, PAPU_PULSE_1_CR_COMMENT),
+    (PAPU_PULSE_1_RCR_ADDRESS, PAPU_PULSE_1_RCR_SIZE,
+     PAPU_PULSE_1_RCR_SHORT_DESCRIPTION, PAPU_PULSE_1_RCR_COMMENT),
+    (PAPU_PULSE_1_FTR_ADDRESS, PAPU_PULSE_1_FTR_SIZE,
+     PAPU_PULSE_1_FTR_SHORT_DESCRIPTION, PAPU_PULSE_1_FTR_COMMENT),
+    (PAPU_PULSE_1_CTR_ADDRESS, PAPU_PULSE_1_CTR_SIZE,
+     PAPU_PULSE_1_CTR_SHORT_DESCRIPTION, PAPU_PULSE_1_CTR_COMMENT),
+    (PAPU_PULSE_2_CR_ADDRESS, PAPU_PULSE_2_CR_SIZE,
+     PAPU_PULSE_2_CR_SHORT_DESCRIPTION, PAPU_PULSE_2_CR_COMMENT),
+    (PAPU_PULSE_2_RCR_ADDRESS, PAPU_PULSE_2_RCR_SIZE,
+     PAPU_PULSE_2_RCR_SHORT_DESCRIPTION, PAPU_PULSE_2_RCR_COMMENT),
+    (PAPU_PULSE_2_FTR_ADDRESS, PAPU_PULSE_2_FTR_SIZE,
+     PAPU_PULSE_2_FTR_SHORT_DESCRIPTION, PAPU_PULSE_2_FTR_COMMENT),
+    (PAPU_PULSE_2_CTR_ADDRESS, PAPU_PULSE_2_CTR_SIZE,
+     PAPU_PULSE_2_CTR_SHORT_DESCRIPTION, PAPU_PULSE_2_CTR_COMMENT),
+    (PAPU_TRIANGLE_CR_1_ADDRESS, PAPU_TRIANGLE_CR_1_SIZE,
+     PAPU_TRIANGLE_CR_1_SHORT_DESCRIPTION, PAPU_TRIANGLE_CR_1_COMMENT),
+    (PAPU_TRIANGLE_CR_2_ADDRESS, PAPU_TRIANGLE_CR_2_SIZE,
+     PAPU_TRIANGLE_CR_2_SHORT_DESCRIPTION, PAPU_TRIANGLE_CR_2_COMMENT),
+    (PAPU_TRIANGLE_FR_1_ADDRESS, PAPU_TRIANGLE_FR_1_SIZE,
+     PAPU_TRIANGLE_FR_1_SHORT_DESCRIPTION, PAPU_TRIANGLE_FR_1_COMMENT),
+    (PAPU_TRIANGLE_FR_2_ADDRESS, PAPU_TRIANGLE_FR_2_SIZE,
+     PAPU_TRIANGLE_FR_2_SHORT_DESCRIPTION, PAPU_TRIANGLE_FR_2_COMMENT),
+    (PAPU_NOISE_CR_1_ADDRESS, PAPU_NOISE_CR_1_SIZE,
+     PAPU_NOISE_CR_1_SHORT_DESCRIPTION, PAPU_NOISE_CR_1_COMMENT),
+    (PAPU_NOISE_CR_2_ADDRESS, PAPU_NOISE_CR_2_SIZE,
+     PAPU_NOISE_CR_2_SHORT_DESCRIPTION, PAPU_NOISE_CR_2_COMMENT),
+    (PAPU_NOISE_FR_1_ADDRESS, PAPU_NOISE_FR_1_SIZE,
+     PAPU_NOISE_FR_1_SHORT_DESCRIPTION, PAPU_NOISE_FR_1_COMMENT),
+    (PAPU_NOISE_FR_2_ADDRESS, PAPU_NOISE_FR_2_SIZE,
+     PAPU_NOISE_FR_2_SHORT_DESCRIPTION, PAPU_NOISE_FR_2_COMMENT),
+    (PAPU_DM_CR_ADDRESS, PAPU_DM_CR_SIZE,
+     PAPU_DM_CR_SHORT_DESCRIPTION, PAPU_DM_CR_COMMENT),
+    (PAPU_DM_DAR_ADDRESS, PAPU_DM_DAR_SIZE,
+     PAPU_DM_DAR_SHORT_DESCRIPTION, PAPU_DM_DAR_COMMENT),
+    (PAPU_DM_AR_ADDRESS, PAPU_DM_AR_SIZE,
+     PAPU_DM_AR_SHORT_DESCRIPTION, PAPU_DM_AR_COMMENT),
+    (PAPU_DM_DLR_ADDRESS, PAPU_DM_DLR_SIZE,
+     PAPU_DM_DLR_SHORT_DESCRIPTION, PAPU_DM_DLR_COMMENT),
+    (PAPU_SV_CSR_ADDRESS, PAPU_SV_CSR_SIZE,
+     PAPU_SV_CSR_SHORT_DESCRIPTION, PAPU_SV_CSR_COMMENT),
+    (SPRITE_DMAR_ADDRESS, SPRITE_DMAR_SIZE,
+     SPRITE_DMAR_SHORT_DESCRIPTION, SPRITE_DMAR_COMMENT),
+    (JOYPAD_1_ADDRESS, JOYPAD_1_SIZE,
+     JOYPAD_1_SHORT_DESCRIPTION, JOYPAD_1_COMMENT),
+    (JOYPAD_2_ADDRESS, JOYPAD_2_SIZE,
+     JOYPAD_2_SHORT_DESCRIPTION, JOYPAD_2_COMMENT),
+)
+
+# address -> short description
+IOREG_NAMES = dict((address, name) for address, _, name, _ in IOREGS)
@@ -0,0 +1,363 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Exporting labels and comments to the debugger label files
+    of emulators:
+
+        Mesen       <rom>.mlb
+        FCEUX       <rom>.nes.ram.nl, <rom>.nes.<bank>.nl
+
+    Inside IDA all names and commented items of the RAM,
+    IO_REGS, SRAM, TRAINER and ROM segments are collected in
+    one pass over IDA's name list and the heads of those
+    segments. ROM addresses are converted to PRG-ROM offsets
+    with the bank map the loader recorded; labels imported for
+    unmapped banks (nesldr/symbols.py) are exported as well.
+
+    The files are written line by line to a temporary file and
+    only replace the old file if their contents differ, so the
+    export can run on every save of the database without
+    touching the emulator's files needlessly.
+
+    usage:
+        python -m nesldr.labelexport <rom.nes> <symbol file>... [--format mlb|nl]
+
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from nesldr.structs import *
+from nesldr.symbols import Symbol, SymbolError, SYMBOL_PRG, SYMBOL_CPU, parse_symbol_file, \
+    merge_symbols
+
+
+FORMAT_MLB = "mlb"
+FORMAT_NL = "nl"
+FORMATS = (FORMAT_MLB, FORMAT_NL)
+
+# segments whose names and comments are exported
+EXPORT_SEGMENTS = ("RAM", "IO_REGS", "SRAM", "TRAINER", "ROM")
+
+# the internal RAM is mirrored every 2k up to RAM_SIZE
+RAM_MIRROR_SIZE = 0x800
+
+_invalid_label_chars_re = re.compile(r"[^A-Za-z0-9_@]")
+
+# compare and copy files in blocks of this size
+_BLOCK_SIZE = 1 << 16
+
+
+# ----------------------------------------------------------------------
+#
+#      labels accepted by both debuggers: letters, digits, '_' and '@',
+#      not starting with a digit
+#
+def label_name(name):
+    name = _invalid_label_chars_re.sub("_", name or "")
+    if(name[:1].isdigit()):
+        name = "_" + name
+    return name
+
+
+# ----------------------------------------------------------------------
+#
+#      Mesen memory type and offset of a symbol, None for addresses
+#      Mesen has no label type for (e.g. expansion ROM)
+#
+def mlb_location(symbol):
+    if(symbol.kind == SYMBOL_PRG):
+        return "P", symbol.location
+    address = symbol.location
+    if(address < RAM_SIZE):
+        return "R", address % RAM_MIRROR_SIZE
+    if(IOREGS_START_ADDRESS <= address < IOREGS_START_ADDRESS + IOREGS_SIZE):
+        return "G", address
+    if(SRAM_START_ADDRESS <= address < SRAM_START_ADDRESS + SRAM_SIZE):
+        return "S", address - SRAM_START_ADDRESS
+    return None
+
+
+# ----------------------------------------------------------------------
+#
+#      lines of a Mesen label file: "P:1F2A[-1F2F]:label[:comment]".
+#      symbols are sorted by location; a location is written once
+#
+def mlb_lines(symbols):
+    seen = set()
+    for symbol in symbols:
+        location = mlb_location(symbol)
+        if(location is None or location in seen):
+            continue
+        seen.add(location)
+        memory, offset = location
+        text = "%s:%04X" % (memory, offset)
+        if(symbol.size > 1):
+            text += "-%04X" % (offset + symbol.size - 1)
+        text += ":" + label_name(symbol.name)
+        if(symbol.comment):
+            text += ":" + symbol.comment.replace("\n", "\\n")
+        yield text + "\n"
+
+
+def _nl_line(address, symbol):
+    text = "$%04X" % address
+    if(symbol.size > 1):
+        text += "/%X" % symbol.size
+    comment = (symbol.comment or "").replace("\n", "\\")
+    return "%s#%s#%s\n" % (text, label_name(symbol.name), comment)
+
+
+# ----------------------------------------------------------------------
+#
+#      lines of the FCEUX name lists as {suffix: lines}, suffix "ram"
+#      for CPU addresses below the ROM and the 16k bank number for
+#      PRG-ROM symbols. address_of gives the CPU address a PRG-ROM
+#      offset is shown at
+#
+def nl_files(symbols, address_of):
+    files = {}
+    seen = set()
+    for symbol in symbols:
+        if(symbol.kind == SYMBOL_PRG):
+            suffix = "%X" % (symbol.location // PRG_PAGE_SIZE)
+            address = address_of(symbol.location)
+        else:
+            suffix = "ram"
+            address = symbol.location
+            if(address >= ROM_START_ADDRESS):
+                continue
+        if(address is None or (suffix, address) in seen):
+            continue
+        seen.add((suffix, address))
+        files.setdefault(suffix, []).append(_nl_line(address, symbol))
+    return files
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(_BLOCK_SIZE), b""):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.digest()
+
+
+# ----------------------------------------------------------------------
+#
+#      streams lines to a temporary file next to path and replaces path
+#      with it only if the contents differ. the file keeps its mode, a
+#      new one gets the default mode of the umask. returns True if path
+#      was written
+#
+def write_if_changed(path, lines):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".labels-", dir=directory)
+    digest = hashlib.sha1()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for line in lines:
+                data = line.encode("utf-8")
+                digest.update(data)
+                f.write(data)
+        if(digest.digest() == _file_digest(path)):
+            os.remove(temp_path)
+            return False
+        # mkstemp() creates the file readable by its owner only
+        if(os.path.exists(path)):
+            shutil.copymode(path, temp_path)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_path, 0o666 & ~umask)
+        os.replace(temp_path, path)
+        return True
+    except:
+        if(os.path.exists(temp_path)):
+            os.remove(temp_path)
+        raise
+
+
+# ----------------------------------------------------------------------
+#
+#      writes the label files of a ROM image at rom_path. name lists of
+#      banks which no longer have labels are emptied. returns
+#      [(path, written)]
+#
+def export_label_files(symbols, rom_path, address_of, formats=FORMATS):
+    symbols = [s for _, s in sorted(merge_symbols(symbols).items())]
+    results = []
+    if(FORMAT_MLB in formats):
+        path = os.path.splitext(rom_path)[0] + ".mlb"
+        results.append((path, write_if_changed(path, mlb_lines(symbols))))
+    if(FORMAT_NL in formats):
+        files = nl_files(symbols, address_of)
+        paths = set()
+        for suffix, lines in sorted(files.items()):
+            path = "%s.%s.nl" % (rom_path, suffix)
+            paths.add(path)
+            results.append((path, write_if_changed(path, lines)))
+        directory = os.path.dirname(os.path.abspath(rom_path))
+        prefix = os.path.basename(rom_path) + "."
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(os.path.dirname(rom_path), name)
+            if(name.startswith(prefix) and name.endswith(".nl") and path not in paths):
+                results.append((path, write_if_changed(path, ())))
+    return results
+
+
+# ----------------------------------------------------------------------
+#
+#      all names and comments of the exported segments as symbols.
+#      names come from IDA's name list, comments from the heads of
+#      the segments
+#
+def database_symbols():
+    import ida_bytes
+    import ida_idaapi
+    import ida_name
+    import ida_netnode
+    import ida_segment
+    from nesldr.romview import romview
+
+    view = romview()
+    ranges = []
+    for name in EXPORT_SEGMENTS:
+        seg = ida_segment.get_segm_by_name(name)
+        if(seg is not None):
+            ranges.append((seg.start_ea, seg.end_ea))
+
+    def to_symbol(ea, name, comment):
+        flags = ida_bytes.get_flags(ea)
+        size = 1 if ida_bytes.is_code(flags) else max(1, ida_bytes.get_item_size(ea))
+        if(ROM_START_ADDRESS <= ea < ROM_START_ADDRESS + ROM_SIZE):
+            offset = view.ea_to_offset(ea) if view is not None else None
+            if(offset is None):
+                return None
+            return Symbol(SYMBOL_PRG, offset, name, comment, size)
+        return Symbol(SYMBOL_CPU, ea, name, comment, size)
+
+    def comment_of(ea):
+        comments = [c for c in (ida_bytes.get_cmt(ea, False), ida_bytes.get_cmt(ea, True)) if c]
+        return "\n".join(comments) or None
+
+    def in_ranges(ea):
+        return any(start <= ea < end for start, end in ranges)
+
+    symbols = []
+    named = set()
+    for i in range(ida_name.get_nlist_size()):
+        ea = ida_name.get_nlist_ea(i)
+        if(in_ranges(ea)):
+            named.add(ea)
+            symbol = to_symbol(ea, ida_name.get_nlist_name(i), comment_of(ea))
+            if(symbol is not None):
+                symbols.append(symbol)
+
+    for start, end in ranges:
+        ea = start
+        while(ea != ida_idaapi.BADADDR and ea < end):
+            if(ida_bytes.has_cmt(ida_bytes.get_flags(ea)) and ea not in named):
+                symbol = to_symbol(ea, "", comment_of(ea))
+                if(symbol is not None):
+                    symbols.append(symbol)
+            ea = ida_bytes.next_head(ea, end)
+
+    # labels imported for banks which are not mapped
+    node = ida_netnode.netnode(PRG_SYMBOLS_NODE, 0, False)
+    if(node != ida_netnode.BADNODE):
+        unmapped = {}
+        for tag in ("N", "C"):
+            index = node.supfirst(tag)
+            while(index != ida_netnode.BADNODE):
+                unmapped.setdefault(index, {})[tag] = node.supstr(index, tag)
+                index = node.supnext(index, tag)
+        for offset, texts in unmapped.items():
+            symbols.append(Symbol(SYMBOL_PRG, offset, texts.get("N") or "", texts.get("C")))
+    return symbols
+
+
+# ----------------------------------------------------------------------
+#
+#      exports the labels of the database next to its input file (or
+#      rom_path). returns [(path, written)]
+#
+def export_database_labels(formats=FORMATS, rom_path=None):
+    import ida_nalt
+    from nesldr.romview import romview
+
+    view = romview()
+    rom_path = rom_path or ida_nalt.get_input_file_path()
+    return export_label_files(database_symbols(), rom_path,
+                              view.offset_to_address if view is not None else lambda o: None,
+                              formats)
+
+
+# ----------------------------------------------------------------------
+#
+#      exports the labels whenever the database is saved. returns the
+#      hooks, unhook() ends it
+#
+def export_labels_on_save(formats=FORMATS, rom_path=None):
+    import ida_idp
+    import ida_kernwin
+
+    class LabelExportHooks(ida_idp.IDB_Hooks):
+
+        def savebase(self):
+            try:
+                written = [p for p, changed in export_database_labels(formats, rom_path) if changed]
+                if(written):
+                    ida_kernwin.msg("labels exported to %s\n" % ", ".join(written))
+            except (OSError, SymbolError) as e:
+                ida_kernwin.msg("label export failed: %s\n" % e)
+            return 0
+
+    hooks = LabelExportHooks()
+    hooks.hook()
+    return hooks
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+    from nesldr.banks import prg_window_size, prg_offset_to_address
+
+    parser = argparse.ArgumentParser(prog="nesldr.labelexport")
+    parser.add_argument("rom")
+    parser.add_argument("symbols", nargs="+", help=".nl, .mlb or .dbg files to convert")
+    parser.add_argument("--format", choices=FORMATS, action="append",
+                        help="format to write (default: all)")
+    args = parser.parse_args(argv)
+
+    image = RomImage.from_file(args.rom)
+    prg_size = len(image.prg())
+    window_size = prg_window_size(image.mapper)
+
+    def address_of(offset):
+        return prg_offset_to_address(prg_size, window_size, offset)
+
+    symbols = []
+    try:
+        for path in args.symbols:
+            symbols.extend(parse_symbol_file(path, image.prg_offset))
+    except (OSError, SymbolError) as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+
+    for path, written in export_label_files(symbols, args.rom, address_of,
+                                            args.format or FORMATS):
+        print("%s %s" % ("written  " if written else "unchanged", path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
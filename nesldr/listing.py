@@ -0,0 +1,211 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Plain text disassembly of every PRG-ROM bank, for review
+    with grep and for diffing, without IDA. Every window is
+    disassembled by a linear sweep at its usual CPU address
+    (see nesldr/banks.py); undocumented opcodes become .byte
+    lines. I/O registers are named as in the loader, the
+    vectors and the handlers they point to as by the loader's
+    name_vector()/add_entry() calls.
+
+    The line formats of all 256 opcodes and the operand
+    strings of all 64k absolute addresses are built once, so
+    each instruction costs a single % format. Lines of a
+    window are joined and written through a large buffer.
+
+    usage:
+        python -m nesldr.listing <rom.nes> [-o <file>]
+
+"""
+
+import argparse
+import sys
+
+from nesldr.structs import *
+from nesldr.ioregs import IOREG_NAMES
+from nesldr.ioaccess import fold_ioreg_address
+from nesldr.opcodes import *
+from nesldr.banks import prg_window_size, prg_offset_to_address
+from nesldr.vectors import read_bank_vectors, is_valid_vectors, VECTOR_NAMES, VECTORS_SIZE
+
+
+# names given by the loader
+VECTOR_LABEL = "%s_vector"
+ROUTINE_LABEL = "%s_routine"
+BANK_ROUTINE_LABEL = "%s_routine_%02d"
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# how the operand of each addressing mode is printed. %s is the
+# operand string of an absolute address, %02X a byte, %04X a target
+_operand_formats = {
+    MODE_IMP: "", MODE_ACC: " A",
+    MODE_IMM: " #$%02X", MODE_ZP: " $%02X", MODE_ZPX: " $%02X,X", MODE_ZPY: " $%02X,Y",
+    MODE_IZX: " ($%02X,X)", MODE_IZY: " ($%02X),Y", MODE_REL: " $%04X",
+    MODE_ABS: " %s", MODE_ABX: " %s,X", MODE_ABY: " %s,Y", MODE_IND: " (%s)",
+}
+
+# line formats: "bank:address  bytes  instruction"
+_byte_format = "%s%04X  %02X        .byte $%02X\n"
+_word_format = "%s%04X  %02X %02X     .word %s\n"
+
+
+def _build_line_formats():
+    formats = [None] * 0x100
+    for op in OPCODES:
+        if(op is None):
+            continue
+        code = "%02X" % op.opcode
+        if(op.size == 1):
+            raw = code + "      "
+        elif(op.size == 2):
+            raw = code + " %02X   "
+        else:
+            raw = code + " %02X %02X"
+        formats[op.opcode] = "%s%04X  " + raw + "  " + op.mnemonic + \
+            _operand_formats[op.mode] + "\n"
+    return formats
+
+
+_line_formats = _build_line_formats()
+
+
+# ----------------------------------------------------------------------
+#
+#      operand strings of all absolute addresses: the register name
+#      for I/O registers (and their mirrors) and vectors, "$nnnn" for
+#      everything else
+#
+def operand_names():
+    names = ["$%04X" % a for a in range(0x10000)]
+    for address in range(IOREGS_START_ADDRESS, IOREGS_START_ADDRESS + IOREGS_SIZE):
+        names[address] = IOREG_NAMES.get(fold_ioreg_address(address), names[address])
+    for i, name in enumerate(VECTOR_NAMES):
+        names[NMI_VECTOR_START_ADDRESS + i * 2] = VECTOR_LABEL % name
+    return names
+
+
+# ----------------------------------------------------------------------
+#
+#      labels of the handlers of all windows with valid vectors, as
+#      {window: {address: name}}. the handlers of the last window are
+#      the database's entry points, the others get the window number
+#
+def handler_labels(prg, window_size):
+    vectors = read_bank_vectors(prg, window_size)
+    labels = {}
+    for v in vectors:
+        if(not is_valid_vectors(prg, v)):
+            continue
+        names = labels.setdefault(v.window, {})
+        for name, address in v.handlers():
+            if(v.offset_of(address) is None):
+                continue
+            if(v.window == len(vectors) - 1):
+                names.setdefault(address, ROUTINE_LABEL % name)
+            else:
+                names.setdefault(address, BANK_ROUTINE_LABEL % (name, v.window))
+    return labels
+
+
+# ----------------------------------------------------------------------
+#
+#      disassembles one window at base. returns the listing lines.
+#      labels maps addresses to names printed before the instruction
+#
+def disassemble(data, base, prefix="", labels=None, names=None):
+    names = names or operand_names()
+    labels = labels or {}
+    formats = _line_formats
+    sizes = OPCODE_SIZES
+    lines = []
+    append = lines.append
+    end = len(data)
+    # the vectors are words, not code
+    if(base + end == 0x10000 and end >= VECTORS_SIZE):
+        end -= VECTORS_SIZE
+
+    pos = 0
+    while(pos < end):
+        address = base + pos
+        if(address in labels):
+            append("%s:\n" % labels[address])
+        opcode = data[pos]
+        size = sizes[opcode]
+        if(size == 0 or pos + size > end):
+            append(_byte_format % (prefix, address, opcode, opcode))
+            pos += 1
+        elif(size == 1):
+            append(formats[opcode] % (prefix, address))
+            pos += 1
+        elif(size == 2):
+            operand = data[pos + 1]
+            if(opcode & 0x1F == 0x10):
+                # branch, print the target
+                append(formats[opcode] % (prefix, address, operand,
+                                          (address + 2 + (operand ^ 0x80) - 0x80) & 0xFFFF))
+            else:
+                append(formats[opcode] % (prefix, address, operand, operand))
+            pos += 2
+        else:
+            lo = data[pos + 1]
+            hi = data[pos + 2]
+            append(formats[opcode] % (prefix, address, lo, hi, names[lo | (hi << 8)]))
+            pos += 3
+
+    if(end != len(data)):
+        for i, name in enumerate(VECTOR_NAMES):
+            pos = end + i * 2
+            address = base + pos
+            target = data[pos] | (data[pos + 1] << 8)
+            append("%s:\n" % (VECTOR_LABEL % name))
+            append(_word_format % (prefix, address, data[pos], data[pos + 1],
+                                   labels.get(target, "$%04X" % target)))
+    return lines
+
+
+# ----------------------------------------------------------------------
+#
+#      writes the listing of all PRG-ROM windows to the text stream out.
+#      returns the number of windows written
+#
+def write_listing(prg, mapper, out, name=None):
+    prg = bytes(prg)
+    window_size = prg_window_size(mapper)
+    names = operand_names()
+    labels = handler_labels(prg, window_size)
+
+    out.write("; %s\n; mapper %d, %dk PRG-ROM, %dk windows\n" %
+              (name or "PRG-ROM", mapper, len(prg) // 1024, window_size // 1024))
+    count = len(prg) // window_size
+    for window in range(count):
+        offset = window * window_size
+        base = prg_offset_to_address(len(prg), window_size, offset)
+        out.write("\n; window %02X, PRG-ROM offset $%06X at $%04X\n" % (window, offset, base))
+        out.write("".join(disassemble(prg[offset:offset + window_size], base,
+                                      "%02X:" % window, labels.get(window), names)))
+    return count
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+
+    parser = argparse.ArgumentParser(prog="nesldr.listing")
+    parser.add_argument("rom")
+    parser.add_argument("-o", "--output", help="listing file (default: standard output)")
+    args = parser.parse_args(argv)
+
+    image = RomImage.from_file(args.rom)
+    if(args.output):
+        with open(args.output, "w", buffering=OUTPUT_BUFFER_SIZE, newline="\n") as out:
+            write_listing(image.prg(), image.mapper, out, args.rom)
+    else:
+        write_listing(image.prg(), image.mapper, sys.stdout, args.rom)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -145,3 +145,13 @@ MAPPER_HK_SF3 = 91
 
 
 MAPPER_LAST = 91
+
+
+# mappers switching the whole 32k PRG-ROM window at once. every
+# 32k bank of those carries its own vectors
+PRG_32K_MAPPERS = (MAPPER_AOROM,
+                   MAPPER_FFE_F3XXX,
+                   MAPPER_COLOR_DREAMS,
+                   MAPPER_100_IN_1,
+                   MAPPER_NINA_1,
+                   MAPPER_GNROM)
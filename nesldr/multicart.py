@@ -0,0 +1,304 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Splitting multicarts (100-in-1 and similar) into their
+    sub-games. Every 16k page is checked as the last page of a
+    game: its vectors have to point to valid code and the reset
+    handler has to look like a reset stub (SEI, CLD, stack
+    setup, PPU disabled, vblank wait). Pages without vectors
+    are joined to the next game, consecutive pages repeating
+    the same vectors and reset stub form one banked game.
+
+    The pages are checked on a process pool for large images.
+    Inside IDA the check always runs in the loader's process.
+
+    usage:
+        python -m nesldr.multicart <rom.nes> [--workers N]
+
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from nesldr.structs import *
+from nesldr.mappers import *
+from nesldr.opcodes import OPCODES, OP_SEI, OP_CLD
+from nesldr.vectors import BankVectors, read_bank_vectors, VECTOR_NAMES
+
+
+# mappers whose images usually hold several games
+MULTICART_MAPPERS = (MAPPER_100_IN_1,)
+
+# the reset handler has to score at least this (see reset_stub_score)
+MIN_RESET_STUB_SCORE = 2
+RESET_STUB_SIZE = 0x20
+
+# images smaller than this are always checked serially
+PARALLEL_MIN_SIZE = 0x100000
+PAGES_PER_TASK = 16
+
+OP_TXS = 0x9A
+OP_LDX_IMM = 0xA2
+
+# fields of a directory entry as stored in the database
+DIRECTORY_FIELDS = 6
+
+
+# ----------------------------------------------------------------------
+#
+#      how much the code at a reset handler looks like a reset stub.
+#      one point each for SEI, CLD, LDX #imm/TXS, a write to
+#      PPUCTRL/PPUMASK and a read of PPUSTATUS near the start
+#
+def reset_stub_score(stub):
+    stub = bytes(stub)
+    score = 0
+    if(OP_SEI in stub[:2]):
+        score += 1
+    if(OP_CLD in stub[:3]):
+        score += 1
+    i = stub.find(bytes((OP_LDX_IMM,)))
+    if(i >= 0 and stub[i + 2:i + 3] == bytes((OP_TXS,))):
+        score += 1
+    # STA/STX/STY $2000 or $2001
+    if(any(bytes((op, reg, 0x20)) in stub for op in (0x8C, 0x8D, 0x8E)
+           for reg in (0x00, 0x01))):
+        score += 1
+    # LDA/BIT $2002
+    if(bytes((0xAD, 0x02, 0x20)) in stub or bytes((0x2C, 0x02, 0x20)) in stub):
+        score += 1
+    return score
+
+
+class PageInfo(object):
+
+    def __init__(self, page, vectors, valid, score, digest):
+        self.page = page
+        self.vectors = vectors          # BankVectors of the page at $C000
+        self.valid = valid              # vectors point to valid code
+        self.score = score              # reset stub score
+        self.digest = digest            # hash of vectors and reset stub
+
+    @property
+    def is_game_end(self):
+        return self.valid and self.score >= MIN_RESET_STUB_SCORE
+
+
+# ----------------------------------------------------------------------
+#
+#      checks a single 16k page as seen at $C000. handlers below $C000
+#      are looked up in the page as well (mirrored 16k games); for
+#      larger games this is a guess, but it only adds to the score
+#
+def check_page(prg, page):
+    base = page * PRG_PAGE_SIZE
+    data = prg[base:base + PRG_PAGE_SIZE]
+    vectors = read_bank_vectors(data, PRG_PAGE_SIZE)[0]
+    vectors = BankVectors(page, base, PRG_PAGE_SIZE, vectors.nmi, vectors.reset, vectors.irq)
+
+    valid = True
+    for name, address in vectors.handlers():
+        if(not ROM_START_ADDRESS <= address < NMI_VECTOR_START_ADDRESS):
+            valid = False
+            break
+        op = OPCODES[data[address % PRG_PAGE_SIZE]]
+        if(op is None or op.mnemonic in ("BRK", "RTS") or
+           (name == "RESET" and op.mnemonic == "RTI")):
+            valid = False
+            break
+
+    stub = b""
+    score = 0
+    if(valid):
+        offset = vectors.reset % PRG_PAGE_SIZE
+        stub = bytes(data[offset:offset + RESET_STUB_SIZE])
+        score = reset_stub_score(stub)
+
+    digest = hashlib.sha1(bytes(data[-6:]) + stub).digest()
+    return PageInfo(page, vectors, valid, score, digest)
+
+
+# state of the pool workers
+_worker_prg = None
+
+
+def _init_worker(prg):
+    global _worker_prg
+    _worker_prg = prg
+
+
+def _check_pages(pages):
+    return [check_page(_worker_prg, p) for p in pages]
+
+
+# ----------------------------------------------------------------------
+#
+#      checks all pages, on a process pool if workers > 1
+#
+def check_pages(prg, workers=None):
+    prg = bytes(prg)
+    count = len(prg) // PRG_PAGE_SIZE
+    if(workers is None):
+        workers = (os.cpu_count() or 1) if len(prg) >= PARALLEL_MIN_SIZE else 1
+    if(workers <= 1 or count <= PAGES_PER_TASK):
+        return [check_page(prg, p) for p in range(count)]
+
+    tasks = [range(i, min(i + PAGES_PER_TASK, count))
+             for i in range(0, count, PAGES_PER_TASK)]
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(prg,)) as pool:
+        return [info for chunk in pool.map(_check_pages, tasks) for info in chunk]
+
+
+class SubGame(object):
+
+    def __init__(self, index, prg_offset, size, vectors, score):
+        self.index = index
+        self.prg_offset = prg_offset
+        self.size = size
+        self.vectors = vectors          # vectors of the last page
+        self.score = score
+
+    @property
+    def page_count(self):
+        return self.size // PRG_PAGE_SIZE
+
+    def to_words(self):
+        return [self.prg_offset, self.size, self.vectors.nmi, self.vectors.reset,
+                self.vectors.irq, self.score]
+
+    @classmethod
+    def from_words(cls, index, words):
+        prg_offset, size, nmi, reset, irq, score = words
+        page = (prg_offset + size) // PRG_PAGE_SIZE - 1
+        vectors = BankVectors(page, page * PRG_PAGE_SIZE, PRG_PAGE_SIZE, nmi, reset, irq)
+        return cls(index, prg_offset, size, vectors, score)
+
+    def __repr__(self):
+        return "SubGame(%d, offset %06X, %dk, RESET=%04X)" % \
+            (self.index, self.prg_offset, self.size // 1024, self.vectors.reset)
+
+
+# ----------------------------------------------------------------------
+#
+#      clusters the checked pages into sub-games. pages without
+#      vectors belong to the next game ending with valid vectors;
+#      runs of game ends sharing vectors and reset stub are a single
+#      banked game. trailing pages without vectors are dropped
+#
+def cluster_pages(infos):
+    games = []
+    start = 0
+    i = 0
+    while(i < len(infos)):
+        info = infos[i]
+        if(not info.is_game_end):
+            i += 1
+            continue
+        end = i
+        while(end + 1 < len(infos) and infos[end + 1].is_game_end and
+              infos[end + 1].digest == info.digest):
+            end += 1
+        last = infos[end]
+        games.append(SubGame(len(games), start * PRG_PAGE_SIZE,
+                             (end + 1 - start) * PRG_PAGE_SIZE, last.vectors, last.score))
+        start = i = end + 1
+    return games
+
+
+def find_subgames(prg, workers=None):
+    return cluster_pages(check_pages(prg, workers))
+
+
+# ----------------------------------------------------------------------
+#
+#      saves the sub-game directory to the database
+#
+def save_directory(games):
+    import ida_netnode
+
+    node = ida_netnode.netnode(MULTICART_NODE, 0, True)
+    words = array("I", [w for g in games for w in g.to_words()])
+    node.setblob(words.tobytes(), 0, 'D')
+    node.altset(0, len(games))
+
+
+def load_directory():
+    from nesldr.database import get_node_blob
+
+    blob = get_node_blob(MULTICART_NODE, 'D')
+    if(blob is None):
+        return []
+    words = array("I")
+    words.frombytes(blob[:len(blob) - len(blob) % 4])
+    return [SubGame.from_words(i, words[i * DIRECTORY_FIELDS:(i + 1) * DIRECTORY_FIELDS])
+            for i in range(len(words) // DIRECTORY_FIELDS)]
+
+
+# ----------------------------------------------------------------------
+#
+#      maps a sub-game into the ROM segment in place of the current
+#      banks, from the PRG-ROM blobs in the database. 16k games are
+#      mirrored at $8000 and $C000, larger games get their first page
+#      at $8000 and their last page at $C000. the old items are
+#      deleted and the sub-game's handlers are queued for analysis
+#
+def load_subgame(index):
+    import ida_auto
+    import ida_bytes
+    from nesldr.database import map_prg_banks
+    from nesldr.romview import romview
+
+    games = load_directory()
+    if(not 0 <= index < len(games)):
+        raise IndexError("no sub-game %d" % index)
+    game = games[index]
+    prg = romview().prg
+
+    if(game.size == ROM_SIZE):
+        layout = ((PRG_ROM_BANK_LOW_ADDRESS, game.prg_offset, ROM_SIZE),)
+    else:
+        last = game.prg_offset + game.size - PRG_PAGE_SIZE
+        first = game.prg_offset if game.size > PRG_PAGE_SIZE else last
+        layout = ((PRG_ROM_BANK_LOW_ADDRESS, first, PRG_PAGE_SIZE),
+                  (PRG_ROM_BANK_HIGH_ADDRESS, last, PRG_PAGE_SIZE))
+
+    map_prg_banks(layout, prg)
+
+    for name, address in game.vectors.handlers():
+        ida_bytes.create_word(address_of_vector(name), 2)
+        ida_auto.auto_make_code(address)
+    ida_bytes.set_cmt(ROM_START_ADDRESS, "sub-game %d of %d, PRG-ROM offset $%X, %dk" %
+                      (index, len(games), game.prg_offset, game.size // 1024), True)
+    ida_auto.plan_range(ROM_START_ADDRESS, ROM_START_ADDRESS + ROM_SIZE)
+    return game
+
+
+def address_of_vector(name):
+    return NMI_VECTOR_START_ADDRESS + VECTOR_NAMES.index(name) * 2
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+
+    parser = argparse.ArgumentParser(prog="nesldr.multicart")
+    parser.add_argument("rom")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    image = RomImage.from_file(args.rom)
+    games = find_subgames(image.prg(), args.workers)
+    for game in games:
+        print("%3d  %06X  %4dk  NMI=%04X RESET=%04X IRQ=%04X  stub %d" %
+              (game.index, game.prg_offset, game.size // 1024, game.vectors.nmi,
+               game.vectors.reset, game.vectors.irq, game.score))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    6502 opcode tables (official opcodes only), used by the
+    analysis passes and the headless tools.
+
+"""
+
+from collections import namedtuple
+
+
+# addressing modes
+MODE_IMP = "imp"    # implied
+MODE_ACC = "acc"    # accumulator
+MODE_IMM = "imm"    # #$nn
+MODE_ZP = "zp"      # $nn
+MODE_ZPX = "zpx"    # $nn,X
+MODE_ZPY = "zpy"    # $nn,Y
+MODE_ABS = "abs"    # $nnnn
+MODE_ABX = "abx"    # $nnnn,X
+MODE_ABY = "aby"    # $nnnn,Y
+MODE_IND = "ind"    # ($nnnn)
+MODE_IZX = "izx"    # ($nn,X)
+MODE_IZY = "izy"    # ($nn),Y
+MODE_REL = "rel"    # branch target
+
+MODE_SIZE = {
+    MODE_IMP: 1, MODE_ACC: 1,
+    MODE_IMM: 2, MODE_ZP: 2, MODE_ZPX: 2, MODE_ZPY: 2,
+    MODE_IZX: 2, MODE_IZY: 2, MODE_REL: 2,
+    MODE_ABS: 3, MODE_ABX: 3, MODE_ABY: 3, MODE_IND: 3,
+}
+
+# modes whose operand is a memory address
+ZP_MODES = (MODE_ZP, MODE_ZPX, MODE_ZPY)
+ABS_MODES = (MODE_ABS, MODE_ABX, MODE_ABY)
+INDEXED_MODES = (MODE_ZPX, MODE_ZPY, MODE_ABX, MODE_ABY, MODE_IZX, MODE_IZY)
+
+# opcode, mnemonic, addressing mode, cycles, +1 cycle on page crossing
+Opcode = namedtuple("Opcode", "opcode mnemonic mode size cycles page_penalty")
+
+_opcode_list = [
+    (0x69, "ADC", MODE_IMM, 2, 0), (0x65, "ADC", MODE_ZP, 3, 0), (0x75, "ADC", MODE_ZPX, 4, 0),
+    (0x6D, "ADC", MODE_ABS, 4, 0), (0x7D, "ADC", MODE_ABX, 4, 1), (0x79, "ADC", MODE_ABY, 4, 1),
+    (0x61, "ADC", MODE_IZX, 6, 0), (0x71, "ADC", MODE_IZY, 5, 1),
+
+    (0x29, "AND", MODE_IMM, 2, 0), (0x25, "AND", MODE_ZP, 3, 0), (0x35, "AND", MODE_ZPX, 4, 0),
+    (0x2D, "AND", MODE_ABS, 4, 0), (0x3D, "AND", MODE_ABX, 4, 1), (0x39, "AND", MODE_ABY, 4, 1),
+    (0x21, "AND", MODE_IZX, 6, 0), (0x31, "AND", MODE_IZY, 5, 1),
+
+    (0x0A, "ASL", MODE_ACC, 2, 0), (0x06, "ASL", MODE_ZP, 5, 0), (0x16, "ASL", MODE_ZPX, 6, 0),
+    (0x0E, "ASL", MODE_ABS, 6, 0), (0x1E, "ASL", MODE_ABX, 7, 0),
+
+    (0x90, "BCC", MODE_REL, 2, 0), (0xB0, "BCS", MODE_REL, 2, 0), (0xF0, "BEQ", MODE_REL, 2, 0),
+    (0x30, "BMI", MODE_REL, 2, 0), (0xD0, "BNE", MODE_REL, 2, 0), (0x10, "BPL", MODE_REL, 2, 0),
+    (0x50, "BVC", MODE_REL, 2, 0), (0x70, "BVS", MODE_REL, 2, 0),
+
+    (0x24, "BIT", MODE_ZP, 3, 0), (0x2C, "BIT", MODE_ABS, 4, 0),
+
+    (0x00, "BRK", MODE_IMP, 7, 0),
+
+    (0x18, "CLC", MODE_IMP, 2, 0), (0xD8, "CLD", MODE_IMP, 2, 0),
+    (0x58, "CLI", MODE_IMP, 2, 0), (0xB8, "CLV", MODE_IMP, 2, 0),
+
+    (0xC9, "CMP", MODE_IMM, 2, 0), (0xC5, "CMP", MODE_ZP, 3, 0), (0xD5, "CMP", MODE_ZPX, 4, 0),
+    (0xCD, "CMP", MODE_ABS, 4, 0), (0xDD, "CMP", MODE_ABX, 4, 1), (0xD9, "CMP", MODE_ABY, 4, 1),
+    (0xC1, "CMP", MODE_IZX, 6, 0), (0xD1, "CMP", MODE_IZY, 5, 1),
+
+    (0xE0, "CPX", MODE_IMM, 2, 0), (0xE4, "CPX", MODE_ZP, 3, 0), (0xEC, "CPX", MODE_ABS, 4, 0),
+    (0xC0, "CPY", MODE_IMM, 2, 0), (0xC4, "CPY", MODE_ZP, 3, 0), (0xCC, "CPY", MODE_ABS, 4, 0),
+
+    (0xC6, "DEC", MODE_ZP, 5, 0), (0xD6, "DEC", MODE_ZPX, 6, 0),
+    (0xCE, "DEC", MODE_ABS, 6, 0), (0xDE, "DEC", MODE_ABX, 7, 0),
+    (0xCA, "DEX", MODE_IMP, 2, 0), (0x88, "DEY", MODE_IMP, 2, 0),
+
+    (0x49, "EOR", MODE_IMM, 2, 0), (0x45, "EOR", MODE_ZP, 3, 0), (0x55, "EOR", MODE_ZPX, 4, 0),
+    (0x4D, "EOR", MODE_ABS, 4, 0), (0x5D, "EOR", MODE_ABX, 4, 1), (0x59, "EOR", MODE_ABY, 4, 1),
+    (0x41, "EOR", MODE_IZX, 6, 0), (0x51, "EOR", MODE_IZY, 5, 1),
+
+    (0xE6, "INC", MODE_ZP, 5, 0), (0xF6, "INC", MODE_ZPX, 6, 0),
+    (0xEE, "INC", MODE_ABS, 6, 0), (0xFE, "INC", MODE_ABX, 7, 0),
+    (0xE8, "INX", MODE_IMP, 2, 0), (0xC8, "INY", MODE_IMP, 2, 0),
+
+    (0x4C, "JMP", MODE_ABS, 3, 0), (0x6C, "JMP", MODE_IND, 5, 0),
+    (0x20, "JSR", MODE_ABS, 6, 0),
+
+    (0xA9, "LDA", MODE_IMM, 2, 0), (0xA5, "LDA", MODE_ZP, 3, 0), (0xB5, "LDA", MODE_ZPX, 4, 0),
+    (0xAD, "LDA", MODE_ABS, 4, 0), (0xBD, "LDA", MODE_ABX, 4, 1), (0xB9, "LDA", MODE_ABY, 4, 1),
+    (0xA1, "LDA", MODE_IZX, 6, 0), (0xB1, "LDA", MODE_IZY, 5, 1),
+
+    (0xA2, "LDX", MODE_IMM, 2, 0), (0xA6, "LDX", MODE_ZP, 3, 0), (0xB6, "LDX", MODE_ZPY, 4, 0),
+    (0xAE, "LDX", MODE_ABS, 4, 0), (0xBE, "LDX", MODE_ABY, 4, 1),
+
+    (0xA0, "LDY", MODE_IMM, 2, 0), (0xA4, "LDY", MODE_ZP, 3, 0), (0xB4, "LDY", MODE_ZPX, 4, 0),
+    (0xAC, "LDY", MODE_ABS, 4, 0), (0xBC, "LDY", MODE_ABX, 4, 1),
+
+    (0x4A, "LSR", MODE_ACC, 2, 0), (0x46, "LSR", MODE_ZP, 5, 0), (0x56, "LSR", MODE_ZPX, 6, 0),
+    (0x4E, "LSR", MODE_ABS, 6, 0), (0x5E, "LSR", MODE_ABX, 7, 0),
+
+    (0xEA, "NOP", MODE_IMP, 2, 0),
+
+    (0x09, "ORA", MODE_IMM, 2, 0), (0x05, "ORA", MODE_ZP, 3, 0), (0x15, "ORA", MODE_ZPX, 4, 0),
+    (0x0D, "ORA", MODE_ABS, 4, 0), (0x1D, "ORA", MODE_ABX, 4, 1), (0x19, "ORA", MODE_ABY, 4, 1),
+    (0x01, "ORA", MODE_IZX, 6, 0), (0x11, "ORA", MODE_IZY, 5, 1),
+
+    (0x48, "PHA", MODE_IMP, 3, 0), (0x08, "PHP", MODE_IMP, 3, 0),
+    (0x68, "PLA", MODE_IMP, 4, 0), (0x28, "PLP", MODE_IMP, 4, 0),
+
+    (0x2A, "ROL", MODE_ACC, 2, 0), (0x26, "ROL", MODE_ZP, 5, 0), (0x36, "ROL", MODE_ZPX, 6, 0),
+    (0x2E, "ROL", MODE_ABS, 6, 0), (0x3E, "ROL", MODE_ABX, 7, 0),
+
+    (0x6A, "ROR", MODE_ACC, 2, 0), (0x66, "ROR", MODE_ZP, 5, 0), (0x76, "ROR", MODE_ZPX, 6, 0),
+    (0x6E, "ROR", MODE_ABS, 6, 0), (0x7E, "ROR", MODE_ABX, 7, 0),
+
+    (0x40, "RTI", MODE_IMP, 6, 0), (0x60, "RTS", MODE_IMP, 6, 0),
+
+    (0xE9, "SBC", MODE_IMM, 2, 0), (0xE5, "SBC", MODE_ZP, 3, 0), (0xF5, "SBC", MODE_ZPX, 4, 0),
+    (0xED, "SBC", MODE_ABS, 4, 0), (0xFD, "SBC", MODE_ABX, 4, 1), (0xF9, "SBC", MODE_ABY, 4, 1),
+    (0xE1, "SBC", MODE_IZX, 6, 0), (0xF1, "SBC", MODE_IZY, 5, 1),
+
+    (0x38, "SEC", MODE_IMP, 2, 0), (0xF8, "SED", MODE_IMP, 2, 0), (0x78, "SEI", MODE_IMP, 2, 0),
+
+    (0x85, "STA", MODE_ZP, 3, 0), (0x95, "STA", MODE_ZPX, 4, 0), (0x8D, "STA", MODE_ABS, 4, 0),
+    (0x9D, "STA", MODE_ABX, 5, 0), (0x99, "STA", MODE_ABY, 5, 0),
+    (0x81, "STA", MODE_IZX, 6, 0), (0x91, "STA", MODE_IZY, 6, 0),
+
+    (0x86, "STX", MODE_ZP, 3, 0), (0x96, "STX", MODE_ZPY, 4, 0), (0x8E, "STX", MODE_ABS, 4, 0),
+    (0x84, "STY", MODE_ZP, 3, 0), (0x94, "STY", MODE_ZPX, 4, 0), (0x8C, "STY", MODE_ABS, 4, 0),
+
+    (0xAA, "TAX", MODE_IMP, 2, 0), (0xA8, "TAY", MODE_IMP, 2, 0), (0xBA, "TSX", MODE_IMP, 2, 0),
+    (0x8A, "TXA", MODE_IMP, 2, 0), (0x9A, "TXS", MODE_IMP, 2, 0), (0x98, "TYA", MODE_IMP, 2, 0),
+]
+
+# opcode -> Opcode, None for undocumented opcodes
+OPCODES = [None] * 0x100
+for _op, _mnemonic, _mode, _cycles, _penalty in _opcode_list:
+    OPCODES[_op] = Opcode(_op, _mnemonic, _mode, MODE_SIZE[_mode], _cycles, _penalty)
+del _op, _mnemonic, _mode, _cycles, _penalty
+
+# translation tables: data.translate(OPCODE_SIZES) gives the length of
+# the instruction starting at every offset (0 = invalid opcode)
+OPCODE_SIZES = bytes(op.size if op else 0 for op in OPCODES)
+OPCODE_VALID = bytes(1 if op else 0 for op in OPCODES)
+
+# instruction classes
+BRANCH_MNEMONICS = frozenset(("BCC", "BCS", "BEQ", "BMI", "BNE", "BPL", "BVC", "BVS"))
+RETURN_MNEMONICS = frozenset(("RTS", "RTI"))
+STORE_MNEMONICS = frozenset(("STA", "STX", "STY"))
+RMW_MNEMONICS = frozenset(("ASL", "LSR", "ROL", "ROR", "INC", "DEC"))
+LOAD_MNEMONICS = frozenset(("LDA", "LDX", "LDY"))
+
+# control flow does not continue with the next instruction
+STOP_MNEMONICS = frozenset(("JMP", "RTS", "RTI", "BRK"))
+
+OP_PHA = 0x48
+OP_RTS = 0x60
+OP_RTI = 0x40
+OP_JSR = 0x20
+OP_JMP = 0x4C
+OP_JMP_IND = 0x6C
+OP_SEI = 0x78
+OP_CLD = 0xD8
+
+
+# ----------------------------------------------------------------------
+#
+#      decodes the instruction at pos. returns (Opcode, operand) or
+#      (None, None) for invalid or truncated instructions
+#
+def decode(data, pos):
+    op = OPCODES[data[pos]]
+    if(op is None or pos + op.size > len(data)):
+        return None, None
+    if(op.size == 1):
+        return op, None
+    if(op.size == 2):
+        return op, data[pos + 1]
+    return op, data[pos + 1] | (data[pos + 2] << 8)
+
+
+# ----------------------------------------------------------------------
+#
+#      target address of a branch at address with operand
+#
+def branch_target(address, operand):
+    return (address + 2 + (operand - 0x100 if operand & 0x80 else operand)) & 0xFFFF
+
+
+# ----------------------------------------------------------------------
+#
+#      is the memory operand of an instruction read, written or both?
+#
+def accesses_memory(op):
+    return op.mode not in (MODE_IMP, MODE_ACC, MODE_IMM, MODE_REL) and \
+        op.mnemonic not in ("JMP", "JSR")
+
+
+def reads_memory(op):
+    return accesses_memory(op) and op.mnemonic not in STORE_MNEMONICS
+
+
+def writes_memory(op):
+    return accesses_memory(op) and \
+        (op.mnemonic in STORE_MNEMONICS or op.mnemonic in RMW_MNEMONICS)
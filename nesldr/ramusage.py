@@ -0,0 +1,248 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Index of all accesses to the 2k of internal RAM. The
+    memory operands of all PRG-ROM pages are decoded by a
+    linear sweep, addresses in the mirrors ($0800-$1FFF) are
+    folded to $0000-$07FF and reads and writes are counted
+    per RAM byte and PRG-ROM page.
+
+    The index is saved to a netnode (zlib compressed) and can
+    be queried later without scanning the ROM again.
+
+    usage:
+        python -m nesldr.ramusage <rom.nes> [--top N]
+
+"""
+
+import argparse
+import re
+import sys
+import zlib
+from array import array
+
+from nesldr.structs import *
+from nesldr.opcodes import *
+
+
+# the internal RAM is mirrored every 2k up to RAM_SIZE
+RAM_MIRROR_SIZE = 0x800
+
+ACCESS_READ = 1
+ACCESS_WRITE = 2
+
+# variables with at least this many accesses are named automatically
+HOT_VARIABLE_MIN_ACCESSES = 8
+
+# the comment line written by build_ram_usage()
+USAGE_COMMENT_FORMAT = "%d reads, %d writes in %d PRG-ROM page(s)"
+USAGE_COMMENT_RE = re.compile(r"^\d+ reads, \d+ writes in \d+ PRG-ROM page\(s\)$")
+
+
+def fold_ram_address(address):
+    return address % RAM_MIRROR_SIZE
+
+
+# per opcode: (size, operand kind, access). operand kind is 1 for a
+# direct address, 2 for a zero page pointer, 0 for no memory operand
+def _build_access_table():
+    table = [None] * 0x100
+    for op in OPCODES:
+        if(op is None):
+            continue
+        kind = 0
+        access = 0
+        if(accesses_memory(op)):
+            kind = 2 if op.mode in (MODE_IZX, MODE_IZY) else 1
+            access = (ACCESS_READ if reads_memory(op) else 0) | \
+                (ACCESS_WRITE if writes_memory(op) else 0)
+        table[op.opcode] = (op.size, kind, access)
+    return table
+
+
+_access_table = _build_access_table()
+
+
+# ----------------------------------------------------------------------
+#
+#      read/write counters per PRG-ROM page and (folded) RAM address
+#
+class RamUsage(object):
+
+    def __init__(self, page_count, counts=None):
+        self.page_count = page_count
+        # [page][read, write][address]
+        self.counts = counts if counts is not None else \
+            array("I", bytes(4 * page_count * 2 * RAM_MIRROR_SIZE))
+
+    def _index(self, page, kind, address):
+        return (page * 2 + kind) * RAM_MIRROR_SIZE + fold_ram_address(address)
+
+    def reads(self, address, page=None):
+        pages = range(self.page_count) if page is None else (page,)
+        return sum(self.counts[self._index(p, 0, address)] for p in pages)
+
+    def writes(self, address, page=None):
+        pages = range(self.page_count) if page is None else (page,)
+        return sum(self.counts[self._index(p, 1, address)] for p in pages)
+
+    # pages accessing an address as {page: (reads, writes)}
+    def pages(self, address):
+        result = {}
+        for p in range(self.page_count):
+            r = self.counts[self._index(p, 0, address)]
+            w = self.counts[self._index(p, 1, address)]
+            if(r or w):
+                result[p] = (r, w)
+        return result
+
+    # ----------------------------------------------------------------------
+    #
+    #      total accesses per RAM byte (2k entries)
+    #
+    def heatmap(self):
+        totals = array("I", bytes(4 * RAM_MIRROR_SIZE))
+        for row in range(self.page_count * 2):
+            base = row * RAM_MIRROR_SIZE
+            for address in range(RAM_MIRROR_SIZE):
+                totals[address] += self.counts[base + address]
+        return totals
+
+    # addresses sorted by number of accesses, most used first
+    def hottest(self, count=None, min_accesses=1):
+        heat = self.heatmap()
+        result = [(heat[a], a) for a in range(RAM_MIRROR_SIZE) if heat[a] >= min_accesses]
+        result.sort(reverse=True)
+        return [(a, n) for n, a in result[:count]]
+
+    def to_bytes(self):
+        return zlib.compress(array("I", [self.page_count]).tobytes() + self.counts.tobytes())
+
+    @classmethod
+    def from_bytes(cls, blob):
+        data = array("I")
+        data.frombytes(zlib.decompress(blob))
+        return cls(data[0], data[1:])
+
+
+# ----------------------------------------------------------------------
+#
+#      scans all PRG-ROM pages. every page is swept linearly from its
+#      start, invalid opcodes are skipped byte by byte
+#
+def scan_ram_usage(prg):
+    prg = bytes(prg)
+    page_count = len(prg) // PRG_PAGE_SIZE
+    usage = RamUsage(page_count)
+    counts = usage.counts
+    table = _access_table
+
+    for page in range(page_count):
+        pos = page * PRG_PAGE_SIZE
+        end = pos + PRG_PAGE_SIZE
+        read_base = page * 2 * RAM_MIRROR_SIZE
+        write_base = read_base + RAM_MIRROR_SIZE
+        while(pos < end):
+            entry = table[prg[pos]]
+            if(entry is None):
+                pos += 1
+                continue
+            size, kind, access = entry
+            if(pos + size > end):
+                break
+            if(kind):
+                if(size == 2):
+                    address = prg[pos + 1]
+                else:
+                    address = prg[pos + 1] | (prg[pos + 2] << 8)
+                if(address < RAM_SIZE):
+                    address %= RAM_MIRROR_SIZE
+                    if(kind == 2):
+                        # ($nn),Y / ($nn,X) read a pointer from zero page
+                        counts[read_base + address] += 1
+                        counts[read_base + (address + 1) % 0x100] += 1
+                    else:
+                        if(access & ACCESS_READ):
+                            counts[read_base + address] += 1
+                        if(access & ACCESS_WRITE):
+                            counts[write_base + address] += 1
+            pos += size
+
+    return usage
+
+
+def ram_variable_name(address):
+    return ("zp_%02X" if address < 0x100 else "ram_%03X") % address
+
+
+# the repeatable comment with the statistics line replaced, user
+# written lines are kept
+def usage_comment(comment, stats):
+    lines = [line for line in (comment or "").split("\n")
+             if line and not USAGE_COMMENT_RE.match(line)]
+    return "\n".join(lines + [stats])
+
+
+# ----------------------------------------------------------------------
+#
+#      builds the index from the PRG-ROM blobs, saves it to the
+#      database and names and comments the most used variables
+#      which do not have a user defined name yet. user comments
+#      are kept, only the statistics line is replaced
+#
+def build_ram_usage(name_variables=True, min_accesses=HOT_VARIABLE_MIN_ACCESSES):
+    import ida_bytes
+    import ida_name
+    import ida_netnode
+    from nesldr.romview import romview
+
+    usage = scan_ram_usage(romview().prg)
+    node = ida_netnode.netnode(RAM_USAGE_NODE, 0, True)
+    node.setblob(usage.to_bytes(), 0, 'U')
+
+    if(name_variables):
+        for address, total in usage.hottest(min_accesses=min_accesses):
+            if(not ida_bytes.has_user_name(ida_bytes.get_flags(address))):
+                ida_name.set_name(address, ram_variable_name(address), ida_name.SN_NOWARN)
+            comment = ida_bytes.get_cmt(address, True)
+            stats = USAGE_COMMENT_FORMAT % (usage.reads(address), usage.writes(address),
+                                            len(usage.pages(address)))
+            updated = usage_comment(comment, stats)
+            if(updated != comment):
+                ida_bytes.set_cmt(address, updated, True)
+    return usage
+
+
+# ----------------------------------------------------------------------
+#
+#      loads the index saved by build_ram_usage(), None if there is none
+#
+def load_ram_usage():
+    from nesldr.database import get_node_blob
+
+    blob = get_node_blob(RAM_USAGE_NODE, 'U')
+    if(blob is None):
+        return None
+    return RamUsage.from_bytes(blob)
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+
+    parser = argparse.ArgumentParser(prog="nesldr.ramusage")
+    parser.add_argument("rom")
+    parser.add_argument("--top", type=int, default=32)
+    args = parser.parse_args(argv)
+
+    usage = scan_ram_usage(RomImage.from_file(args.rom).prg())
+    for address, total in usage.hottest(args.top):
+        print("$%03X  %-8s  reads %5d  writes %5d  pages %d" %
+              (address, ram_variable_name(address), usage.reads(address),
+               usage.writes(address), len(usage.pages(address))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Read-only access to the parts of an iNES image (header,
+    trainer, PRG and CHR pages) without IDA. Used by the
+    headless tools in this package.
+
+"""
+
+import os
+
+from nesldr.structs import *
+from nesldr.archive import RomArchive, split_archive_path, is_archive_file, is_rom_name, \
+    archive_errors
+
+
+# ----------------------------------------------------------------------
+#
+#      an iNES image held in memory. page accessors return
+#      memoryviews into the image, so no page is ever copied
+#
+class RomImage(object):
+
+    def __init__(self, data, name=None):
+        if(len(data) < INES_HDR_SIZE):
+            raise ValueError("%s: file is smaller than an iNES header" % name)
+
+        self.name = name
+        self.data = bytes(data)
+        self.view = memoryview(self.data)
+        self.hdr = ines_hdr.from_buffer_copy(self.data[:INES_HDR_SIZE])
+
+        if(self.hdr.id != b"NES" or self.hdr.term != 0x1A):
+            raise ValueError("%s: not an iNES image" % name)
+
+        self.has_trainer = bool(INES_MASK_TRAINER(self.hdr.rom_control_byte_0))
+        self.mapper = INES_MASK_MAPPER_VERSION(
+            self.hdr.rom_control_byte_0, self.hdr.rom_control_byte_1)
+
+        # file offsets of the trainer, PRG and CHR areas
+        self.trainer_offset = INES_HDR_SIZE
+        self.prg_offset = INES_HDR_SIZE + \
+            (TRAINER_SIZE if self.has_trainer else 0)
+        self.chr_offset = self.prg_offset + \
+            PRG_PAGE_SIZE * self.hdr.prg_page_count_16k
+
+        # short images only expose the pages that are actually present
+        self.prg_page_count = min(self.hdr.prg_page_count_16k,
+                                  max(0, len(self.data) - self.prg_offset) // PRG_PAGE_SIZE)
+        self.chr_page_count = min(self.hdr.chr_page_count_8k,
+                                  max(0, len(self.data) - self.chr_offset) // CHR_PAGE_SIZE)
+
+    # ----------------------------------------------------------------------
+    #
+    #      reads an image from a .nes file, an archive (first ROM image
+    #      in it), an archive member ("archive.zip!member.nes") or a bank
+    #      store manifest (see nesldr/bankstore.py)
+    #
+    @classmethod
+    def from_file(cls, path):
+        from nesldr.bankstore import is_manifest_file, read_manifest_image
+
+        if(is_manifest_file(path)):
+            return cls(read_manifest_image(path)[1], path)
+        archive_path, member = split_archive_path(path)
+        if(member is not None or is_archive_file(archive_path)):
+            archive = RomArchive(archive_path)
+            try:
+                f = archive.open(member)
+                return cls.from_fileobj(f, "%s!%s" % (archive_path, f.name))
+            finally:
+                archive.close()
+        with open(path, "rb") as f:
+            return cls(f.read(), path)
+
+    @classmethod
+    def from_fileobj(cls, f, name=None):
+        f.seek(0)
+        return cls(f.read(), name)
+
+    # ----------------------------------------------------------------------
+    #
+    #      builds an image from its parts, e.g. from the blobs
+    #      stored in an IDA database
+    #
+    @classmethod
+    def from_pages(cls, hdr_bytes, prg_pages, chr_pages, trainer=None, name=None):
+        parts = [bytes(hdr_bytes)]
+        if(trainer is not None):
+            parts.append(bytes(trainer))
+        parts.extend(bytes(p) for p in prg_pages)
+        parts.extend(bytes(p) for p in chr_pages)
+        return cls(b"".join(parts), name)
+
+    def header_bytes(self):
+        return self.data[:INES_HDR_SIZE]
+
+    def trainer(self):
+        if(not self.has_trainer):
+            return None
+        return self.view[self.trainer_offset:self.trainer_offset + TRAINER_SIZE]
+
+    def prg_page(self, index):
+        if(not 0 <= index < self.prg_page_count):
+            raise IndexError("PRG-ROM page %d out of range" % index)
+        start = self.prg_offset + index * PRG_PAGE_SIZE
+        return self.view[start:start + PRG_PAGE_SIZE]
+
+    def chr_page(self, index):
+        if(not 0 <= index < self.chr_page_count):
+            raise IndexError("CHR-ROM page %d out of range" % index)
+        start = self.chr_offset + index * CHR_PAGE_SIZE
+        return self.view[start:start + CHR_PAGE_SIZE]
+
+    def prg_pages(self):
+        return [self.prg_page(i) for i in range(self.prg_page_count)]
+
+    def chr_pages(self):
+        return [self.chr_page(i) for i in range(self.chr_page_count)]
+
+    # whole PRG/CHR areas as one contiguous view each
+    def prg(self):
+        return self.view[self.prg_offset:self.prg_offset + self.prg_page_count * PRG_PAGE_SIZE]
+
+    def chr(self):
+        return self.view[self.chr_offset:self.chr_offset + self.chr_page_count * CHR_PAGE_SIZE]
+
+
+# ----------------------------------------------------------------------
+#
+#      yields (name, RomImage) for all ROM images below the given paths:
+#      .nes files, archives and archive members. each archive is
+#      opened once. unreadable images are yielded as (name, exception)
+#
+def iter_rom_images(paths):
+    errors = archive_errors()
+    for path in paths:
+        if(os.path.isdir(path)):
+            files = []
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in sorted(names))
+            candidates = [f for f in files if is_rom_name(f) or is_archive_file(f)]
+        else:
+            candidates = [path]
+
+        for candidate in candidates:
+            archive_path, member = split_archive_path(candidate)
+            if(member is None and not is_archive_file(archive_path)):
+                try:
+                    yield candidate, RomImage.from_file(candidate)
+                except errors as e:
+                    yield candidate, e
+                continue
+
+            try:
+                archive = RomArchive(archive_path)
+            except errors as e:
+                yield candidate, e
+                continue
+            # a missing member or a damaged archive ends the archive,
+            # the error is yielded for it
+            try:
+                if(member is not None):
+                    members = [(member, archive.open(member))]
+                else:
+                    members = archive.iter_roms()
+                for name, f in members:
+                    full_name = "%s!%s" % (archive_path, name)
+                    try:
+                        image = RomImage.from_fileobj(f, full_name)
+                    except errors as e:
+                        image = e
+                    yield full_name, image
+            except errors as e:
+                yield candidate, e
+            finally:
+                archive.close()
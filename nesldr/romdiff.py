@@ -0,0 +1,330 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Diffs the PRG-ROM of two revisions of a game, including
+    code that moved between banks.
+
+    Anchors are picked from the old PRG-ROM with a rolling
+    hash (every k-gram whose top ANCHOR_BITS hash bits are
+    zero), looked up in the new PRG-ROM with the same rolling
+    hash, and every hit is extended in both directions. The
+    result is a list of blocks:
+
+        same      identical bytes at the same offset
+        moved     identical bytes at another offset
+        changed   old bytes without a counterpart
+        inserted  new bytes without a counterpart
+
+    Names and comments can be ported from an annotated
+    database to a new revision with export_annotations() /
+    import_annotations().
+
+    usage:
+        python -m nesldr.romdiff <old.nes> <new.nes> [--min N]
+
+"""
+
+import argparse
+import json
+import sys
+
+from nesldr.structs import *
+from nesldr.rom import RomImage
+
+
+# length of the k-grams used as anchors
+ANCHOR_SIZE = 16
+
+# on average one k-gram in 2 ** ANCHOR_BITS becomes an anchor
+ANCHOR_BITS = 3
+
+# shortest block that is reported as same/moved
+MIN_BLOCK_SIZE = 24
+
+# k-grams occuring more often than this (fill bytes, repeated
+# tables) are useless as anchors
+MAX_ANCHOR_HITS = 16
+
+_HASH_BASE = 257
+_HASH_BITS = 61
+_HASH_MASK = (1 << _HASH_BITS) - 1
+
+
+# ----------------------------------------------------------------------
+#
+#      yields (offset, hash) for every k-gram of data with a
+#      polynomial rolling hash
+#
+def rolling_hashes(data, k=ANCHOR_SIZE):
+    if(len(data) < k):
+        return
+    h = 0
+    for b in data[:k]:
+        h = (h * _HASH_BASE + b) & _HASH_MASK
+    top = pow(_HASH_BASE, k - 1, 1 << _HASH_BITS)
+    yield 0, h
+    for i in range(k, len(data)):
+        h = ((h - data[i - k] * top) * _HASH_BASE + data[i]) & _HASH_MASK
+        yield i - k + 1, h
+
+
+# ----------------------------------------------------------------------
+#
+#      length of the common run of a[i:] and b[j:] (forward) or of
+#      a[:i] and b[:j] (backward). compares whole chunks first
+#
+def _common_forward(a, i, b, j, chunk=0x100):
+    n = 0
+    limit = min(len(a) - i, len(b) - j)
+    while(n + chunk <= limit and a[i + n:i + n + chunk] == b[j + n:j + n + chunk]):
+        n += chunk
+    while(n < limit and a[i + n] == b[j + n]):
+        n += 1
+    return n
+
+
+def _common_backward(a, i, b, j, chunk=0x100):
+    n = 0
+    limit = min(i, j)
+    while(n + chunk <= limit and a[i - n - chunk:i - n] == b[j - n - chunk:j - n]):
+        n += chunk
+    while(n < limit and a[i - n - 1] == b[j - n - 1]):
+        n += 1
+    return n
+
+
+# ----------------------------------------------------------------------
+#
+#      anchors are selected by the high bits of the hash, which depend
+#      on every byte of the k-gram. the low bits modulo 2^61 only
+#      depend on the byte sum
+#
+def is_anchor(h):
+    return h >> (_HASH_BITS - ANCHOR_BITS) == 0
+
+
+class Block(object):
+
+    def __init__(self, kind, old_offset, new_offset, size):
+        self.kind = kind
+        self.old_offset = old_offset
+        self.new_offset = new_offset
+        self.size = size
+
+    def __repr__(self):
+        return "Block(%s, %r, %r, %d)" % (self.kind, self.old_offset,
+                                          self.new_offset, self.size)
+
+
+# ----------------------------------------------------------------------
+#
+#      finds matching blocks between old and new. returns a list of
+#      Block objects sorted by old offset, covering all of old,
+#      followed by the "inserted" blocks covering the rest of new
+#      (old_offset None), sorted by new offset
+#
+def diff_data(old, new, min_size=MIN_BLOCK_SIZE):
+    old = bytes(old)
+    new = bytes(new)
+
+    # index the anchors of old
+    anchors = {}
+    for offset, h in rolling_hashes(old):
+        if(is_anchor(h)):
+            anchors.setdefault(h, []).append(offset)
+
+    # look up all k-grams of new and extend every hit. a k-gram of
+    # new that lies inside an already found match is skipped
+    matches = []
+    covered_until = -1
+    for new_offset, h in rolling_hashes(new):
+        if(new_offset < covered_until or h not in anchors):
+            continue
+        candidates = anchors[h]
+        if(len(candidates) > MAX_ANCHOR_HITS):
+            continue
+        best = None
+        for old_offset in candidates:
+            if(old[old_offset:old_offset + ANCHOR_SIZE] != new[new_offset:new_offset + ANCHOR_SIZE]):
+                continue
+            back = _common_backward(old, old_offset, new, new_offset)
+            start_old, start_new = old_offset - back, new_offset - back
+            size = back + ANCHOR_SIZE + _common_forward(
+                old, old_offset + ANCHOR_SIZE, new, new_offset + ANCHOR_SIZE)
+            # prefer the longest match, then the one that did not move
+            if(best is None or size > best[2] or
+               (size == best[2] and start_old == start_new)):
+                best = (start_old, start_new, size)
+        if(best is not None and best[2] >= min_size):
+            matches.append(best)
+            covered_until = best[1] + best[2]
+
+    # every old byte belongs to at most one block: longest first
+    matches.sort(key=lambda m: -m[2])
+    taken = bytearray(len(old))
+    blocks = []
+    for start_old, start_new, size in matches:
+        # only the parts not claimed by a longer match are kept
+        pos, end = start_old, start_old + size
+        while(pos < end):
+            if(taken[pos]):
+                pos += 1
+                continue
+            stop = taken.find(1, pos, end)
+            if(stop == -1):
+                stop = end
+            if(stop - pos >= min_size):
+                taken[pos:stop] = b"\x01" * (stop - pos)
+                new_offset = start_new + pos - start_old
+                kind = "same" if pos == new_offset else "moved"
+                blocks.append(Block(kind, pos, new_offset, stop - pos))
+            pos = stop
+
+    # whatever is left of old has changed, whatever is left of new
+    # was inserted
+    new_taken = bytearray(len(new))
+    for b in blocks:
+        new_taken[b.new_offset:b.new_offset + b.size] = b"\x01" * b.size
+    for pos, size in _uncovered(taken):
+        blocks.append(Block("changed", pos, None, size))
+    blocks.sort(key=lambda b: b.old_offset)
+    blocks.extend(Block("inserted", None, pos, size) for pos, size in _uncovered(new_taken))
+    return blocks
+
+
+# yields (offset, size) of the runs of zeros in taken
+def _uncovered(taken):
+    pos = taken.find(0)
+    while(pos != -1):
+        end = taken.find(1, pos)
+        if(end == -1):
+            end = len(taken)
+        yield pos, end - pos
+        pos = taken.find(0, end)
+
+
+def diff_images(old, new, min_size=MIN_BLOCK_SIZE):
+    return diff_data(old.prg(), new.prg(), min_size)
+
+
+# ----------------------------------------------------------------------
+#
+#      returns a function translating old PRG-ROM offsets to new ones
+#      (None for offsets without a counterpart)
+#
+def offset_translator(blocks):
+    import bisect
+    matched = [b for b in blocks if b.old_offset is not None and b.new_offset is not None]
+    starts = [b.old_offset for b in matched]
+
+    def translate(offset):
+        i = bisect.bisect_right(starts, offset) - 1
+        if(i < 0):
+            return None
+        b = matched[i]
+        if(offset >= b.old_offset + b.size):
+            return None
+        return b.new_offset + offset - b.old_offset
+    return translate
+
+
+# ----------------------------------------------------------------------
+#
+#      writes the names and comments of all items in the mapped ROM
+#      banks of the current database to a json file, keyed by their
+#      PRG-ROM offset
+#
+def export_annotations(path):
+    import ida_bytes
+    import ida_name
+    import idautils
+    from nesldr.database import prg_bank_map, ea_to_prg_offset
+
+    bank_map = prg_bank_map()
+    result = {}
+    for address in sorted(bank_map):
+        for ea in idautils.Heads(address, address + PRG_BANK_MAP_SLOT_SIZE):
+            entry = {}
+            if(ida_bytes.has_user_name(ida_bytes.get_flags(ea))):
+                entry["name"] = ida_name.get_name(ea)
+            for repeatable in (False, True):
+                cmt = ida_bytes.get_cmt(ea, repeatable)
+                if(cmt):
+                    entry["rcmt" if repeatable else "cmt"] = cmt
+            if(entry):
+                result[ea_to_prg_offset(ea, bank_map)] = entry
+
+    with open(path, "w") as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+    return len(result)
+
+
+# ----------------------------------------------------------------------
+#
+#      applies annotations exported from another revision to the
+#      current database. translate maps the old PRG-ROM offsets to
+#      the new ones, see offset_translator()
+#
+def import_annotations(path, translate):
+    import ida_bytes
+    import ida_name
+    from nesldr.database import prg_bank_map, prg_offset_to_eas, primary_ea
+
+    with open(path, "r") as f:
+        annotations = json.load(f)
+
+    bank_map = prg_bank_map()
+    applied = 0
+    for old_offset, entry in sorted(annotations.items(), key=lambda i: int(i[0])):
+        new_offset = translate(int(old_offset))
+        if(new_offset is None):
+            continue
+        eas = prg_offset_to_eas(new_offset, bank_map)
+        if(not eas):
+            continue
+        # names are unique: the copy code runs from gets it, the
+        # others a repeatable comment pointing there
+        primary = primary_ea(eas)
+        for ea in eas:
+            rcmt = entry.get("rcmt")
+            if("name" in entry and ea == primary and ida_name.get_name(ea) != entry["name"]):
+                ida_name.set_name(ea, entry["name"], ida_name.SN_NOWARN | ida_name.SN_FORCE)
+            elif("name" in entry and ea != primary):
+                note = "%s (also mapped at $%04X)" % (entry["name"], primary)
+                rcmt = note + "\n" + rcmt if rcmt else note
+            if("cmt" in entry):
+                ida_bytes.set_cmt(ea, entry["cmt"], False)
+            if(rcmt):
+                ida_bytes.set_cmt(ea, rcmt, True)
+        applied += 1
+    return applied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nesldr.romdiff")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--min", type=int, default=MIN_BLOCK_SIZE,
+                        help="shortest block reported as same/moved")
+    args = parser.parse_args(argv)
+
+    blocks = diff_images(RomImage.from_file(args.old),
+                         RomImage.from_file(args.new), args.min)
+    for b in blocks:
+        if(b.old_offset is None):
+            new = "%02d:%04x" % (b.new_offset // PRG_PAGE_SIZE, b.new_offset % PRG_PAGE_SIZE)
+            print("%-8s %s  %6d bytes" % (b.kind, new, b.size))
+            continue
+        old = "%02d:%04x" % (b.old_offset // PRG_PAGE_SIZE, b.old_offset % PRG_PAGE_SIZE)
+        if(b.new_offset is None):
+            print("%-8s %s  %6d bytes" % (b.kind, old, b.size))
+        else:
+            new = "%02d:%04x" % (b.new_offset // PRG_PAGE_SIZE, b.new_offset % PRG_PAGE_SIZE)
+            print("%-8s %s -> %s  %6d bytes" % (b.kind, old, new, b.size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Read-only view of the whole PRG-ROM and CHR-ROM of a
+    database for scripts and plugins. The page blobs stored by
+    the loader are read once per database; all accessors then
+    return memoryviews (or NumPy arrays sharing their memory,
+    if numpy is installed) into that single copy.
+
+    romview() returns the cached view of the open database.
+    It is rebuilt when another database is opened and picks
+    up bank map changes (e.g. nesldr.multicart.load_subgame())
+    without reading the pages again.
+
+    usage (inside IDA):
+        from nesldr.romview import romview
+        view = romview()
+        prg = view.prg_array()
+        ea = view.offset_to_ea(offset)
+
+"""
+
+from nesldr.structs import *
+from nesldr.banks import prg_window_size, prg_offset_to_address, address_to_prg_offset
+
+
+# ----------------------------------------------------------------------
+#
+#      the PRG-ROM and CHR-ROM areas of an image with the translation
+#      between PRG-ROM offsets, banks and CPU addresses. bank_map is
+#      {8k slot address: PRG-ROM offset} of the database
+#
+class RomView(object):
+
+    def __init__(self, image, bank_map=None):
+        self.image = image
+        self.mapper = image.mapper
+        self.window_size = prg_window_size(image.mapper)
+        self.bank_map = dict(bank_map or {})
+        self.prg = image.prg()
+        self.chr = image.chr()
+        self._arrays = {}
+
+    @classmethod
+    def from_database(cls):
+        from nesldr.database import rom_image_from_database, prg_bank_map
+
+        image = rom_image_from_database()
+        if(image is None):
+            return None
+        return cls(image, prg_bank_map())
+
+    @property
+    def prg_bank_count(self):
+        return len(self.prg) // self.window_size
+
+    @property
+    def chr_page_count(self):
+        return self.image.chr_page_count
+
+    # ----------------------------------------------------------------------
+    #
+    #      the PRG-ROM / CHR-ROM areas as read-only uint8 arrays. needs
+    #      numpy; the arrays share the memory of the view
+    #
+    def _array(self, name, view):
+        array = self._arrays.get(name)
+        if(array is None):
+            try:
+                import numpy
+            except ImportError:
+                raise ImportError("RomView arrays need the numpy package")
+            array = numpy.frombuffer(view, dtype=numpy.uint8)
+            self._arrays[name] = array
+        return array
+
+    def prg_array(self):
+        return self._array("prg", self.prg)
+
+    def chr_array(self):
+        return self._array("chr", self.chr)
+
+    # CHR-ROM as (tiles, 16) array, 16 bytes per 8x8 tile
+    def chr_tiles(self):
+        return self.chr_array().reshape(-1, 16)
+
+    # ----------------------------------------------------------------------
+    #
+    #      one PRG-ROM bank of the mapper's window size (or of size) and
+    #      one 8k CHR-ROM page
+    #
+    def prg_bank(self, index, size=None):
+        size = size or self.window_size
+        if(not 0 <= index < len(self.prg) // size):
+            raise IndexError("PRG-ROM bank %d out of range" % index)
+        return self.prg[index * size:(index + 1) * size]
+
+    def chr_page(self, index):
+        return self.image.chr_page(index)
+
+    def bank_of(self, offset):
+        return offset // self.window_size
+
+    # ----------------------------------------------------------------------
+    #
+    #      PRG-ROM offsets and CPU addresses: the usual address of an
+    #      offset, and the offset of an address as seen from code at
+    #      origin (see nesldr/banks.py)
+    #
+    def offset_to_address(self, offset):
+        return prg_offset_to_address(len(self.prg), self.window_size, offset)
+
+    def address_to_offset(self, address, origin):
+        return address_to_prg_offset(len(self.prg), self.window_size, origin, address)
+
+    # ----------------------------------------------------------------------
+    #
+    #      PRG-ROM offsets and addresses in the database. an offset may
+    #      be mapped at several addresses, offset_to_ea() returns the
+    #      lowest. None if that part of the PRG-ROM is not mapped
+    #
+    def offset_to_eas(self, offset):
+        return sorted(address + offset - prg_offset for address, prg_offset in self.bank_map.items()
+                      if prg_offset <= offset < prg_offset + PRG_BANK_MAP_SLOT_SIZE)
+
+    def offset_to_ea(self, offset):
+        eas = self.offset_to_eas(offset)
+        return eas[0] if eas else None
+
+    def ea_to_offset(self, ea):
+        slot = ea - ea % PRG_BANK_MAP_SLOT_SIZE
+        if(slot not in self.bank_map):
+            return None
+        return self.bank_map[slot] + ea - slot
+
+    def is_mapped(self, offset):
+        return self.offset_to_ea(offset) is not None
+
+    def __repr__(self):
+        return "RomView(mapper %d, %dk PRG-ROM, %dk CHR-ROM, %d slot(s) mapped)" % \
+            (self.mapper, len(self.prg) // 1024, len(self.chr) // 1024, len(self.bank_map))
+
+
+# cached view of the open database: (idb path, RomView)
+_cache = {}
+_hooks = None
+
+
+def _install_hooks():
+    global _hooks
+    import ida_idp
+
+    class RomViewHooks(ida_idp.IDB_Hooks):
+
+        def closebase(self):
+            invalidate_romview()
+            return 0
+
+    _hooks = RomViewHooks()
+    _hooks.hook()
+
+
+def invalidate_romview():
+    _cache.clear()
+
+
+# ----------------------------------------------------------------------
+#
+#      the RomView of the open database, None if the loader stored no
+#      image. the pages are read on the first call per database, the
+#      bank map is compared on every call
+#
+def romview():
+    import ida_loader
+    from nesldr.database import prg_bank_map
+
+    if(_hooks is None):
+        _install_hooks()
+    path = ida_loader.get_path(ida_loader.PATH_TYPE_IDB)
+    view = _cache.get(path)
+    if(view is None):
+        view = RomView.from_database()
+        if(view is None):
+            return None
+        _cache.clear()
+        _cache[path] = view
+    else:
+        bank_map = prg_bank_map()
+        if(bank_map != view.bank_map):
+            view.bank_map = bank_map
+    return view
@@ -0,0 +1,382 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Importing the machine state of an emulator snapshot into
+    the database: the internal RAM and the SRAM are written to
+    their segments in one go, the ROM segment is remapped to
+    the PRG-ROM banks selected when the snapshot was taken,
+    and CHR-RAM, nametables, palette and OAM are stored in the
+    database (SAVESTATE_MEMORY_NODE).
+
+        FCEUX       .fcs / .fc0-.fc9 save states ("FCSX", and
+                    the older uncompressed "FCS" format)
+        Mesen       memory dumps exported from the memory
+                    viewer (File > Export), one file per memory
+                    type. Mesen's .mss save states store their
+                    components without names in a layout that
+                    changes between versions and are not read.
+
+    FCEUX states are a sequence of sections (type byte, 32-bit
+    size) holding named chunks (4 byte name, 32-bit size, data),
+    zlib compressed as a whole. They are decompressed and split
+    into chunks while being read, so no copy of the whole state
+    is made.
+
+    The active banks are decoded from the mapper registers the
+    state holds, for the mappers nesldr/bankprop.py knows: the
+    latch mappers (FCEUX "LATC"), MMC1 ("DREG") and MMC3
+    ("REGS", "CMD"). Other mappers keep the banks the loader
+    mapped.
+
+    usage:
+        python -m nesldr.savestate <state.fc0> [--rom <rom.nes>]
+        python -m nesldr.savestate --dump ram=<file> [--dump sram=<file>...] [--rom <rom.nes>]
+
+"""
+
+import argparse
+import struct
+import sys
+import zlib
+
+from nesldr.structs import *
+from nesldr.mappers import *
+from nesldr.bankprop import LATCH_MAPPERS, MMC3_PRG_REGISTERS
+
+
+FCS_MAGIC = b"FCS"
+FCSX_MAGIC = b"FCSX"
+FCS_HDR_SIZE = 16
+FCS_UNCOMPRESSED = 0xFFFFFFFF
+
+# FCEUX section types
+FCS_SECTION_CPU = 1
+FCS_SECTION_CPUC = 2
+FCS_SECTION_PPU = 3
+FCS_SECTION_CTRL = 4
+FCS_SECTION_SOUND = 5
+FCS_SECTION_MAPPER = 0x10
+
+# internal RAM, mirrored up to RAM_SIZE
+CPU_RAM_SIZE = 0x800
+
+# memory types of a state and the FCEUX chunks holding them
+MEMORY_RAM = "RAM"
+MEMORY_SRAM = "SRAM"
+MEMORY_CHR_RAM = "CHR-RAM"
+MEMORY_NAMETABLES = "nametables"
+MEMORY_PALETTE = "palette"
+MEMORY_OAM = "OAM"
+
+FCS_MEMORY_CHUNKS = {
+    "RAM": MEMORY_RAM,
+    "WRAM": MEMORY_SRAM,
+    "SRAM": MEMORY_SRAM,
+    "CHRR": MEMORY_CHR_RAM,
+    "NTAR": MEMORY_NAMETABLES,
+    "PRAM": MEMORY_PALETTE,
+    "SPRA": MEMORY_OAM,
+}
+
+# memory dumps by the names given on the command line
+DUMP_KINDS = {
+    "ram": MEMORY_RAM,
+    "sram": MEMORY_SRAM,
+    "chr": MEMORY_CHR_RAM,
+    "nametables": MEMORY_NAMETABLES,
+    "palette": MEMORY_PALETTE,
+    "oam": MEMORY_OAM,
+}
+
+# memory stored in the database instead of a segment
+PPU_MEMORY = (MEMORY_CHR_RAM, MEMORY_NAMETABLES, MEMORY_PALETTE, MEMORY_OAM)
+
+CPU_REGISTERS = ("PC", "A", "X", "Y", "S", "P")
+
+# decompress in blocks of this size
+_BLOCK_SIZE = 1 << 16
+
+
+class SaveStateError(ValueError):
+    pass
+
+
+# ----------------------------------------------------------------------
+#
+#      the parts of a snapshot the import uses. memory is {memory type:
+#      bytes}, registers {name: value}, mapper_chunks the raw chunks of
+#      the mapper section {name: bytes}
+#
+class SaveState(object):
+
+    def __init__(self, source=None, format=None):
+        self.source = source
+        self.format = format
+        self.version = None
+        self.memory = {}
+        self.registers = {}
+        self.mapper_chunks = {}
+
+    def __repr__(self):
+        return "SaveState(%s %s, %s)" % (self.format, self.source,
+                                          ", ".join(sorted(self.memory)) or "no memory")
+
+
+# ----------------------------------------------------------------------
+#
+#      file object returning the decompressed bytes of a zlib stream
+#      as they are read
+#
+class ZlibReader(object):
+
+    def __init__(self, f):
+        self.f = f
+        self.inflater = zlib.decompressobj()
+        self.buffer = b""
+
+    def read(self, size):
+        while(len(self.buffer) < size and not self.inflater.eof):
+            data = self.f.read(_BLOCK_SIZE)
+            if(not data):
+                break
+            self.buffer += self.inflater.decompress(data)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _read_exactly(f, size, what):
+    data = f.read(size)
+    if(len(data) != size):
+        raise SaveStateError("truncated save state (%s)" % what)
+    return data
+
+
+# ----------------------------------------------------------------------
+#
+#      yields (section type, chunk name, data) for all chunks of an
+#      FCEUX save state. sets version in info (a dict) if given
+#
+def iter_fcs_chunks(f, info=None):
+    hdr = f.read(FCS_HDR_SIZE)
+    if(len(hdr) != FCS_HDR_SIZE or not hdr.startswith(FCS_MAGIC)):
+        raise SaveStateError("not an FCEUX save state")
+    total_size, version, compressed_size = struct.unpack("<III", hdr[4:])
+    if(hdr.startswith(FCSX_MAGIC)):
+        if(compressed_size != FCS_UNCOMPRESSED):
+            f = ZlibReader(f)
+    else:
+        version = hdr[3]
+    if(info is not None):
+        info["version"] = version
+
+    position = 0
+    while(position < total_size):
+        kind = f.read(1)
+        if(not kind):
+            break
+        section_size, = struct.unpack("<I", _read_exactly(f, 4, "section header"))
+        position += 5 + section_size
+        left = section_size
+        while(left >= 8):
+            name, size = struct.unpack("<4sI", _read_exactly(f, 8, "chunk header"))
+            if(size > left - 8):
+                raise SaveStateError("chunk %r overruns its section" % name)
+            yield kind[0], name.rstrip(b"\0").decode("latin-1"), _read_exactly(f, size, name)
+            left -= 8 + size
+        _read_exactly(f, left, "section padding")
+
+
+def read_fcs(path):
+    state = SaveState(path, "FCEUX")
+    info = {}
+    with open(path, "rb") as f:
+        for section, name, data in iter_fcs_chunks(f, info):
+            if(name in FCS_MEMORY_CHUNKS):
+                state.memory[FCS_MEMORY_CHUNKS[name]] = data
+            elif(section == FCS_SECTION_CPU and name in CPU_REGISTERS):
+                state.registers[name] = int.from_bytes(data, "little")
+            elif(section == FCS_SECTION_MAPPER):
+                state.mapper_chunks[name] = data
+    state.version = info.get("version")
+    return state
+
+
+# ----------------------------------------------------------------------
+#
+#      a snapshot made of memory dumps, dumps being {memory type: path}
+#
+def read_memory_dumps(dumps):
+    state = SaveState(", ".join(sorted(dumps.values())), "memory dumps")
+    for kind, path in dumps.items():
+        with open(path, "rb") as f:
+            state.memory[kind] = f.read()
+    return state
+
+
+# ----------------------------------------------------------------------
+#
+#      the PRG-ROM banks selected by the mapper registers of a state as
+#      [(address, PRG-ROM offset, size)]: the switched window of latch
+#      mappers, the whole ROM segment for MMC1 and MMC3. None if the
+#      registers are missing or the mapper is not known
+#
+def active_prg_banks(mapper, prg_size, chunks):
+    if(prg_size == 0):
+        return None
+    if(mapper in LATCH_MAPPERS and "LATC" in chunks):
+        window_size, window_address, shift, mask, _ = LATCH_MAPPERS[mapper]
+        bank = (chunks["LATC"][0] >> shift) & mask
+        return [(window_address, (bank * window_size) % prg_size, window_size)]
+
+    if(mapper == MAPPER_MMC1 and len(chunks.get("DREG", b"")) == 4):
+        control, prg = chunks["DREG"][0], chunks["DREG"][3] & 0x0F
+        pages = prg_size // PRG_PAGE_SIZE
+        mode = (control >> 2) & 3
+        if(mode < 2):
+            return [(ROM_START_ADDRESS, ((prg & 0x0E) % pages) * PRG_PAGE_SIZE,
+                     min(ROM_SIZE, prg_size))]
+        if(mode == 2):
+            return [(PRG_ROM_BANK_LOW_ADDRESS, 0, PRG_PAGE_SIZE),
+                    (PRG_ROM_BANK_HIGH_ADDRESS, (prg % pages) * PRG_PAGE_SIZE, PRG_PAGE_SIZE)]
+        return [(PRG_ROM_BANK_LOW_ADDRESS, (prg % pages) * PRG_PAGE_SIZE, PRG_PAGE_SIZE),
+                (PRG_ROM_BANK_HIGH_ADDRESS, prg_size - PRG_PAGE_SIZE, PRG_PAGE_SIZE)]
+
+    if(mapper == MAPPER_MMC3 and len(chunks.get("REGS", b"")) == 8 and "CMD" in chunks):
+        regs, swapped = chunks["REGS"], chunks["CMD"][0] & 0x40
+        banks = prg_size // PRG_ROM_8K_BANK_SIZE
+        layout = []
+        for register, address in sorted(MMC3_PRG_REGISTERS.items()):
+            if(swapped and address == PRG_ROM_BANK_8000):
+                address = PRG_ROM_BANK_C000
+            layout.append((address, (regs[register] % banks) * PRG_ROM_8K_BANK_SIZE,
+                           PRG_ROM_8K_BANK_SIZE))
+        fixed = PRG_ROM_BANK_8000 if swapped else PRG_ROM_BANK_C000
+        layout.append((fixed, prg_size - 2 * PRG_ROM_8K_BANK_SIZE, PRG_ROM_8K_BANK_SIZE))
+        layout.append((PRG_ROM_BANK_E000, prg_size - PRG_ROM_8K_BANK_SIZE, PRG_ROM_8K_BANK_SIZE))
+        return sorted(layout)
+    return None
+
+
+# ----------------------------------------------------------------------
+#
+#      writes a state into the database. returns a list of lines
+#      describing what was imported
+#
+def apply_save_state(state, remap=True):
+    import ida_auto
+    import ida_bytes
+    import ida_loader
+    import ida_netnode
+    import ida_segment
+    from nesldr.database import map_prg_banks
+    from nesldr.romview import romview
+
+    lines = []
+
+    ram = state.memory.get(MEMORY_RAM)
+    if(ram is not None and ida_segment.getseg(RAM_START_ADDRESS) is not None):
+        ram = ram[:CPU_RAM_SIZE]
+        ida_loader.mem2base(ram * (RAM_SIZE // CPU_RAM_SIZE), RAM_START_ADDRESS, -1)
+        lines.append("RAM: %d bytes" % len(ram))
+
+    sram = state.memory.get(MEMORY_SRAM)
+    if(sram is not None):
+        if(ida_segment.getseg(SRAM_START_ADDRESS) is not None):
+            ida_loader.mem2base(sram[:SRAM_SIZE], SRAM_START_ADDRESS, -1)
+            lines.append("SRAM: %d bytes" % min(len(sram), SRAM_SIZE))
+        else:
+            lines.append("SRAM: skipped, the database has no SRAM segment")
+
+    view = romview()
+    if(remap and view is not None):
+        layout = active_prg_banks(view.mapper, len(view.prg), state.mapper_chunks)
+        if(layout is not None):
+            map_prg_banks(layout, view.prg)
+            for address, _, size in layout:
+                ida_auto.plan_range(address, address + size)
+            lines.extend("bank at $%04X: PRG-ROM $%06X (%dk)" % (address, offset, size // 1024)
+                         for address, offset, size in layout)
+
+    for kind in PPU_MEMORY:
+        data = state.memory.get(kind)
+        if(data is not None):
+            node = ida_netnode.netnode(SAVESTATE_MEMORY_NODE % kind, 0, True)
+            node.setblob(bytes(data), 0, 'I')
+            lines.append("%s: %d bytes stored" % (kind, len(data)))
+
+    if(state.registers):
+        node = ida_netnode.netnode(SAVESTATE_NODE, 0, True)
+        for i, name in enumerate(CPU_REGISTERS):
+            if(name in state.registers):
+                node.altset(i, state.registers[name] + 1)
+        lines.append(describe_registers(state.registers))
+        pc = state.registers.get("PC")
+        if(pc is not None and ida_segment.getseg(pc) is not None):
+            ida_bytes.set_cmt(pc, "save state: %s" % describe_registers(state.registers), True)
+            ida_auto.auto_make_code(pc)
+    return lines
+
+
+def describe_registers(registers):
+    return " ".join(("%s=$%04X" if name == "PC" else "%s=$%02X") % (name, registers[name])
+                    for name in CPU_REGISTERS if name in registers)
+
+
+# ----------------------------------------------------------------------
+#
+#      reads a save state file and imports it. returns the lines of
+#      apply_save_state()
+#
+def import_save_state(path, remap=True):
+    return apply_save_state(read_fcs(path), remap)
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+
+    parser = argparse.ArgumentParser(prog="nesldr.savestate")
+    parser.add_argument("state", nargs="?", help="FCEUX save state")
+    parser.add_argument("--dump", action="append", default=[], metavar="KIND=FILE",
+                        help="memory dump, KIND one of %s" % ", ".join(sorted(DUMP_KINDS)))
+    parser.add_argument("--rom", help="ROM image, to decode the active banks")
+    args = parser.parse_args(argv)
+
+    try:
+        if(args.state):
+            state = read_fcs(args.state)
+        else:
+            dumps = {}
+            for arg in args.dump:
+                kind, _, path = arg.partition("=")
+                if(kind not in DUMP_KINDS or not path):
+                    parser.error("bad memory dump %r" % arg)
+                dumps[DUMP_KINDS[kind]] = path
+            if(not dumps):
+                parser.error("no save state or memory dump given")
+            state = read_memory_dumps(dumps)
+    except (OSError, SaveStateError, zlib.error) as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+
+    print("%s%s" % (state.format, "" if state.version is None else " (version %d)" % state.version))
+    for kind, data in sorted(state.memory.items()):
+        print("  %-12s %6d bytes" % (kind, len(data)))
+    if(state.registers):
+        print("  %s" % describe_registers(state.registers))
+    if(state.mapper_chunks):
+        print("  mapper: %s" % ", ".join("%s[%d]" % (name, len(data))
+                                         for name, data in sorted(state.mapper_chunks.items())))
+    if(args.rom):
+        image = RomImage.from_file(args.rom)
+        layout = active_prg_banks(image.mapper, len(image.prg()), state.mapper_chunks)
+        if(layout is None):
+            print("  active banks: unknown for mapper %d" % image.mapper)
+        for address, offset, size in layout or ():
+            print("  $%04X: PRG-ROM $%06X (%dk)" % (address, offset, size // 1024))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
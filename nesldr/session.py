@@ -0,0 +1,241 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    The state of loading one iNES image: its header, the image
+    and the plan of which PRG-ROM banks are mapped where. A
+    session holds no module-global state and makes no IDA
+    calls, so any number of them can be used from threads or
+    one after another in a single process. The IDA loader
+    (loaders/nes.py) runs its loading stages as methods of a
+    subclass.
+
+    usage:
+        python -m nesldr.session <rom.nes>...
+
+"""
+
+import argparse
+import sys
+
+from nesldr.structs import *
+from nesldr.mappers import *
+from nesldr.rom import RomImage, iter_rom_images
+from nesldr.classify import classify_prg
+
+
+# mappers loaded as: 1st prg, last prg, 1st chr
+FIRST_LAST_MAPPERS = (MAPPER_NONE,
+                      MAPPER_MMC1,
+                      MAPPER_UNROM,
+                      MAPPER_CNROM,
+                      MAPPER_MMC3,
+                      MAPPER_MMC5,
+                      MAPPER_FFE_F4XXX,
+                      MAPPER_MMC4,
+                      MAPPER_BANDAI,
+                      MAPPER_FFE_F8XXX,
+                      MAPPER_JALECO_SS8806,
+                      MAPPER_KONAMI_VRC4,
+                      MAPPER_KONAMI_VRC2_TYPE_A,
+                      MAPPER_KONAMI_VRC2_TYPE_B,
+                      MAPPER_KONAMI_VRC6,
+                      MAPPER_NAMCOT_106,
+                      MAPPER_IREM_G_101,
+                      MAPPER_TAITO_TC0190,
+                      MAPPER_IREM_H_3001,
+                      MAPPER_SUNSOFT_MAPPER_4,
+                      MAPPER_SUNSOFT_FME7,  # not sure about this mapper
+                      MAPPER_CAMERICA,
+                      MAPPER_IREM_74HC161_32,
+                      MAPPER_GNROM)
+
+# mappers loaded as: 1st prg, 2nd prg, 1st chr
+FIRST_SECOND_MAPPERS = (MAPPER_AOROM,
+                        MAPPER_FFE_F3XXX,
+                        MAPPER_COLOR_DREAMS,
+                        MAPPER_100_IN_1,
+                        MAPPER_NINA_1)
+
+
+# ----------------------------------------------------------------------
+#
+#      one bank to load: the address it is mapped to, its offset
+#      in the PRG-ROM (or CHR-ROM) area and its size
+#
+class BankLoad(object):
+
+    def __init__(self, address, offset, size, chr=False):
+        self.address = address
+        self.offset = offset
+        self.size = size
+        self.chr = chr
+
+    def __repr__(self):
+        return "BankLoad(%s %06X -> $%04X, %dk)" % \
+            ("CHR" if self.chr else "PRG", self.offset, self.address, self.size // 1024)
+
+
+# ----------------------------------------------------------------------
+#
+#      the banks loaded for a mapper. bank numbers are counted from
+#      one, like the loader always did; bank zero or an image without
+#      PRG-ROM loads nothing. returns None for unsupported mappers
+#
+def plan_banks(mapper, prg_page_count):
+    plan = []
+
+    def prg(banknr, address, size=PRG_ROM_BANK_SIZE):
+        if(banknr != 0 and prg_page_count != 0):
+            plan.append(BankLoad(address, (banknr - 1) * size, size))
+
+    if(mapper in FIRST_LAST_MAPPERS):
+        prg(1, PRG_ROM_BANK_LOW_ADDRESS)
+        prg(prg_page_count, PRG_ROM_BANK_HIGH_ADDRESS)
+    elif(mapper == MAPPER_HK_SF3):  # last prg, last prg, 1st chr
+        prg(prg_page_count, PRG_ROM_BANK_LOW_ADDRESS)
+        prg(prg_page_count, PRG_ROM_BANK_HIGH_ADDRESS)
+    elif(mapper in FIRST_SECOND_MAPPERS):
+        prg(1, PRG_ROM_BANK_LOW_ADDRESS)
+        prg(2, PRG_ROM_BANK_HIGH_ADDRESS)
+    elif(mapper == MAPPER_MMC2):  # 1st 8k prg, last three 8k prgs, 1st chr
+        prg(1, PRG_ROM_BANK_LOW_ADDRESS, PRG_ROM_8K_BANK_SIZE)
+        prg(prg_page_count * 2 - 2, PRG_ROM_BANK_A000, PRG_ROM_8K_BANK_SIZE)
+        prg(prg_page_count, PRG_ROM_BANK_HIGH_ADDRESS)
+    elif(mapper == MAPPER_TENGEN_RAMBO_1):  # last 8k prg four times, 1st chr
+        for address in (PRG_ROM_BANK_8000, PRG_ROM_BANK_A000,
+                        PRG_ROM_BANK_C000, PRG_ROM_BANK_E000):
+            prg(prg_page_count * 2, address, PRG_ROM_8K_BANK_SIZE)
+    else:
+        return None
+
+    plan.append(BankLoad(CHR_ROM_BANK_ADDRESS, 0, CHR_ROM_BANK_SIZE, True))
+    return plan
+
+
+class LoadSession(object):
+
+    def __init__(self, data, name=None):
+        self.name = name
+        self.image = RomImage(data, name)
+        # a copy, fix_header() must not change the image
+        self.hdr = ines_hdr.from_buffer_copy(self.image.header_bytes())
+        self._prg = None
+        self._scores = None
+
+    @classmethod
+    def from_file(cls, path):
+        image = RomImage.from_file(path)
+        return cls(image.data, image.name)
+
+    # loader input (li) or any file object with seek() and read()
+    @classmethod
+    def from_fileobj(cls, f, name=None):
+        f.seek(0)
+        return cls(f.read(), name)
+
+    @property
+    def mapper(self):
+        return INES_MASK_MAPPER_VERSION(self.hdr.rom_control_byte_0,
+                                        self.hdr.rom_control_byte_1)
+
+    @property
+    def has_trainer(self):
+        return bool(INES_MASK_TRAINER(self.hdr.rom_control_byte_0))
+
+    # TV system flag of iNES byte 9, the first reserved byte
+    @property
+    def is_pal(self):
+        return bool(self.hdr.reserved[0] & 0x1)
+
+    @property
+    def prg_page_count(self):
+        return self.hdr.prg_page_count_16k
+
+    @property
+    def chr_page_count(self):
+        return self.hdr.chr_page_count_8k
+
+    # file offsets of the PRG-ROM and CHR-ROM areas
+    @property
+    def prg_offset(self):
+        return INES_HDR_SIZE + (TRAINER_SIZE if self.has_trainer else 0)
+
+    @property
+    def chr_offset(self):
+        return self.prg_offset + PRG_PAGE_SIZE * self.prg_page_count
+
+    def is_corrupt(self):
+        return self.hdr.is_corrupt_ines_hdr()
+
+    # fixes the session's copy of the header, not the image
+    def fix_header(self):
+        self.hdr.fix_ines_hdr()
+        self._prg = self._scores = None
+
+    def header_bytes(self):
+        return bytes(self.hdr)
+
+    def trainer(self):
+        if(not self.has_trainer):
+            return None
+        return self.image.data[INES_HDR_SIZE:INES_HDR_SIZE + TRAINER_SIZE]
+
+    # ----------------------------------------------------------------------
+    #
+    #      the PRG-ROM area as given by the header (shorter if the image
+    #      is truncated). read once per session
+    #
+    def prg(self):
+        if(self._prg is None):
+            self._prg = self.image.data[self.prg_offset:self.chr_offset]
+        return self._prg
+
+    # code scores of every PRG-ROM offset (see nesldr/classify.py)
+    def code_scores(self):
+        if(self._scores is None):
+            self._scores = classify_prg(self.prg(), self.mapper)
+        return self._scores
+
+    def prg_page(self, index):
+        return self.prg()[index * PRG_PAGE_SIZE:(index + 1) * PRG_PAGE_SIZE]
+
+    def chr_page(self, index):
+        start = self.chr_offset + index * CHR_PAGE_SIZE
+        return self.image.data[start:start + CHR_PAGE_SIZE]
+
+    def is_supported_mapper(self):
+        return plan_banks(self.mapper, 0) is not None
+
+    def bank_plan(self):
+        return plan_banks(self.mapper, self.prg_page_count)
+
+    # file offset of a planned bank
+    def file_offset(self, load):
+        return (self.chr_offset if load.chr else self.prg_offset) + load.offset
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nesldr.session")
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args(argv)
+
+    status = 0
+    for name, image in iter_rom_images(args.paths):
+        if(isinstance(image, Exception)):
+            sys.stderr.write("%s: %s\n" % (name, image))
+            status = 1
+            continue
+        session = LoadSession(image.data, name)
+        plan = session.bank_plan()
+        print("%s: mapper %d%s%s" % (name, session.mapper,
+                                     ", corrupt header" if session.is_corrupt() else "",
+                                     "" if plan is not None else ", not supported"))
+        for load in plan or ():
+            print("  %r" % load)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Byte signatures for well known 6502 code (sound drivers,
+    controller reading routines, math helpers, ...).
+
+    signature file format, one signature per line:
+
+        <name> <hex bytes, ?? for any byte> [; <C declaration>]
+
+    e.g.
+
+        read_joypad A9 01 8D 16 40 A9 00 8D 16 40 A2 08 AD 16 40 ?? ; void read_joypad();
+
+    All signatures are matched in a single pass over the
+    PRG-ROM with an Aho-Corasick automaton built from the
+    longest fixed part ("anchor") of every signature.
+
+    usage:
+        python -m nesldr.signatures <signatures> <rom.nes>
+
+"""
+
+import re
+import sys
+from array import array
+
+from nesldr.structs import *
+
+
+# anchors are cut to this many bytes to keep the automaton small
+MAX_ANCHOR_SIZE = 8
+
+WILDCARDS = ("??", "..")
+
+
+class SignatureError(ValueError):
+    pass
+
+
+# ----------------------------------------------------------------------
+#
+#      a single signature. pattern is a list of byte values,
+#      None for wildcards
+#
+class Signature(object):
+
+    def __init__(self, name, pattern, decl=None):
+        if(all(b is None for b in pattern)):
+            raise SignatureError("signature %s has no fixed bytes" % name)
+        self.name = name
+        self.pattern = pattern
+        self.decl = decl
+        self.regex = re.compile(b"".join(
+            b"." if b is None else re.escape(bytes([b])) for b in pattern), re.DOTALL)
+
+        # the longest run of fixed bytes becomes the anchor
+        best_start, best_len, start = 0, 0, None
+        for i, b in enumerate(pattern + [None]):
+            if(b is not None and start is None):
+                start = i
+            elif(b is None and start is not None):
+                if(i - start > best_len):
+                    best_start, best_len = start, i - start
+                start = None
+        self.anchor_offset = best_start
+        self.anchor = bytes(pattern[best_start:best_start + min(best_len, MAX_ANCHOR_SIZE)])
+
+    def __len__(self):
+        return len(self.pattern)
+
+    def __repr__(self):
+        return "Signature(%r)" % self.name
+
+
+def parse_signature_line(line):
+    line = line.strip()
+    if(not line or line.startswith("#")):
+        return None
+
+    decl = None
+    if(";" in line):
+        line, decl = line.split(";", 1)
+        decl = decl.strip() or None
+
+    tokens = line.split()
+    if(len(tokens) < 2):
+        raise SignatureError("malformed signature: %r" % line)
+
+    pattern = []
+    for token in tokens[1:]:
+        if(token in WILDCARDS):
+            pattern.append(None)
+        else:
+            try:
+                if(len(token) != 2):
+                    raise ValueError(token)
+                pattern.append(int(token, 16))
+            except ValueError:
+                raise SignatureError("bad byte %r in signature %s" % (token, tokens[0]))
+    return Signature(tokens[0], pattern, decl)
+
+
+def load_signatures(path):
+    signatures = []
+    with open(path, "r") as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                sig = parse_signature_line(line)
+            except SignatureError as e:
+                raise SignatureError("%s:%d: %s" % (path, lineno, e))
+            if(sig is not None):
+                signatures.append(sig)
+    return signatures
+
+
+# ----------------------------------------------------------------------
+#
+#      Aho-Corasick automaton over all anchors. the goto function is
+#      stored as a complete transition table (256 entries per state),
+#      so scanning costs one table lookup per input byte
+#
+class SignatureMatcher(object):
+
+    def __init__(self, signatures):
+        self.signatures = list(signatures)
+
+        # build the trie
+        children = [{}]
+        outputs = [[]]
+        for sig in self.signatures:
+            state = 0
+            for b in sig.anchor:
+                nxt = children[state].get(b)
+                if(nxt is None):
+                    nxt = len(children)
+                    children[state][b] = nxt
+                    children.append({})
+                    outputs.append([])
+                state = nxt
+            outputs[state].append(sig)
+
+        # complete the transition table breadth first. each state
+        # starts as a copy of its failure state's row
+        count = len(children)
+        delta = array("I", bytes(4 * 0x100 * count))
+        fail = [0] * count
+        queue = []
+        for b, child in children[0].items():
+            delta[b] = child
+            queue.append(child)
+        for state in queue:
+            f = fail[state]
+            row = state << 8
+            delta[row:row + 0x100] = delta[f << 8:(f << 8) + 0x100]
+            outputs[state] = outputs[state] + outputs[f]
+            for b, child in children[state].items():
+                fail[child] = delta[(f << 8) | b] if state else 0
+                delta[row | b] = child
+                queue.append(child)
+
+        self.delta = delta
+        self.outputs = [tuple(o) for o in outputs]
+
+    # ----------------------------------------------------------------------
+    #
+    #      yields (offset, signature) for every full match in data
+    #
+    def scan(self, data):
+        delta = self.delta
+        outputs = self.outputs
+        data = bytes(data)
+        state = 0
+        for pos, b in enumerate(data):
+            state = delta[(state << 8) | b]
+            if(outputs[state]):
+                for sig in outputs[state]:
+                    start = pos + 1 - len(sig.anchor) - sig.anchor_offset
+                    if(start >= 0 and sig.regex.match(data, start)):
+                        yield start, sig
+
+
+# ----------------------------------------------------------------------
+#
+#      matches all signatures against the whole PRG-ROM area of an
+#      image. overlapping matches are resolved in favour of the longer
+#      signature. returns a list of (prg offset, signature)
+#
+def match_prg(image, signatures):
+    matcher = signatures if isinstance(signatures, SignatureMatcher) \
+        else SignatureMatcher(signatures)
+
+    best = {}
+    for offset, sig in matcher.scan(image.prg()):
+        if(offset not in best or len(sig) > len(best[offset])):
+            best[offset] = sig
+
+    result = []
+    end = 0
+    for offset in sorted(best):
+        if(offset < end):
+            continue
+        result.append((offset, best[offset]))
+        end = offset + len(best[offset])
+    return result
+
+
+# ----------------------------------------------------------------------
+#
+#      names and types the matched functions in the IDA database.
+#      matches in banks that are not mapped are remembered in a
+#      netnode (supval index = PRG-ROM offset)
+#
+def apply_matches(matches):
+    import ida_funcs
+    import ida_name
+    import ida_netnode
+    import ida_typeinf
+    from nesldr.database import prg_bank_map, prg_offset_to_eas
+
+    bank_map = prg_bank_map()
+    unmapped = ida_netnode.netnode(PRG_SIGNATURES_NODE, 0, True)
+    applied = 0
+
+    for offset, sig in matches:
+        eas = prg_offset_to_eas(offset, bank_map)
+        if(not eas):
+            unmapped.supset(offset, sig.name)
+            continue
+
+        # every copy of a bank mapped twice gets the function, copies
+        # after the first one a suffixed name
+        for i, ea in enumerate(eas):
+            if(ida_funcs.get_func(ea) is None):
+                ida_funcs.add_func(ea)
+            if(ida_name.get_name(ea) != sig.name):
+                ida_name.set_name(ea, sig.name, ida_name.SN_NOWARN | ida_name.SN_NOCHECK |
+                                  (ida_name.SN_FORCE if i else 0))
+            if(sig.decl):
+                decl = sig.decl if sig.decl.endswith(";") else sig.decl + ";"
+                ida_typeinf.apply_cdecl(None, ea, decl)
+        applied += 1
+
+    return applied
+
+
+def main(argv=None):
+    from nesldr.rom import RomImage
+
+    argv = sys.argv[1:] if argv is None else argv
+    if(len(argv) != 2):
+        sys.stderr.write("usage: python -m nesldr.signatures <signatures> <rom.nes>\n")
+        return 2
+
+    signatures = load_signatures(argv[0])
+    image = RomImage.from_file(argv[1])
+    for offset, sig in match_prg(image, signatures):
+        print("page %02d:%04x  %s" % (offset // PRG_PAGE_SIZE, offset % PRG_PAGE_SIZE, sig.name))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
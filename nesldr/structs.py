@@ -132,14 +132,12 @@ class ines_hdr(Structure):
     #
     #      fix iNES header internally
     #
-
-    def fix_ines_hdr(void):
-        diskdude = b"DiskDude\x00"
-
-        if(self.rom_control_byte_1[0] == diskdude[0] and self.ram_bank_count_8k == diskdude[1] and self.reserved == diskdude[2:]):
-            self.rom_control_byte_1[:] = b'\x00' * 9
-        self.reserved[:] = b'\x00' * sizeof(self.reserved)
-        return
+    def fix_ines_hdr(self):
+        # "DiskDude!" written over bytes 7-15 by an old dumping tool
+        if(bytes(self)[7:16] == b"DiskDude!"):
+            self.rom_control_byte_1 = 0
+            self.ram_bank_count_8k = 0
+        self.reserved[:] = [0] * len(self.reserved)
 
 
 # size of iNES header
@@ -149,9 +147,68 @@ INES_HDR_SIZE = sizeof(ines_hdr)
 # node name for iNES header
 INES_HDR_NODE = "$ iNES ROM header"
 
+# node names for trainer and PRG/CHR ROM pages
+TRAINER_NODE = "$ Trainer"
+PRG_PAGE_NODE = "$ PRG-ROM page %d"
+CHR_PAGE_NODE = "$ CHR-ROM page %d"
+
 BANK_NUM_8000 = "$ Bank 8000"
 BANK_NUM_C000 = "$ Bank C000"
 
+# node recording which PRG-ROM data is mapped into the ROM segment.
+# altval index is the 8k slot (address >> 13), the value is the
+# offset into the PRG-ROM area plus one (zero means unmapped)
+PRG_BANK_MAP_NODE = "$ PRG-ROM bank map"
+PRG_BANK_MAP_SLOT_SIZE = 0x2000
+
+# names of signature matches in unmapped PRG-ROM (supval index = offset)
+PRG_SIGNATURES_NODE = "$ PRG-ROM signatures"
+
+# imported symbols in unmapped PRG-ROM (supval index = offset, tag 'N'
+# for names, 'C' for comments), see nesldr/symbols.py
+PRG_SYMBOLS_NODE = "$ PRG-ROM symbols"
+
+# decoded text blocks in unmapped PRG-ROM (supval index = offset)
+PRG_TEXT_NODE = "$ PRG-ROM text"
+
+# entropy map ('E') and page histograms ('H') of the PRG-ROM.
+# altval 0 and 1 hold window size and step of the map
+PRG_ENTROPY_NODE = "$ PRG-ROM entropy"
+
+# vectors of all PRG-ROM banks ('V'): 16-bit words window, NMI, RESET,
+# IRQ per bank. altval 0 holds the window size
+PRG_VECTORS_NODE = "$ PRG-ROM vectors"
+
+# RAM usage index ('U', zlib compressed), see nesldr/ramusage.py
+RAM_USAGE_NODE = "$ RAM usage"
+
+# cross-bank references into unmapped banks, "bank:address" (supval
+# index = PRG-ROM offset of the JSR/JMP), see nesldr/bankprop.py
+PRG_CROSS_BANK_REFS_NODE = "$ PRG-ROM cross-bank refs"
+
+# sub-games of a multicart ('D'): 32-bit words PRG-ROM offset, size,
+# NMI, RESET, IRQ, reset stub score per game. altval 0 holds the count
+MULTICART_NODE = "$ Multicart directory"
+
+# code likelihood (0-255) of every PRG-ROM offset ('S', zlib
+# compressed), see nesldr/classify.py
+CODE_SCORES_NODE = "$ PRG-ROM code scores"
+
+# imported Code/Data Logger flags of PRG-ROM and CHR-ROM ('C', zlib
+# compressed). altval 0 holds the PRG-ROM size
+CDL_NODE = "$ CDL map"
+
+# the sides of a Famicom Disk System image (65500 bytes each, 'I'),
+# see nesldr/containers.py. altval 0 holds the side count
+FDS_SIDE_NODE = "$ FDS disk side %d"
+FDS_SIDES_NODE = "$ FDS disk sides"
+
+# PPU memory of an imported save state ('I'): "CHR-RAM", "nametables",
+# "palette" and "OAM", see nesldr/savestate.py. the CPU registers are
+# kept as altvals plus one (PC, A, X, Y, S, P)
+SAVESTATE_MEMORY_NODE = "$ Save state %s"
+SAVESTATE_NODE = "$ Save state"
+
 # macros for masking control byte (cb) flags of the header
 
 
@@ -0,0 +1,352 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Importing labels and comments from emulator and assembler
+    symbol files:
+
+        FCEUX       <rom>.nes.<bank>.nl, <rom>.nes.ram.nl
+        Mesen       .mlb (Mesen 1 and Mesen 2 memory types)
+        ca65/ld65   .dbg (labels of segments written to the ROM)
+
+    The files are parsed line by line. Labels in PRG-ROM are
+    located by their PRG-ROM offset and applied in the mapped
+    banks; labels in unmapped banks are kept in a netnode
+    (supval index = offset, tag 'N' for names, 'C' for
+    comments). Labels of RAM, SRAM and registers are applied
+    at their CPU address.
+
+    usage:
+        python -m nesldr.symbols <symbol file>...
+
+"""
+
+import argparse
+import os
+import re
+import sys
+
+from nesldr.structs import *
+
+
+SYMBOL_PRG = "prg"      # location is a PRG-ROM offset
+SYMBOL_CPU = "cpu"      # location is a CPU address
+
+# Mesen memory types -> (kind, base address)
+MLB_MEMORY_TYPES = {
+    "P": (SYMBOL_PRG, 0), "NesPrgRom": (SYMBOL_PRG, 0),
+    "R": (SYMBOL_CPU, 0), "NesInternalRam": (SYMBOL_CPU, 0),
+    "S": (SYMBOL_CPU, SRAM_START_ADDRESS), "NesSaveRam": (SYMBOL_CPU, SRAM_START_ADDRESS),
+    "W": (SYMBOL_CPU, SRAM_START_ADDRESS), "NesWorkRam": (SYMBOL_CPU, SRAM_START_ADDRESS),
+    "G": (SYMBOL_CPU, 0), "NesMemory": (SYMBOL_CPU, 0),
+}
+
+_nl_name_re = re.compile(r"\.(?:nes\.)?([0-9A-Fa-f]+|ram)\.nl$", re.IGNORECASE)
+_dbg_field_re = re.compile(r'(\w+)=("(?:[^"\\]|\\.)*"|[^,]*)')
+_invalid_name_chars_re = re.compile(r"[^A-Za-z0-9_@?$.]")
+
+
+class SymbolError(Exception):
+    pass
+
+
+class Symbol(object):
+
+    def __init__(self, kind, location, name, comment=None, size=1):
+        self.kind = kind
+        self.location = location
+        self.name = name
+        self.comment = comment
+        self.size = size
+
+    @property
+    def key(self):
+        return self.kind, self.location
+
+    def __repr__(self):
+        return "Symbol(%s %X %s)" % (self.kind, self.location, self.name)
+
+
+def sanitize_name(name):
+    return _invalid_name_chars_re.sub("_", name.strip())
+
+
+# ----------------------------------------------------------------------
+#
+#      FCEUX name list: "$C000#Name#Comment", "$0300/10#Array#".
+#      bank is the 16k PRG-ROM bank of the file, None for ram.nl
+#
+def parse_nl(lines, bank=None):
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if(not line.startswith("$")):
+            continue
+        parts = line[1:].split("#", 2)
+        if(len(parts) < 2):
+            raise SymbolError("line %d: missing '#'" % number)
+        address, _, size = parts[0].partition("/")
+        try:
+            address = int(address, 16)
+            size = int(size, 16) if size else 1
+        except ValueError:
+            raise SymbolError("line %d: bad address %r" % (number, parts[0]))
+        comment = parts[2].replace("\\", "\n").strip() if len(parts) > 2 else None
+
+        if(bank is not None and address >= ROM_START_ADDRESS):
+            kind, location = SYMBOL_PRG, bank * PRG_PAGE_SIZE + address % PRG_PAGE_SIZE
+        else:
+            kind, location = SYMBOL_CPU, address
+        yield Symbol(kind, location, sanitize_name(parts[1]), comment or None, size)
+
+
+# ----------------------------------------------------------------------
+#
+#      Mesen label file: "P:1F2A[-1F2F]:label[:comment]"
+#
+def parse_mlb(lines):
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if(not line.strip()):
+            continue
+        parts = line.split(":", 3)
+        if(len(parts) < 3):
+            raise SymbolError("line %d: expected type:address:label" % number)
+        memory = MLB_MEMORY_TYPES.get(parts[0])
+        if(memory is None):
+            continue
+        start, _, end = parts[1].partition("-")
+        try:
+            start = int(start, 16)
+            size = int(end, 16) - start + 1 if end else 1
+        except ValueError:
+            raise SymbolError("line %d: bad address %r" % (number, parts[1]))
+        comment = parts[3].replace("\\n", "\n") if len(parts) > 3 else None
+        if(not parts[2] and not comment):
+            continue
+        kind, base = memory
+        yield Symbol(kind, base + start, sanitize_name(parts[2]), comment or None, size)
+
+
+def _dbg_fields(text):
+    fields = {}
+    for key, value in _dbg_field_re.findall(text):
+        fields[key] = value[1:-1] if value.startswith('"') else value
+    return fields
+
+
+def _dbg_int(value):
+    return int(value, 0)
+
+
+# ----------------------------------------------------------------------
+#
+#      ld65 debug info: labels ("sym ... type=lab") of segments written
+#      to the ROM image (ooffs) become PRG-ROM symbols, the others CPU
+#      address symbols. header_size is the size of the iNES header
+#      (and trainer) in front of the PRG-ROM in the output file
+#
+def parse_dbg(lines, header_size=INES_HDR_SIZE):
+    segments = {}
+    pending = []
+
+    def resolve(fields):
+        value = _dbg_int(fields["val"])
+        segment = segments.get(fields.get("seg"))
+        size = _dbg_int(fields.get("size", "1"))
+        name = sanitize_name(fields["name"])
+        if(segment is not None and "ooffs" in segment):
+            offset = _dbg_int(segment["ooffs"]) - header_size + \
+                value - _dbg_int(segment["start"])
+            if(offset >= 0):
+                return Symbol(SYMBOL_PRG, offset, name, None, size)
+        if(value < ROM_START_ADDRESS):
+            return Symbol(SYMBOL_CPU, value, name, None, size)
+        return None
+
+    for line in lines:
+        kind, _, rest = line.strip().partition("\t")
+        if(kind == "seg"):
+            fields = _dbg_fields(rest)
+            segments[fields.get("id")] = fields
+        elif(kind == "sym"):
+            fields = _dbg_fields(rest)
+            if(fields.get("type") != "lab" or "val" not in fields):
+                continue
+            # segments are listed first by ld65, but do not rely on it
+            if(fields.get("seg") is not None and fields["seg"] not in segments):
+                pending.append(fields)
+                continue
+            symbol = resolve(fields)
+            if(symbol is not None):
+                yield symbol
+
+    for fields in pending:
+        symbol = resolve(fields)
+        if(symbol is not None):
+            yield symbol
+
+
+# ----------------------------------------------------------------------
+#
+#      parses a symbol file, choosing the format by its name
+#
+def parse_symbol_file(path, header_size=INES_HDR_SIZE):
+    lower = path.lower()
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        if(lower.endswith(".nl")):
+            m = _nl_name_re.search(lower)
+            bank = None
+            if(m is not None and m.group(1) != "ram"):
+                bank = int(m.group(1), 16)
+            for symbol in parse_nl(f, bank):
+                yield symbol
+        elif(lower.endswith(".mlb")):
+            for symbol in parse_mlb(f):
+                yield symbol
+        elif(lower.endswith(".dbg")):
+            for symbol in parse_dbg(f, header_size):
+                yield symbol
+        else:
+            raise SymbolError("%s: unknown symbol file format" % path)
+
+
+# ----------------------------------------------------------------------
+#
+#      all symbol files next to a ROM image: game.nes.*.nl, game.mlb,
+#      game.dbg
+#
+def find_symbol_files(rom_path):
+    directory = os.path.dirname(os.path.abspath(rom_path))
+    base = os.path.basename(rom_path)
+    stem = os.path.splitext(base)[0]
+    found = []
+    for name in sorted(os.listdir(directory)):
+        lower = name.lower()
+        if((lower.startswith(base.lower() + ".") and lower.endswith(".nl")) or
+           lower in (stem.lower() + ".mlb", stem.lower() + ".dbg")):
+            found.append(os.path.join(directory, name))
+    return found
+
+
+# ----------------------------------------------------------------------
+#
+#      merges the symbols of several files. later definitions of a
+#      location replace the name of earlier ones, comments are kept
+#      unless replaced
+#
+def merge_symbols(symbols):
+    merged = {}
+    for symbol in symbols:
+        old = merged.get(symbol.key)
+        if(old is not None):
+            if(not symbol.name):
+                symbol.name = old.name
+            if(symbol.comment is None):
+                symbol.comment = old.comment
+        merged[symbol.key] = symbol
+    return merged
+
+
+# ----------------------------------------------------------------------
+#
+#      applies symbols to the database. names and comments already
+#      present are not set again. returns (applied, stored) counts
+#
+def apply_symbols(symbols):
+    import ida_bytes
+    import ida_name
+    import ida_netnode
+    from nesldr.database import prg_bank_map, prg_offset_to_eas, primary_ea
+
+    merged = merge_symbols(symbols)
+    bank_map = prg_bank_map()
+    unmapped = ida_netnode.netnode(PRG_SYMBOLS_NODE, 0, True)
+
+    # resolve all locations first, then apply names and comments in
+    # separate passes. a PRG-ROM symbol mapped several times is named
+    # at the copy code runs from, the other copies get a comment
+    resolved = []
+    copies = []
+    stored = 0
+    for (kind, location), symbol in sorted(merged.items()):
+        if(kind == SYMBOL_PRG):
+            eas = prg_offset_to_eas(location, bank_map)
+            if(not eas):
+                if(symbol.name):
+                    unmapped.supset(location, symbol.name, 'N')
+                if(symbol.comment):
+                    unmapped.supset(location, symbol.comment, 'C')
+                stored += 1
+                continue
+            ea = primary_ea(eas)
+            copies.extend((copy, ea, symbol) for copy in eas if copy != ea)
+        else:
+            ea = location
+        resolved.append((ea, symbol))
+
+    for ea, symbol in resolved:
+        if(symbol.name and ida_name.get_name(ea) != symbol.name):
+            ida_name.set_name(ea, symbol.name, ida_name.SN_NOWARN | ida_name.SN_FORCE)
+
+    for ea, symbol in resolved:
+        if(symbol.comment and ida_bytes.get_cmt(ea, True) != symbol.comment):
+            ida_bytes.set_cmt(ea, symbol.comment, True)
+
+    for ea, primary, symbol in copies:
+        lines = [symbol.comment] if symbol.comment else []
+        if(symbol.name):
+            lines.insert(0, "%s (also mapped at $%04X)" % (symbol.name, primary))
+        comment = "\n".join(lines)
+        if(comment and ida_bytes.get_cmt(ea, True) != comment):
+            ida_bytes.set_cmt(ea, comment, True)
+
+    return len(resolved), stored
+
+
+# ----------------------------------------------------------------------
+#
+#      imports symbol files, by default all files found next to the
+#      input file of the database
+#
+def import_symbols(paths=None):
+    import ida_nalt
+
+    if(paths is None):
+        paths = find_symbol_files(ida_nalt.get_input_file_path())
+
+    def all_symbols():
+        for path in paths:
+            for symbol in parse_symbol_file(path):
+                yield symbol
+
+    return apply_symbols(all_symbols())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nesldr.symbols")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--list", action="store_true", help="print every symbol")
+    args = parser.parse_args(argv)
+
+    status = 0
+    for path in args.paths:
+        counts = {SYMBOL_PRG: 0, SYMBOL_CPU: 0}
+        try:
+            for symbol in parse_symbol_file(path):
+                counts[symbol.kind] += 1
+                if(args.list):
+                    print("%s %06X %s%s" % (symbol.kind, symbol.location, symbol.name,
+                                            "  ; " + symbol.comment.replace("\n", " ")
+                                            if symbol.comment else ""))
+        except (OSError, SymbolError) as e:
+            sys.stderr.write("%s: %s\n" % (path, e))
+            status = 1
+            continue
+        print("%s: %d PRG-ROM, %d CPU address symbol(s)" %
+              (path, counts[SYMBOL_PRG], counts[SYMBOL_CPU]))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Finding game text with unknown character encodings.
+
+    relative search: a known word is looked up under every
+    linear character mapping at once by searching the
+    differences between its letters in the differences
+    between neighbouring ROM bytes.
+
+    table files (.tbl): once the encoding is known, all text
+    blocks of the ROM are decoded in one pass.
+
+        XX=c        single byte
+        XXYY=str    multi byte sequence
+        /XX[=str]   end of string
+        *XX         line break
+
+    usage:
+        python -m nesldr.textsearch find <rom.nes> <word>
+        python -m nesldr.textsearch decode <rom.nes> <table.tbl> [--min N]
+
+"""
+
+import argparse
+import operator
+import re
+import sys
+
+from nesldr.structs import *
+from nesldr.rom import RomImage
+
+
+# ----------------------------------------------------------------------
+#
+#      d[i] = (data[i + 1] - data[i]) mod 256 for the whole buffer,
+#      computed by C level map()s rather than a python loop
+#
+def diff_bytes(data):
+    data = bytes(data)
+    return bytes(map((0xFF).__and__, map(operator.sub, data[1:], data)))
+
+
+def word_diff(word):
+    return bytes((ord(b) - ord(a)) & 0xFF for a, b in zip(word, word[1:]))
+
+
+# ----------------------------------------------------------------------
+#
+#      yields (offset, bias) for each place where word occurs in data
+#      under a linear mapping, where the encoded value of a character
+#      c is (ord(c) + bias) mod 256
+#
+def relative_search(data, word, diffs=None):
+    if(len(word) < 2):
+        raise ValueError("relative search needs at least two characters")
+    if(diffs is None):
+        diffs = diff_bytes(data)
+    needle = word_diff(word)
+    pos = diffs.find(needle)
+    while(pos != -1):
+        yield pos, (data[pos] - ord(word[0])) & 0xFF
+        pos = diffs.find(needle, pos + 1)
+
+
+# ----------------------------------------------------------------------
+#
+#      relative search over PRG-ROM and CHR-ROM of an image. returns
+#      a list of (area, page, page offset, bias)
+#
+def relative_search_image(image, word):
+    result = []
+    for area, data, page_size in (("PRG", image.prg(), PRG_PAGE_SIZE),
+                                  ("CHR", image.chr(), CHR_PAGE_SIZE)):
+        for offset, bias in relative_search(data, word):
+            result.append((area, offset // page_size, offset % page_size, bias))
+    return result
+
+
+# ----------------------------------------------------------------------
+#
+#      a character table (.tbl file)
+#
+class TextTable(object):
+
+    def __init__(self):
+        self.entries = {}
+        self.end_tokens = set()
+        self.newline_tokens = set()
+        self.max_len = 1
+
+    def add(self, seq, text):
+        self.entries[seq] = text
+        self.max_len = max(self.max_len, len(seq))
+        self._regex = None
+
+    # ----------------------------------------------------------------------
+    #
+    #      parses the lines of a .tbl file
+    #
+    @classmethod
+    def parse(cls, lines):
+        table = cls()
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if(not line.strip()):
+                continue
+            kind = line[0] if line[0] in "/*" else None
+            if(kind):
+                line = line[1:]
+            seq, _, text = line.partition("=")
+            try:
+                seq = bytes.fromhex(seq.strip())
+            except ValueError:
+                continue
+            if(not seq):
+                continue
+            if(kind == "/"):
+                table.end_tokens.add(seq)
+            elif(kind == "*"):
+                table.newline_tokens.add(seq)
+                text = text or "\n"
+            table.add(seq, text)
+        return table
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return cls.parse(f)
+
+    # ----------------------------------------------------------------------
+    #
+    #      regex matching maximal runs of bytes that occur in any table
+    #      entry. the runs are found in C, only their contents are
+    #      decoded in python
+    #
+    def candidate_regex(self):
+        if(self._regex is None):
+            members = sorted(set(b for seq in self.entries for b in seq))
+            cls = b"".join(re.escape(bytes([b])) for b in members)
+            self._regex = re.compile(b"[" + cls + b"]+")
+        return self._regex
+
+    # ----------------------------------------------------------------------
+    #
+    #      yields (offset, length, text) for every text block of at least
+    #      min_len characters. a block ends at an end token, or where
+    #      the bytes can not be decoded
+    #
+    def find_blocks(self, data, min_len=4):
+        if(not self.entries):
+            return
+        data = bytes(data)
+        entries = self.entries
+        for run in self.candidate_regex().finditer(data):
+            pos, end = run.start(), run.end()
+            start, chars, count = pos, [], 0
+            while(pos < end):
+                for n in range(min(self.max_len, end - pos), 0, -1):
+                    seq = data[pos:pos + n]
+                    text = entries.get(seq)
+                    if(text is not None):
+                        break
+                else:
+                    n, seq = 0, None
+
+                if(seq is None):
+                    if(count >= min_len):
+                        yield start, pos - start, "".join(chars)
+                    pos += 1
+                    start, chars, count = pos, [], 0
+                    continue
+
+                pos += n
+                chars.append(text)
+                if(seq in self.end_tokens):
+                    if(count >= min_len):
+                        yield start, pos - start, "".join(chars)
+                    start, chars, count = pos, [], 0
+                elif(seq not in self.newline_tokens):
+                    count += 1
+
+            if(count >= min_len):
+                yield start, pos - start, "".join(chars)
+
+
+# ----------------------------------------------------------------------
+#
+#      text blocks of all PRG-ROM pages as (prg offset, length, text).
+#      blocks never cross a page boundary
+#
+def find_prg_text(image, table, min_len=4):
+    result = []
+    for page in range(image.prg_page_count):
+        base = page * PRG_PAGE_SIZE
+        for offset, length, text in table.find_blocks(image.prg_page(page), min_len):
+            result.append((base + offset, length, text))
+    return result
+
+
+def make_text_label(text, prefix="txt_", max_len=24):
+    name = re.sub(r"[^0-9A-Za-z]+", "_", text).strip("_")[:max_len]
+    return prefix + (name or "block")
+
+
+# ----------------------------------------------------------------------
+#
+#      creates string items for text blocks in the IDA database. the
+#      decoded text becomes a repeatable comment. blocks in unmapped
+#      banks are remembered in a netnode (supval index = PRG offset)
+#
+def apply_text_blocks(blocks):
+    import ida_bytes
+    import ida_name
+    import ida_netnode
+    from nesldr.database import is_prg_offset_at, prg_bank_map, prg_offset_to_eas, primary_ea
+
+    bank_map = prg_bank_map()
+    unmapped = ida_netnode.netnode(PRG_TEXT_NODE, 0, True)
+    applied = 0
+
+    for offset, length, text in blocks:
+        # every copy of the bank holding the whole block in one piece
+        eas = [ea for ea in prg_offset_to_eas(offset, bank_map)
+               if is_prg_offset_at(offset + length - 1, ea + length - 1, bank_map)]
+        if(not eas):
+            unmapped.supset(offset, text)
+            continue
+
+        primary = primary_ea(eas)
+        for ea in eas:
+            ida_bytes.del_items(ea, ida_bytes.DELIT_SIMPLE, length)
+            ida_bytes.create_byte(ea, length)
+            ida_bytes.set_cmt(ea, text, True)
+        ida_name.set_name(primary, make_text_label(text), ida_name.SN_NOWARN | ida_name.SN_FORCE)
+        applied += 1
+
+    return applied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="nesldr.textsearch")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("find", help="relative search for a known word")
+    p.add_argument("rom")
+    p.add_argument("word")
+
+    p = sub.add_parser("decode", help="decode all text using a table file")
+    p.add_argument("rom")
+    p.add_argument("table")
+    p.add_argument("--min", type=int, default=4, help="minimum characters per block")
+
+    args = parser.parse_args(argv)
+    image = RomImage.from_file(args.rom)
+
+    if(args.command == "find"):
+        for area, page, offset, bias in relative_search_image(image, args.word):
+            print("%s page %02d:%04x  'A' = %02X" %
+                  (area, page, offset, (ord("A") + bias) & 0xFF))
+    else:
+        table = TextTable.from_file(args.table)
+        for offset, length, text in find_prg_text(image, table, args.min):
+            print("PRG page %02d:%04x  %r" %
+                  (offset // PRG_PAGE_SIZE, offset % PRG_PAGE_SIZE, text))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
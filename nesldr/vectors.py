@@ -0,0 +1,111 @@
+"""
+
+    Nintendo Entertainment System (NES) loader module
+    ------------------------------------------------------
+
+    Interrupt vectors of every PRG-ROM bank. Mappers switching
+    the whole 32k (AOROM, GNROM, Color Dreams, ...) and most
+    16k switching games repeat the vectors and a reset stub
+    in every bank, so each window ending at $FFFF is checked.
+
+"""
+
+import sys
+from array import array
+
+from nesldr.structs import *
+from nesldr.banks import prg_window_size
+from nesldr.opcodes import OPCODES, OP_SEI, OP_CLD
+
+
+VECTOR_NAMES = ("NMI", "RESET", "IRQ")
+VECTORS_SIZE = 6
+
+
+class BankVectors(object):
+
+    def __init__(self, window, prg_offset, size, nmi, reset, irq):
+        self.window = window            # index of the window
+        self.prg_offset = prg_offset    # PRG-ROM offset of the window
+        self.size = size                # 16k or 32k
+        self.nmi = nmi
+        self.reset = reset
+        self.irq = irq
+
+    @property
+    def base(self):
+        return 0x10000 - self.size
+
+    def handlers(self):
+        return (("NMI", self.nmi), ("RESET", self.reset), ("IRQ", self.irq))
+
+    # PRG-ROM offset of an address inside this window, None outside
+    def offset_of(self, address):
+        if(not self.base <= address < 0x10000):
+            return None
+        return self.prg_offset + address - self.base
+
+    def __repr__(self):
+        return "BankVectors(%d, NMI=%04X, RESET=%04X, IRQ=%04X)" % \
+            (self.window, self.nmi, self.reset, self.irq)
+
+
+# ----------------------------------------------------------------------
+#
+#      reads the vector triplets of all windows at once: the last six
+#      bytes of every window are gathered into one buffer and viewed
+#      as 16 bit words
+#
+def read_bank_vectors(prg, window_size):
+    prg = memoryview(prg)
+    count = len(prg) // window_size
+    tails = b"".join(prg[(i + 1) * window_size - VECTORS_SIZE:(i + 1) * window_size]
+                     for i in range(count))
+    words = array("H", tails)
+    if(sys.byteorder == "big"):
+        words.byteswap()
+    return [BankVectors(i, i * window_size, window_size, *words[i * 3:i * 3 + 3])
+            for i in range(count)]
+
+
+# ----------------------------------------------------------------------
+#
+#      checks a handler address. it has to point into the ROM below the
+#      vectors and, if it lies inside the window, to a valid opcode
+#
+def is_valid_handler(prg, vectors, address, reset=False):
+    if(not ROM_START_ADDRESS <= address < NMI_VECTOR_START_ADDRESS):
+        return False
+    offset = vectors.offset_of(address)
+    if(offset is None):
+        # points into the other, switchable half of the address space
+        return True
+    op = OPCODES[prg[offset]]
+    if(op is None or op.mnemonic == "BRK"):
+        return False
+    if(reset):
+        # reset stubs start with SEI/CLD nearly everywhere; accept other
+        # code too, but not a bare return
+        return op.mnemonic not in ("RTI", "RTS")
+    return True
+
+
+def is_valid_vectors(prg, vectors):
+    return is_valid_handler(prg, vectors, vectors.nmi) and \
+        is_valid_handler(prg, vectors, vectors.reset, True) and \
+        is_valid_handler(prg, vectors, vectors.irq)
+
+
+def has_reset_stub(prg, vectors):
+    offset = vectors.offset_of(vectors.reset)
+    return offset is not None and prg[offset] in (OP_SEI, OP_CLD)
+
+
+# ----------------------------------------------------------------------
+#
+#      returns the validated vectors of all windows of an image
+#
+def find_bank_vectors(image):
+    prg = image.prg()
+    return [v for v in read_bank_vectors(prg, prg_window_size(image.mapper))
+            if is_valid_vectors(prg, v)]